@@ -1,6 +1,10 @@
 from socket import *
 import sys
 import os
+import threading
+import time
+
+import protocol
 
 if len(sys.argv) != 3:
     print("\n===== Error usage, python3 UDPClient.py SERVER_IP SERVER_PORT ======\n")
@@ -14,9 +18,13 @@ serverAddress = (serverHost, serverPort)
 AVAILABLE_COMMANDS = {
     "LST": 0,  # List Threads
     "XIT": 0,  # Exit
+    "BAT": 0,  # Batch of commands
     "CRT": 1,  # Create Thread
     "RDT": 1,  # Read Thread
     "RMV": 1,  # Remove Thread
+    "SUB": 1,  # Subscribe to Thread
+    "UNSUB": 1,  # Unsubscribe from Thread
+    "SRCH": 1,  # Search Messages
     "MSG": 2,  # Post Message
     "DLT": 2,  # Delete Message
     "UPD": 2,  # Upload File
@@ -30,11 +38,15 @@ def display_commands():
     print("MSG <threadtitle> <message> - Post Message")
     print("DLT <threadtitle> <message number> - Delete Message")
     print("EDT <threadtitle> <message number> <message> - Edit Message")
-    print("LST - List Threads")
-    print("RDT <threadtitle> - Read thread")
+    print("LST [name|created|activity] - List Threads")
+    print("RDT <threadtitle> [offset] [count] - Read thread (again: only what changed)")
     print("UPD <threadtitle> <filename> - Upload file")
     print("DWN <threadtitle> <filename> - Download file")
     print("RMV <threadtitle> - Remove thread")
+    print("SUB <threadtitle> - Get notified of changes to a thread")
+    print("UNSUB <threadtitle> - Stop notifications for a thread")
+    print("SRCH <words> [user=<name>] [limit=<n>] - Find messages containing all the words")
+    print("BAT [file] - Run several CRT/MSG/DLT/EDT/RDT commands at once (from file, or typed one per line)")
     print("XIT - Exit")
     print("================================\n")
 
@@ -48,6 +60,210 @@ def clean_udp_socket(sock):
     finally:
         sock.setblocking(True)
 
+# sequence number of the last notification datagram from each server process, to notice lost ones
+last_notification = {}
+
+# called from the socket's reader thread for every notification the server pushes
+def show_notification(origin, seq, events):
+    last = last_notification.get(origin)
+    if last is not None and seq > last + 1:
+        print(f"\n[notify] {seq - last - 1} notification(s) lost, RDT to catch up")
+    last_notification[origin] = seq
+    for event in events:
+        print(f"\n[notify] {event}")
+
+# threads this client is subscribed to, from the server's replies to SUB and UNSUB
+subscriptions = set()
+
+# note the subscriptions a reply (to a single command or a batch) started or ended
+def note_subscriptions(response):
+    for line in response.split("\n"):
+        if line.startswith("Subscribed to thread '"):
+            subscriptions.add(line.split("'")[1])
+        elif line.startswith("Unsubscribed from thread '"):
+            subscriptions.discard(line.split("'")[1])
+
+# seconds between keepalives, well within the server's idle timeout
+KEEPALIVE_INTERVAL = 60
+
+# a client that only waits for notifications sends no requests, so while it is subscribed it tells
+# the server now and then that it is still there; sock must send the keepalive as it is, unwrapped
+def send_keepalives(sock, serverAddress):
+    while True:
+        time.sleep(KEEPALIVE_INTERVAL)
+        if subscriptions:
+            try:
+                sock.sendto(protocol.KEEPALIVE_MARKER, serverAddress)
+            except OSError:
+                return
+
+# compression codec agreed with the server after login, None if replies come uncompressed
+session_codec = None
+
+# offer the codecs this client has and binary framing; older servers do not know HELLO and the
+# session just goes on with uncompressed text
+def negotiate_session(udpSocket, serverAddress):
+    global session_codec
+    try:
+        udpSocket.sendto(f"HELLO compress={','.join(protocol.CODECS)} framing=binary".encode(), serverAddress)
+        data, _ = udpSocket.recvfrom(1024)
+        fields = data.decode(errors="replace").split()
+        if fields and fields[0] == "HELLO":
+            options = protocol.parse_options(fields[1:])
+            session_codec = options.get("compress")
+            # from now on commands go out as binary frames, see protocol.FramedSocket
+            udpSocket.binary = options.get("framing") == "binary"
+    except timeout:
+        pass
+
+# receive one reply from the server; long replies arrive as numbered parts and are put back together.
+# While parts are missing the socket resends the request, so the server sends the parts again
+def receive_response(udpSocket):
+    data = receive_payload(udpSocket)
+    # the server compresses long replies with the codec agreed on for the session
+    if session_codec and data.startswith(protocol.COMPRESSED_MARKER):
+        data = protocol.decompress(session_codec, data[1:])
+    return data
+
+def receive_payload(udpSocket):
+    data, _ = udpSocket.recvfrom(65535)
+    part = protocol.parse_stream_part(data)
+    if part is None:
+        return data
+
+    stream_id, _, total, _ = part
+    chunks = {}
+    try:
+        while True:
+            # parts of an older reply that arrive late are ignored
+            if part is not None and part[0] == stream_id:
+                chunks[part[1]] = part[3]
+                if len(chunks) == total:
+                    break
+            data, _ = udpSocket.recvfrom(65535)
+            part = protocol.parse_stream_part(data)
+    except timeout:
+        print(f"===== Warning: reply incomplete, received {len(chunks)} of {total} parts =====")
+
+    return b"".join(chunks[index] for index in sorted(chunks))
+
+# threads read before: title -> (version, [[id, line], ...]) with id "-" for uploads, so reading a
+# thread again only fetches what changed since
+thread_cache = {}
+
+# read a whole thread with "RDT <title> since <version>" and merge the changes into the cached copy
+def read_thread(udpSocket, serverAddress, title, retry=True):
+    version, entries = thread_cache.pop(title, ("0", []))
+    udpSocket.sendto(f"RDT {title} since {version}".encode(), serverAddress)
+    response = receive_response(udpSocket).decode(errors="replace")
+    lines = response.split("\n")
+    header = lines[0].split()
+    if len(header) != 3 or header[0] not in ("VERSION", "RESET"):
+        # an error, or a server that cannot send changes
+        print("[server]:\n", response)
+        return
+
+    if header[0] == "RESET":
+        entries = []
+    by_id = {entry[0]: entry for entry in entries if entry[0] != "-"}
+    deleted = set()
+    for line in lines[1:]:
+        if line.startswith("DELETED "):
+            deleted.update(line.split()[1:])
+            continue
+        fields = line.split(" ", 2)
+        if len(fields) < 3:
+            continue
+        message_id, text = fields[1], fields[2]
+        if message_id in by_id:
+            by_id[message_id][1] = text
+        else:
+            # uploads ("-") are never edited, each one is a new entry
+            entry = [message_id, text]
+            entries.append(entry)
+            if message_id != "-":
+                by_id[message_id] = entry
+    entries = [entry for entry in entries if entry[0] not in deleted]
+
+    # a copy that does not add up (e.g. part of a reply was lost) is fetched again in full
+    if len(entries) != int(header[2]):
+        if retry:
+            read_thread(udpSocket, serverAddress, title, retry=False)
+        else:
+            print("===== Error: thread changed while reading it, try again =====")
+        return
+    thread_cache[title] = (header[1], entries)
+
+    if not entries:
+        print("[server]:\n", f"Thread '{title}' has no messages.")
+        return
+    out = []
+    for number, (message_id, text) in enumerate(entries, 1):
+        out.append(text if message_id == "-" else f"{number} {text}")
+    print("[server]:\n", "\n".join(out))
+
+# size of the buffer used to receive downloaded files
+TRANSFER_BUFFER_SIZE = 1 << 20
+
+# large files may be split over this many TCP connections running side by side, if the server agrees
+TRANSFER_STREAMS = 4
+
+# "PORT <port> [token] [key=value ...]" -> (port, token, options); older servers send no token
+def parse_port_line(port_line):
+    fields = port_line.split()
+    token = fields[2] if len(fields) > 2 and "=" not in fields[2] else None
+    options = protocol.parse_options(fields[3 if token else 2:])
+    return int(fields[1]), token, options
+
+# connect to the server's data listener and tell it which transfer (and which byte range of it,
+# for one stream of a multi-stream transfer) this connection is for
+def open_data_connection(serverHost, tcp_port, token, byte_range=None):
+    tcp_socket = socket(AF_INET, SOCK_STREAM)
+    tcp_socket.connect((serverHost, tcp_port))
+    if byte_range:
+        tcp_socket.sendall(f"{token} {byte_range[0]} {byte_range[1]}\n".encode())
+    elif token:
+        tcp_socket.sendall(f"{token}\n".encode())
+    return tcp_socket
+
+# run one stream per byte range and wait for all of them
+def run_streams(target, ranges, *args):
+    streams = [threading.Thread(target=target, args=args + byte_range, daemon=True) for byte_range in ranges]
+    for stream in streams:
+        stream.start()
+    for stream in streams:
+        stream.join()
+
+def upload_range(serverHost, tcp_port, token, filename, start, end):
+    try:
+        tcp_socket = open_data_connection(serverHost, tcp_port, token, (start, end))
+        with open(filename, "rb") as f:
+            tcp_socket.sendfile(f, start, end - start)
+        tcp_socket.close()
+    except Exception as e:
+        print(f"===== Error sending bytes {start}-{end}: {e}")
+
+# receive bytes [start, end) of a file into its place in part_name, noting how many arrived in results
+def download_range(serverHost, tcp_port, token, part_name, results, start, end):
+    received = 0
+    buffer = bytearray(TRANSFER_BUFFER_SIZE)
+    view = memoryview(buffer)
+    fd = os.open(part_name, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        tcp_socket = open_data_connection(serverHost, tcp_port, token, (start, end))
+        while received < end - start:
+            n = tcp_socket.recv_into(buffer, min(len(buffer), end - start - received))
+            if not n:
+                break
+            os.pwrite(fd, view[:n], start + received)
+            received += n
+        tcp_socket.close()
+    except Exception as e:
+        print(f"===== Error receiving bytes {start}-{end}: {e}")
+    finally:
+        os.close(fd)
+        results[start] = (end, received)
+
 def upload_file_to_server(udpSocket, serverAddress, serverHost, parameters):
     try:
         threadtitle, filename = parameters.split()
@@ -56,8 +272,15 @@ def upload_file_to_server(udpSocket, serverAddress, serverHost, parameters):
             print("===== Error: File not found on client side.")
             return
 
-        # send UPD command to server
-        udpSocket.sendto(f"UPD {threadtitle} {filename}".encode(), serverAddress)
+        # send UPD command to server, with the size and checksum the server needs to resume an
+        # interrupted upload and to check the file arrived intact
+        size = os.path.getsize(filename)
+        checksum = protocol.file_sha256(filename)
+        request = f"UPD {threadtitle} {filename} size={size} sha256={checksum} streams={TRANSFER_STREAMS}"
+        # compress the file on the way unless it is compressed already (zip, jpeg, ...)
+        if session_codec and not protocol.looks_compressed(filename):
+            request += f" compress={session_codec}"
+        udpSocket.sendto(request.encode(), serverAddress)
 
         # handle the server response, as it may contain multiple lines
         response_lines = []
@@ -66,32 +289,49 @@ def upload_file_to_server(udpSocket, serverAddress, serverHost, parameters):
             if not data:
                 break
             response_lines += data.decode().strip().splitlines()
-            if any(line.startswith("PORT") or line.startswith("Error") for line in response_lines):
+            # anything but READY ends the exchange: PORT, an error, or a success reply when the server
+            # already has the file's content and no transfer is needed
+            if any(line != "READY" for line in response_lines):
                 break
 
         for line in response_lines:
             print(f"[recv] {line}")
 
-        if any(line.startswith("Error") for line in response_lines):
+        # the status of the last reply tells whether the server refused the transfer
+        if udpSocket.status == protocol.STATUS_ERROR:
             return
 
         port_line = next((line for line in response_lines if line.startswith("PORT")), None)
         if not port_line:
-            print("===== Error: Did not receive PORT from server =====")
             return
 
-        tcp_port = int(port_line.split()[1])
+        tcp_port, token, options = parse_port_line(port_line)
+        # the server already has the first offset bytes of an earlier, interrupted upload
+        offset = int(options.get("offset", "0"))
+        if offset:
+            print(f"===== Resuming upload at byte {offset} of {size} =====")
 
-        # create TCP socket for file transfer
-        tcp_socket = socket(AF_INET, SOCK_STREAM)
-        tcp_socket.connect((serverHost, tcp_port))
-        with open(filename, "rb") as f:
-            while True:
-                data = f.read(2048)
-                if not data:
-                    break
-                tcp_socket.sendall(data)
-        tcp_socket.close()
+        streams = int(options.get("streams", "1"))
+        if streams > 1:
+            # each stream sends its own part of the rest of the file
+            run_streams(upload_range, protocol.split_ranges(offset, size, streams), serverHost, tcp_port, token, filename)
+        else:
+            # create TCP socket for file transfer
+            tcp_socket = open_data_connection(serverHost, tcp_port, token)
+            with open(filename, "rb") as f:
+                if "compress" in options:
+                    compressor = protocol.Compressor(options["compress"])
+                    f.seek(offset)
+                    while True:
+                        chunk = f.read(TRANSFER_BUFFER_SIZE)
+                        if not chunk:
+                            break
+                        tcp_socket.sendall(compressor.compress(chunk))
+                    tcp_socket.sendall(compressor.flush())
+                else:
+                    # let the kernel copy the file to the socket (falls back to plain sends where unsupported)
+                    tcp_socket.sendfile(f, offset)
+            tcp_socket.close()
 
         # make sure to receive the ACK from the server
         final_ack, _ = udpSocket.recvfrom(1024)
@@ -104,8 +344,16 @@ def download_file_from_server(udpSocket, serverAddress, serverHost, parameters):
     try:
         threadtitle, filename = parameters.split()
 
+        # the file is downloaded into "{filename}.part" and only renamed once it is complete and its
+        # checksum matches; a partial file left by an interrupted download is resumed
+        part_name = f"{filename}.part"
+        offset = os.path.getsize(part_name) if os.path.isfile(part_name) else 0
+
         # send DWN command to server
-        udpSocket.sendto(f"DWN {threadtitle} {filename}".encode(), serverAddress)
+        request = f"DWN {threadtitle} {filename} streams={TRANSFER_STREAMS}"
+        if offset:
+            request += f" offset={offset}"
+        udpSocket.sendto(request.encode(), serverAddress)
 
         # similar to UPD, handle the server response as it may contain multiple lines
         response_lines = []
@@ -115,13 +363,14 @@ def download_file_from_server(udpSocket, serverAddress, serverHost, parameters):
                 break
             response_lines += data.decode().strip().splitlines()
 
-            if any(line.startswith("PORT") or line.startswith("Error") for line in response_lines):
+            if udpSocket.status == protocol.STATUS_ERROR or any(line.startswith("PORT") for line in response_lines):
                 break
 
         for line in response_lines:
             print(f"[recv] {line}")
 
-        if any(line.startswith("Error") for line in response_lines):
+        # the status of the last reply tells whether the server refused the transfer
+        if udpSocket.status == protocol.STATUS_ERROR:
             return
 
         port_line = next((line for line in response_lines if line.startswith("PORT")), None)
@@ -129,26 +378,92 @@ def download_file_from_server(udpSocket, serverAddress, serverHost, parameters):
             print("===== Error: Did not receive PORT from server =====")
             return
 
-        tcp_port = int(port_line.split()[1])
-
-        # create tcp connection and download the file
-        tcp_socket = socket(AF_INET, SOCK_STREAM)
-        tcp_socket.connect((serverHost, tcp_port))
-        with open(filename, "wb") as f:
-            while True:
-                data = tcp_socket.recv(2048)
-                if not data:
-                    break
-                f.write(data)
-        tcp_socket.close()
+        tcp_port, token, options = parse_port_line(port_line)
+        # the server may start over from 0 if the partial file does not fit the file it has
+        offset = int(options.get("offset", "0"))
+        if offset:
+            print(f"===== Resuming download at byte {offset} =====")
+
+        with open(part_name, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            f.truncate()
+            streams = int(options.get("streams", "1"))
+            if streams <= 1:
+                # create tcp connection and download the file
+                tcp_socket = open_data_connection(serverHost, tcp_port, token)
+                decompressor = protocol.Decompressor(options["compress"]) if "compress" in options else None
+                buffer = bytearray(TRANSFER_BUFFER_SIZE)
+                view = memoryview(buffer)
+                while True:
+                    n = tcp_socket.recv_into(buffer)
+                    if not n:
+                        break
+                    f.write(decompressor.decompress(view[:n]) if decompressor else view[:n])
+                if decompressor:
+                    f.write(decompressor.flush())
+                tcp_socket.close()
+
+        if streams > 1:
+            # each stream fills its own part of the file; if one stops early, only what arrived
+            # without a gap is kept for a later DWN to resume from
+            results = {}
+            end = offset + int(options["length"])
+            run_streams(download_range, protocol.split_ranges(offset, end, streams), serverHost, tcp_port, token, part_name, results)
+            os.truncate(part_name, protocol.received_prefix(offset, results))
 
         # make sure to receive the ACK from the server
         final_ack, _ = udpSocket.recvfrom(1024)
         print(f"[recv] {final_ack.decode().strip()}")
 
+        # keep a short file for the next DWN to resume, drop a corrupt one
+        if "size" in options:
+            received = os.path.getsize(part_name)
+            if received < int(options["size"]):
+                print(f"===== Download interrupted at byte {received} of {options['size']}, run DWN again to resume =====")
+                return
+            if protocol.file_sha256(part_name) != options.get("sha256"):
+                os.remove(part_name)
+                print("===== Error: Checksum mismatch, downloaded file discarded =====")
+                return
+        os.replace(part_name, filename)
+
     except Exception as e:
         print(f"===== Error in DWN client side: {e}")
 
+# largest batch request that still fits in one datagram
+MAX_BATCH_SIZE = 60000
+
+# send several commands as one BAT request: read from a file, or typed one per line until an empty line
+def run_batch(udpSocket, serverAddress, filename):
+    try:
+        if filename:
+            with open(filename) as f:
+                lines = [line.strip() for line in f if line.strip()]
+        else:
+            lines = []
+            while True:
+                line = input("batch> ").strip()
+                if not line:
+                    break
+                lines.append(line)
+
+        if not lines:
+            print("===== Error: Batch is empty =====")
+            return
+        request = "\n".join(["BAT"] + lines)
+        if len(request.encode()) > MAX_BATCH_SIZE:
+            print("===== Error: Batch too large, split it into several =====")
+            return
+
+        udpSocket.sendto(request.encode(), serverAddress)
+        response = receive_response(udpSocket).decode(errors="replace")
+        note_subscriptions(response)
+        print("[server]:\n", response)
+    except timeout:
+        print("===== Error: No response from server =====")
+    except Exception as e:
+        print(f"===== Error in BAT client side: {e}")
+
 def use_command(udpSocket, serverAddress):
     while True:
         clean_udp_socket(udpSocket) # Clean the socket to avoid blocking, as UDP is a state-less protocol and may have old data
@@ -172,7 +487,9 @@ def use_command(udpSocket, serverAddress):
         # handle commands by checking the number of their parameters
         expected_parameters = AVAILABLE_COMMANDS[command]
         if expected_parameters == 0:
-            parameters = ""
+            # LST takes an optional sort order and BAT an optional file, the other commands ignore
+            # anything after them
+            parameters = parts[1] if command in ("LST", "BAT") and len(parts) > 1 else ""
         elif len(parts) < 2:
             print(f"===== Error: '{command}' requires {expected_parameters} parameter(s) =====")
             continue
@@ -186,6 +503,18 @@ def use_command(udpSocket, serverAddress):
         # send command to server
         full_message = f"{command} {parameters}".strip()
 
+        if command == "BAT":
+            run_batch(udpSocket, serverAddress, parameters)
+            continue
+
+        # a plain RDT only fetches what changed since the thread was last read
+        if command == "RDT" and len(parameters.split()) == 1:
+            try:
+                read_thread(udpSocket, serverAddress, parameters)
+            except timeout:
+                print("===== Error: No response from server =====")
+            continue
+
         if command not in("UPD", "DWN", "RMV", "XIT"):
             udpSocket.sendto(full_message.encode(), serverAddress)
 
@@ -225,8 +554,12 @@ def use_command(udpSocket, serverAddress):
             # user log out, break the while loop    
             break 
 
-        response, _ = udpSocket.recvfrom(2048)
-        print("[server]:\n", response.decode())
+        try:
+            response = receive_response(udpSocket).decode(errors="replace")
+            note_subscriptions(response)
+            print("[server]:\n", response)
+        except timeout:
+            print("===== Error: No response from server =====")
 
 def login_process(udpSocket, serverAddress):
     udpSocket.sendto("login".encode(), serverAddress)
@@ -249,6 +582,11 @@ def login_process(udpSocket, serverAddress):
             print("[recv] this user is logged in already")
             return False
 
+        # a new username must be one word, without ":" and not starting with "!"
+        elif next_message == "invalid username":
+            print("[recv] invalid username, use one word without ':' that does not start with '!'")
+            return False
+
         # user if not logged in
         elif next_message == "password request":
             password = input("Password: ")
@@ -282,15 +620,29 @@ def login_process(udpSocket, serverAddress):
     
 def main():
     # use UDP socket
-    udpSocket = socket(AF_INET, SOCK_DGRAM)
+    # requests are resent until the server answers, see protocol.ReliableSocket, and sent as binary
+    # frames if the server supports them; notifications pushed by the server are printed as they
+    # arrive, see protocol.PushSocket
+    pushSocket = protocol.PushSocket(socket(AF_INET, SOCK_DGRAM), show_notification)
+    udpSocket = protocol.FramedSocket(protocol.ReliableSocket(pushSocket))
+    # a large receive buffer, so the parts of a long reply are not dropped while we reassemble them
+    udpSocket.setsockopt(SOL_SOCKET, SO_RCVBUF, 1 << 20)
     print("===== UDP Client Started =====")
 
     while True:
         user_input = input(">>>(enter: login) ").strip()
 
         if user_input.lower() == "login":
-            if login_process(udpSocket, serverAddress):
+            try:
+                logged_in = login_process(udpSocket, serverAddress)
+            except timeout:
+                print("===== Error: No response from server =====")
+                logged_in = False
+
+            if logged_in:
                 print("Welcome.")
+                negotiate_session(udpSocket, serverAddress)
+                threading.Thread(target=send_keepalives, args=(pushSocket, serverAddress), daemon=True).start()
                 use_command(udpSocket, serverAddress)
                 break
             else:
@@ -0,0 +1,165 @@
+import itertools
+import json
+import os
+import signal
+import socket
+import struct
+import threading
+import zlib
+
+# several server processes sharing one UDP port (SO_REUSEPORT), so the forum can use more than one
+# core. The kernel spreads clients over the processes by address, and each thread title is owned by
+# exactly one process, picked by a hash of the title, which is the only one that touches its files.
+# The processes are forked from one parent and talk over stream socket pairs: a message is a 4-byte
+# length, a JSON header line with its "kind", and a binary payload
+MESSAGE_LENGTH = struct.Struct("!I")
+
+class Cluster:
+    def __init__(self, size):
+        self.size = max(1, size)
+        self.index = 0          # which process this is, 0 is the parent
+        self.children = []      # pids of the forked processes (in the parent)
+        self.links = {}         # peer index -> socket to it
+        self.send_locks = {}    # peer index -> lock, so messages from several threads do not interleave
+        self.handlers = {}      # message kind -> handler(peer, header, payload)
+        self.asks = {}          # ask id -> [event, (header, payload) of the reply]
+        self.ask_ids = itertools.count(1)
+
+    # fork the other processes, returns the index of the calling process afterwards. Call it before
+    # any thread is started
+    def fork(self):
+        pairs = {}
+        for i in range(self.size):
+            for j in range(i + 1, self.size):
+                pairs[i, j] = socket.socketpair()
+        for index in range(1, self.size):
+            pid = os.fork()
+            if pid == 0:
+                self.index = index
+                self.children = []
+                # Ctrl+C reaches every process, but only the parent handles it; it stops the others
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                break
+            self.children.append(pid)
+
+        for (i, j), (a, b) in pairs.items():
+            if self.index == i:
+                self.links[j] = a
+                b.close()
+            elif self.index == j:
+                self.links[i] = b
+                a.close()
+            else:
+                a.close()
+                b.close()
+        self.send_locks = {peer: threading.Lock() for peer in self.links}
+        return self.index
+
+    def owner(self, title):
+        return zlib.crc32(title.encode()) % self.size
+
+    def owns(self, title):
+        return self.owner(title) == self.index
+
+    def peers(self):
+        return sorted(self.links)
+
+    def on(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def send(self, peer, kind, header=None, payload=b""):
+        data = json.dumps(dict(header or {}, kind=kind)).encode() + b"\n" + payload
+        with self.send_locks[peer]:
+            self.links[peer].sendall(MESSAGE_LENGTH.pack(len(data)) + data)
+
+    def broadcast(self, kind, header=None, payload=b""):
+        for peer in self.peers():
+            try:
+                self.send(peer, kind, header, payload)
+            except OSError as e:
+                print(f"===== Error sending to process {peer}: {e}")
+
+    # send a message whose handler returns a reply, and wait for it; None when the peer does not answer
+    def ask(self, peer, kind, header=None, payload=b"", timeout=2.0):
+        ask_id = next(self.ask_ids)
+        waiting = self.asks[ask_id] = [threading.Event(), None]
+        try:
+            self.send(peer, kind, dict(header or {}, ask=ask_id), payload)
+            waiting[0].wait(timeout)
+            return waiting[1]
+        except OSError:
+            return None
+        finally:
+            self.asks.pop(ask_id, None)
+
+    # ask every other process at once, returns the replies that arrived in time
+    def ask_all(self, kind, header=None, payload=b"", timeout=2.0):
+        replies = [None] * len(self.links)
+        def ask_one(n, peer):
+            replies[n] = self.ask(peer, kind, header, payload, timeout)
+        threads = [threading.Thread(target=ask_one, args=(n, peer)) for n, peer in enumerate(self.peers())]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return [reply for reply in replies if reply is not None]
+
+    def start(self):
+        for peer, link in self.links.items():
+            threading.Thread(target=self.receive_loop, args=(peer, link), name=f"link-{peer}", daemon=True).start()
+
+    # stop the forked processes, from the parent
+    def stop(self):
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in self.children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+
+    def receive_loop(self, peer, link):
+        while True:
+            header = recv_exact(link, MESSAGE_LENGTH.size)
+            data = header and recv_exact(link, MESSAGE_LENGTH.unpack(header)[0])
+            if not data:
+                break
+            line, _, payload = data.partition(b"\n")
+            header = json.loads(line)
+            kind = header.pop("kind")
+            try:
+                if kind == "reply":
+                    waiting = self.asks.get(header.pop("reply"))
+                    if waiting is not None:
+                        waiting[1] = (header, payload)
+                        waiting[0].set()
+                    continue
+
+                handler = self.handlers.get(kind)
+                if handler is None:
+                    print(f"===== Unknown message '{kind}' from process {peer}")
+                    continue
+                ask_id = header.pop("ask", None)
+                reply = handler(peer, header, payload)
+                if ask_id is not None:
+                    reply_header, reply_payload = reply or ({}, b"")
+                    self.send(peer, "reply", dict(reply_header, reply=ask_id), reply_payload)
+            except Exception as e:
+                print(f"===== Error handling '{kind}' from process {peer}: {e}")
+
+        # the parent went away without stopping us (e.g. it was killed), shut down cleanly as well
+        print(f"[cluster] Lost the link to process {peer}")
+        if peer == 0:
+            os.kill(os.getpid(), signal.SIGTERM)
+
+def recv_exact(sock, n):
+    data = bytearray()
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
@@ -0,0 +1,62 @@
+import sys
+
+from storage import CredentialStore, ThreadStore, lock_wal, replay_wal
+from sqlite_storage import Database, SQLiteCredentialStore, SQLiteThreadStore
+
+# copy a forum from one storage backend of the server to the other, in the server's directory and
+# while it is stopped:
+#   python3 migrate.py files sqlite [DATABASE]    thread files and credentials.txt into the database
+#   python3 migrate.py sqlite files [DATABASE]    and back
+# DATABASE defaults to forum.db, as FORUM_DATABASE does. Users and threads the target already has are
+# left alone. Attachments stay in "attachments/", which both backends use, and the search index
+# notices the threads are new and indexes them again when the server starts
+BACKENDS = ("files", "sqlite")
+
+if len(sys.argv) not in (3, 4) or sys.argv[1] not in BACKENDS or sys.argv[2] not in BACKENDS or sys.argv[1] == sys.argv[2]:
+    print("\n===== Usage: python3 migrate.py files|sqlite sqlite|files [DATABASE] ======\n")
+    exit(0)
+databaseFile = sys.argv[3] if len(sys.argv) == 4 else "forum.db"
+# lock on the thread files' write-ahead logs, held until the migration ends
+walLock = None
+
+# (credential store, thread store) of a backend
+def open_backend(name):
+    if name == "sqlite":
+        database = Database(databaseFile)
+        return SQLiteCredentialStore(database), SQLiteThreadStore(database)
+    # the thread files must not be in use by a running server
+    global walLock
+    walLock = lock_wal(".")
+    if walLock is None:
+        print("\n===== A server is running in this directory, stop it first ======\n")
+        exit(1)
+    # writes a crash left in the write-ahead log belong in the thread files first
+    recovered = replay_wal(".")
+    if recovered:
+        print(f"Recovered {recovered} thread writes from the write-ahead log")
+    return CredentialStore("credentials.txt", flush_interval=60), ThreadStore(".")
+
+def migrate(source, target):
+    sourceCredentials, sourceThreads = open_backend(source)
+    targetCredentials, targetThreads = open_backend(target)
+
+    users = 0
+    for username, password in sourceCredentials.items():
+        if targetCredentials.register(username, password):
+            users += 1
+    targetCredentials.flush()
+
+    threads = 0
+    for title in sorted(sourceThreads.catalog):
+        if targetThreads.exists(title):
+            print(f"Skipped thread '{title}', the {target} backend already has it")
+            continue
+        meta = sourceThreads.meta(title)
+        targetThreads.restore(title, meta.creator, meta.created, meta.modified, sourceThreads.records(title))
+        threads += 1
+
+    sourceThreads.close()
+    targetThreads.close()
+    print(f"Copied {users} users and {threads} threads from {source} to {target}")
+
+migrate(sys.argv[1], sys.argv[2])
@@ -0,0 +1,591 @@
+import hashlib
+import itertools
+import queue
+import random
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from socket import timeout
+
+# optional codecs, used when their packages are installed
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# wire format helpers shared by the client and the server
+
+# replies longer than one datagram are sent as numbered parts. Each part starts with this byte and a
+# "{stream id} {part index} {part count}\n" header; plain text replies never start with it
+STREAM_MARKER = b"\x02"
+
+# largest datagram the server sends, small enough to avoid IP fragmentation on ordinary links
+MAX_DATAGRAM_SIZE = 1400
+
+# room kept for the part header in each datagram of a stream
+STREAM_HEADER_SIZE = 32
+
+# split a reply into the datagrams that carry it: the reply itself if it fits, numbered parts otherwise
+def split_stream(payload, stream_id, max_size=MAX_DATAGRAM_SIZE):
+    if len(payload) <= max_size:
+        return [payload]
+    chunk_size = max_size - STREAM_HEADER_SIZE
+    chunks = [payload[i:i + chunk_size] for i in range(0, len(payload), chunk_size)]
+    return [STREAM_MARKER + f"{stream_id} {index} {len(chunks)}\n".encode() + chunk
+            for index, chunk in enumerate(chunks)]
+
+# (stream id, part index, part count, chunk) of a stream part, None for an ordinary reply
+def parse_stream_part(data):
+    if not data.startswith(STREAM_MARKER):
+        return None
+    header, chunk = data[1:].split(b"\n", 1)
+    stream_id, index, total = (int(value) for value in header.split())
+    return stream_id, index, total, chunk
+
+
+# reliable requests: the client wraps each request as REQUEST_MARKER "{request id}\n" payload and
+# the server wraps every datagram it sends back as REPLY_MARKER "{request id} {seq}\n" payload.
+# A client that hears nothing resends the request with exponential backoff; the server keeps the
+# replies of recent requests and answers a resent request from them instead of running it again.
+# ACK_MARKER "{request id}\n" tells the client a resent request is still being worked on.
+REQUEST_MARKER = b"\x01"
+REPLY_MARKER = b"\x04"
+ACK_MARKER = b"\x06"
+
+def encode_request(request_id, payload):
+    return REQUEST_MARKER + f"{request_id}\n".encode() + payload
+
+# (request id, payload) of a wrapped request, None for a plain text request from an old client;
+# raises ValueError for a wrapped request without a numeric id line
+def parse_request(data):
+    if not data.startswith(REQUEST_MARKER):
+        return None
+    header, newline, payload = data[1:].partition(b"\n")
+    if not newline or not header.isdigit():
+        raise ValueError("malformed request header")
+    return int(header), payload
+
+def encode_reply(request_id, seq, payload):
+    return REPLY_MARKER + f"{request_id} {seq}\n".encode() + payload
+
+def encode_ack(request_id):
+    return ACK_MARKER + f"{request_id}\n".encode()
+
+# (request id, seq, payload) of a reply, (request id, None, b"") of an ACK, None for anything else
+def parse_reply(data):
+    if data.startswith(ACK_MARKER):
+        return int(data[1:].strip()), None, b""
+    if not data.startswith(REPLY_MARKER):
+        return None
+    header, payload = data[1:].split(b"\n", 1)
+    request_id, seq = header.split()
+    return int(request_id), int(seq), payload
+
+# server side: the datagrams already sent for recent requests, bounded by entry count and bytes
+class ResponseCache:
+    def __init__(self, max_entries=4096, max_bytes=16 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()    # (client address, request id) -> list of sent datagrams
+        self.size = 0
+        self.lock = threading.Lock()
+
+    # returns (datagrams, True) for a new request, or (datagrams sent so far, False) for a resent one
+    def begin(self, client_addr, request_id):
+        key = (client_addr, request_id)
+        with self.lock:
+            datagrams = self.entries.get(key)
+            if datagrams is not None:
+                return list(datagrams), False
+            datagrams = []
+            self.entries[key] = datagrams
+            self.evict()
+            return datagrams, True
+
+    def add(self, client_addr, request_id, datagram):
+        with self.lock:
+            datagrams = self.entries.get((client_addr, request_id))
+            if datagrams is not None:
+                datagrams.append(datagram)
+                self.size += len(datagram)
+                self.evict()
+
+    # drop a request whose reply must not be replayed (e.g. "server busy"), so a resend runs it again
+    def forget(self, client_addr, request_id):
+        with self.lock:
+            datagrams = self.entries.pop((client_addr, request_id), None)
+            if datagrams:
+                self.size -= sum(len(datagram) for datagram in datagrams)
+
+    def evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+            _, datagrams = self.entries.popitem(last=False)
+            self.size -= sum(len(datagram) for datagram in datagrams)
+
+# server side: stands in for the UDP socket while one wrapped request is handled, numbering and
+# recording every reply datagram so that it can be replayed if the request is resent
+class ReplyChannel:
+    def __init__(self, sock, cache, client_addr, request_id):
+        self.sock = sock
+        self.cache = cache
+        self.client_addr = client_addr
+        self.request_id = request_id
+        self.seq = itertools.count()
+
+    def sendto(self, data, address):
+        datagram = encode_reply(self.request_id, next(self.seq), data)
+        self.cache.add(self.client_addr, self.request_id, datagram)
+        return self.sock.sendto(datagram, address)
+
+# client side: wraps the UDP socket with the same sendto/recvfrom calls. recvfrom returns the next
+# reply to the last request sent, resending that request with exponential backoff while nothing
+# arrives, and drops duplicate or stale replies
+class ReliableSocket:
+    def __init__(self, sock, initial_timeout=0.5, max_timeout=8.0, max_retries=6):
+        self.sock = sock
+        self.initial_timeout = initial_timeout
+        self.max_timeout = max_timeout
+        self.max_retries = max_retries
+        self.next_id = random.randint(1, 1 << 30)
+        self.request = None         # (request id, datagram, address) of the last request
+        self.seen = set()           # seqs of the replies to it already returned
+        self.timeout = None         # like socket.settimeout: None waits as long as retries allow
+        self.blocking = True
+
+    def sendto(self, data, address):
+        request_id = self.next_id
+        self.next_id += 1
+        datagram = encode_request(request_id, data)
+        self.request = (request_id, datagram, address)
+        self.seen = set()
+        return self.sock.sendto(datagram, address)
+
+    def settimeout(self, value):
+        self.timeout = value
+
+    def setblocking(self, flag):
+        self.blocking = flag
+        self.sock.setblocking(flag)
+
+    def setsockopt(self, *args):
+        self.sock.setsockopt(*args)
+
+    def close(self):
+        self.sock.close()
+
+    def recvfrom(self, bufsize):
+        # non-blocking reads are only used to drain the socket, hand back whatever is there
+        if not self.blocking:
+            return self.sock.recvfrom(bufsize)
+
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        rto = self.initial_timeout
+        retries = 0
+        while True:
+            wait = rto if deadline is None else min(rto, deadline - time.time())
+            if wait <= 0:
+                raise timeout("timed out")
+            self.sock.settimeout(wait)
+            try:
+                data, address = self.sock.recvfrom(max(bufsize, 65535))
+            except timeout:
+                if deadline is not None and time.time() >= deadline:
+                    raise
+                retries += 1
+                if self.request is None or retries > self.max_retries:
+                    raise timeout("no reply from server")
+                self.sock.sendto(self.request[1], self.request[2])
+                rto = min(rto * 2, self.max_timeout)
+                continue
+            finally:
+                self.sock.settimeout(None)
+
+            reply = parse_reply(data)
+            if reply is None:
+                return data, address
+            request_id, seq, payload = reply
+            if self.request is None or request_id != self.request[0]:
+                continue
+            if seq is None:
+                # the server has the request and is still working on it
+                retries = 0
+                continue
+            if seq in self.seen:
+                continue
+            self.seen.add(seq)
+            return payload, address
+
+
+# optional "key=value" fields after a command's arguments, e.g. "UPD thread file size=10 sha256=ab..."
+def parse_options(fields):
+    options = {}
+    for field in fields:
+        key, sep, value = field.partition("=")
+        if not sep or not key:
+            raise ValueError(f"bad option '{field}'")
+        options[key] = value
+    return options
+
+def format_options(options):
+    return " ".join(f"{key}={value}" for key, value in options.items())
+
+# hex SHA-256 of a file, used to check that a (resumed) transfer arrived intact
+def file_sha256(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    with open(path, "rb") as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+# split [start, end) into n contiguous byte ranges, one per stream of a multi-stream transfer
+def split_ranges(start, end, n):
+    return [(start + (end - start) * i // n, start + (end - start) * (i + 1) // n) for i in range(n)]
+
+# end of the data received without a gap after start, given {range start: (range end, bytes received)}
+# for the ranges of a multi-stream transfer; anything after it has to be sent again
+def received_prefix(start, ranges):
+    end = start
+    for range_start in sorted(ranges):
+        range_end, received = ranges[range_start]
+        if range_start != end:
+            break
+        end = range_start + received
+        if end < range_end:
+            break
+    return end
+
+
+# compression, agreed on once per session with "HELLO compress={codecs}": the server picks the first
+# codec of its own list that the client offered. zlib is always available
+CODECS = [codec for codec, module in (("zstd", zstandard), ("lz4", lz4), ("zlib", zlib)) if module is not None]
+
+# a reply payload that starts with this byte is compressed with the session's codec
+COMPRESSED_MARKER = b"\x03"
+
+# replies shorter than this are not worth compressing
+COMPRESS_MIN_SIZE = 256
+
+def choose_codec(offered):
+    return next((codec for codec in CODECS if codec in offered), None)
+
+def compress(codec, data):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor().compress(data)
+    if codec == "lz4":
+        return lz4.frame.compress(data)
+    return zlib.compress(data)
+
+def decompress(codec, data):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "lz4":
+        return lz4.frame.decompress(data)
+    return zlib.decompress(data)
+
+# incremental compression of a TCP file transfer
+class Compressor:
+    def __init__(self, codec):
+        self.header = b""
+        if codec == "zstd":
+            self.obj = zstandard.ZstdCompressor().compressobj()
+        elif codec == "lz4":
+            self.obj = lz4.frame.LZ4FrameCompressor()
+            self.header = self.obj.begin()
+        else:
+            self.obj = zlib.compressobj()
+
+    def compress(self, data):
+        out = self.header + self.obj.compress(data)
+        self.header = b""
+        return out
+
+    def flush(self):
+        return self.header + self.obj.flush()
+
+# max_length bounds what one call may return, so a small compressed stream cannot expand into a huge
+# buffer: a call that returns max_length bytes may have left output (and input) behind, and the
+# stream cannot be read any further after that. zstd's decompressobj has no such bound, so zstd
+# output goes through a stream writer into an OutputLimit that refuses to collect more
+class Decompressor:
+    def __init__(self, codec):
+        self.codec = codec
+        self.output = None
+        if codec == "zstd":
+            self.output = OutputLimit()
+            self.obj = zstandard.ZstdDecompressor().stream_writer(self.output)
+        elif codec == "lz4":
+            self.obj = lz4.frame.LZ4FrameDecompressor()
+        else:
+            self.obj = zlib.decompressobj()
+
+    def decompress(self, data, max_length=None):
+        if self.output is not None:
+            self.output.start(max_length)
+            try:
+                self.obj.write(data)
+            except OutputLimitReached:
+                pass
+            return self.output.take()
+        if self.codec == "lz4":
+            return self.obj.decompress(data, -1 if max_length is None else max_length)
+        return self.obj.decompress(data, max_length or 0)
+
+    def flush(self):
+        flush = getattr(self.obj, "flush", None)
+        return flush() if flush and self.output is None else b""
+
+class OutputLimitReached(Exception):
+    pass
+
+# file-like sink of a zstd stream writer, holding at most limit bytes of output per call
+class OutputLimit:
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.limit = None
+
+    def start(self, limit):
+        self.chunks, self.size, self.limit = [], 0, limit
+
+    def write(self, data):
+        if self.limit is not None and self.size + len(data) >= self.limit:
+            self.chunks.append(bytes(data[:self.limit - self.size]))
+            self.size = self.limit
+            raise OutputLimitReached()
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+# leading bytes of file formats that are compressed already (archives, images, audio, video)
+COMPRESSED_MAGIC = (
+    b"\x1f\x8b",               # gzip
+    b"PK\x03\x04",             # zip, docx, jar, ...
+    b"\x28\xb5\x2f\xfd",       # zstd
+    b"\x04\x22\x4d\x18",       # lz4
+    b"BZh",                    # bzip2
+    b"\xfd7zXZ\x00",           # xz
+    b"7z\xbc\xaf\x27\x1c",       # 7z
+    b"Rar!",                   # rar
+    b"\x89PNG",                # png
+    b"\xff\xd8\xff",            # jpeg
+    b"GIF8",                   # gif
+    b"OggS",                   # ogg
+    b"ID3",                    # mp3
+    b"fLaC",                   # flac
+)
+
+# how much of a file of no known format is compressed to see whether compressing it pays off
+COMPRESS_SAMPLE_SIZE = 64 << 10
+
+# whether a file would not get any smaller by compressing it (again)
+def looks_compressed(path):
+    with open(path, "rb") as f:
+        head = f.read(COMPRESS_SAMPLE_SIZE)
+    if head.startswith(COMPRESSED_MAGIC) or head[4:8] == b"ftyp":   # ftyp: mp4, mov, heic
+        return True
+    # data that hardly shrinks (encrypted, random, unknown media formats) is sent as it is
+    return len(zlib.compress(head, 1)) > len(head) * 0.9
+
+
+# commands as text are split into their parts at spaces, except that MSG and EDT end in free text
+# which is kept as a single part, and BAT carries one command per line
+TEXT_SPLITS = {"MSG": 2, "EDT": 3}
+
+def split_command(message):
+    name = message.split(None, 1)[0] if message.strip() else ""
+    if name == "BAT":
+        return message.split("\n")
+    if name in TEXT_SPLITS:
+        return message.split(" ", TEXT_SPLITS[name])
+    return message.split()
+
+# binary frames, used instead of text commands once HELLO has agreed on "framing=binary":
+# FRAME_MARKER, opcode, status, request id and field count, then each field as a 4-byte length
+# and its bytes. A request's fields are its parts after the command name, a reply has one field
+# (the reply text or a stream part) and a status telling success from failure
+FRAME_MARKER = b"\x05"
+FRAME_HEADER = struct.Struct("!BBIH")
+FIELD_LENGTH = struct.Struct("!I")
+
+OPCODES = {"CRT": 1, "MSG": 2, "DLT": 3, "EDT": 4, "LST": 5, "RDT": 6, "UPD": 7, "DWN": 8,
+           "RMV": 9, "XIT": 10, "HELLO": 11, "BAT": 12, "SUB": 13, "UNSUB": 14, "SRCH": 15}
+OPCODE_NAMES = {opcode: name for name, opcode in OPCODES.items()}
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+def encode_frame(opcode, request_id, fields, status=STATUS_OK):
+    out = [FRAME_MARKER, FRAME_HEADER.pack(opcode, status, request_id, len(fields))]
+    for field in fields:
+        out.append(FIELD_LENGTH.pack(len(field)))
+        out.append(field)
+    return b"".join(out)
+
+# (opcode, status, request id, fields) of a frame, None for anything else; ValueError if truncated
+def parse_frame(data):
+    if not data.startswith(FRAME_MARKER):
+        return None
+    try:
+        opcode, status, request_id, count = FRAME_HEADER.unpack_from(data, 1)
+        pos = 1 + FRAME_HEADER.size
+        fields = []
+        for _ in range(count):
+            (length,) = FIELD_LENGTH.unpack_from(data, pos)
+            pos += FIELD_LENGTH.size
+            if pos + length > len(data):
+                raise ValueError("truncated frame")
+            fields.append(data[pos:pos + length])
+            pos += length
+    except struct.error:
+        raise ValueError("truncated frame")
+    return opcode, status, request_id, fields
+
+# server side: stands in for the reply socket of a framed request, wrapping every reply into a
+# frame for the same opcode and request id; replies starting with "Error" get STATUS_ERROR
+class FrameChannel:
+    def __init__(self, sock, opcode, request_id):
+        self.sock = sock
+        self.opcode = opcode
+        self.request_id = request_id
+
+    def sendto(self, data, address):
+        status = STATUS_ERROR if data.startswith(b"Error") else STATUS_OK
+        return self.sock.sendto(encode_frame(self.opcode, self.request_id, [data], status), address)
+
+# client side: once binary is set, text commands given to sendto are sent as frames, and recvfrom
+# unwraps framed replies, keeping the status of the last one in status
+class FramedSocket:
+    def __init__(self, sock):
+        self.sock = sock
+        self.binary = False
+        self.next_id = 1
+        self.status = STATUS_OK
+
+    def sendto(self, data, address):
+        if self.binary:
+            parts = split_command(data.decode())
+            if parts and parts[0] in OPCODES:
+                fields = [part.encode() for part in parts[1:]]
+                data = encode_frame(OPCODES[parts[0]], self.next_id, fields)
+                self.next_id += 1
+        return self.sock.sendto(data, address)
+
+    def recvfrom(self, bufsize):
+        data, address = self.sock.recvfrom(bufsize)
+        frame = parse_frame(data)
+        if frame is None:
+            self.status = STATUS_ERROR if data.startswith(b"Error") else STATUS_OK
+            return data, address
+        _, self.status, _, fields = frame
+        return (fields[0] if fields else b""), address
+
+    def settimeout(self, value):
+        self.sock.settimeout(value)
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def setsockopt(self, *args):
+        self.sock.setsockopt(*args)
+
+    def close(self):
+        self.sock.close()
+
+
+# notifications the server pushes to clients subscribed to a thread (SUB), outside any request:
+# NOTIFY_MARKER "{origin} {seq}\n" followed by one event per line. origin is the server process
+# that sent it, and seq counts the datagrams that process sent to each client, so a client can tell
+# when some were lost by looking at each origin's numbers on their own
+NOTIFY_MARKER = b"\x07"
+
+# a datagram of just this byte tells the server a client is still there, and gets no reply: a client
+# waiting for notifications sends it now and then, so its session is not ended for being idle
+KEEPALIVE_MARKER = b"\x08"
+
+# pack event lines into as few notification datagrams as possible; seqs supplies the numbers
+def encode_notifications(lines, seqs, origin=0, max_size=MAX_DATAGRAM_SIZE):
+    datagrams = []
+    batch = []
+    size = 0
+    for line in lines:
+        line = line.encode()[:max_size - STREAM_HEADER_SIZE]
+        if batch and size + len(line) + 1 > max_size - STREAM_HEADER_SIZE:
+            datagrams.append(NOTIFY_MARKER + f"{origin} {next(seqs)}\n".encode() + b"\n".join(batch))
+            batch = []
+            size = 0
+        batch.append(line)
+        size += len(line) + 1
+    if batch:
+        datagrams.append(NOTIFY_MARKER + f"{origin} {next(seqs)}\n".encode() + b"\n".join(batch))
+    return datagrams
+
+# (origin, seq, event lines) of a notification datagram; a header without an origin is from a
+# server that runs a single process
+def parse_notification(data):
+    header, body = data[1:].split(b"\n", 1)
+    fields = header.split()
+    origin = int(fields[0]) if len(fields) == 2 else 0
+    return origin, int(fields[-1]), body.decode(errors="replace").split("\n")
+
+# client side: reads the UDP socket on a background thread, so notifications are shown as soon as
+# they arrive (even while the user is typing); everything else is queued for recvfrom
+class PushSocket:
+    def __init__(self, sock, on_notification):
+        self.sock = sock
+        self.on_notification = on_notification
+        self.incoming = queue.Queue()
+        self.timeout = None
+        self.blocking = True
+        threading.Thread(target=self.reader, daemon=True).start()
+
+    def reader(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(65535)
+            except OSError:
+                return
+            if data.startswith(NOTIFY_MARKER):
+                self.on_notification(*parse_notification(data))
+            else:
+                self.incoming.put((data, address))
+
+    def sendto(self, data, address):
+        return self.sock.sendto(data, address)
+
+    def recvfrom(self, bufsize):
+        try:
+            if not self.blocking:
+                return self.incoming.get_nowait()
+            return self.incoming.get(timeout=self.timeout)
+        except queue.Empty:
+            if not self.blocking:
+                raise BlockingIOError("no data")
+            raise timeout("timed out")
+
+    def settimeout(self, value):
+        self.timeout = value
+
+    def setblocking(self, flag):
+        self.blocking = flag
+
+    def setsockopt(self, *args):
+        self.sock.setsockopt(*args)
+
+    def close(self):
+        self.sock.close()
@@ -1,8 +1,19 @@
 from socket import *
 import threading
-import random
 import os
 import time
+import queue
+import signal
+import itertools
+import secrets
+import contextlib
+import collections
+import heapq
+
+import protocol
+from cluster import Cluster
+from storage import AttachmentStore, CredentialStore, SearchIndex, ThreadStore, WriteAheadLog, is_valid_name, is_valid_title, is_valid_username, lock_wal, replay_wal
+from sqlite_storage import Database, SQLiteCredentialStore, SQLiteThreadStore
 
 serverHost = "127.0.0.1"
 
@@ -13,73 +24,648 @@ if len(sys.argv) != 2:
 udpPort = int(sys.argv[1])
 serverAddress = (serverHost, udpPort)
 
+# worker processes sharing the UDP port, so the server can use several cores: each thread title is
+# owned by one of them, which runs every command naming it; see cluster.py. Sessions and the thread
+# catalog are copied to all of them
+SERVER_PROCESSES = int(os.environ.get("FORUM_PROCESSES", "1"))
+cluster = Cluster(SERVER_PROCESSES)
+
 CREDENTIALS_FILE = "credentials.txt"
-activeUsers = {} 
 
-# read credentials from file
-def read_credentials():
-    if not os.path.exists(CREDENTIALS_FILE):
-        return {}
-    with open(CREDENTIALS_FILE, 'r') as f:
-        lines = f.readlines()
-    return dict(line.strip().split(' ') for line in lines if line.strip())
+# logged in clients, indexed both ways (address -> user and user -> address) together with the time
+# each client was last heard from, so clients that vanish without XIT can be logged out
+class SessionRegistry:
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.users = {}         # client address -> username
+        self.addresses = {}     # username -> client address
+        self.last_seen = {}     # client address -> time of the last datagram
+        self.codecs = {}        # client address -> compression codec agreed with HELLO
+
+    def __contains__(self, client_addr):
+        return client_addr in self.users
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, client_addr, default=None):
+        return self.users.get(client_addr, default)
+
+    def is_online(self, username):
+        return username in self.addresses
+
+    def add(self, client_addr, username):
+        with self.lock:
+            # the same address logging in again replaces its previous session
+            old_username = self.users.get(client_addr)
+            if old_username is not None:
+                self.addresses.pop(old_username, None)
+            self.codecs.pop(client_addr, None)
+            self.users[client_addr] = username
+            self.addresses[username] = client_addr
+            self.last_seen[client_addr] = time.time()
+
+    # a session held by another server process: known here so its commands can be run, but it is
+    # never expired here, the process holding it tells us when it ends
+    def add_remote(self, client_addr, username, codec):
+        with self.lock:
+            old_username = self.users.get(client_addr)
+            if old_username is not None:
+                self.addresses.pop(old_username, None)
+            self.users[client_addr] = username
+            self.addresses[username] = client_addr
+            self.codecs[client_addr] = codec
+
+    def codec(self, client_addr):
+        return self.codecs.get(client_addr)
+
+    def set_codec(self, client_addr, codec):
+        with self.lock:
+            if client_addr in self.users:
+                self.codecs[client_addr] = codec
+
+    def touch(self, client_addr):
+        if client_addr in self.users:
+            self.last_seen[client_addr] = time.time()
+
+    def pop(self, client_addr, default=None):
+        with self.lock:
+            username = self.users.pop(client_addr, None)
+            if username is None:
+                return default
+            self.addresses.pop(username, None)
+            self.last_seen.pop(client_addr, None)
+            self.codecs.pop(client_addr, None)
+            return username
+
+    # log out every client that has been silent for longer than the idle timeout
+    def expire_idle(self):
+        deadline = time.time() - self.idle_timeout
+        expired = []
+        with self.lock:
+            for client_addr, seen in list(self.last_seen.items()):
+                if seen < deadline:
+                    username = self.users.pop(client_addr)
+                    self.addresses.pop(username, None)
+                    del self.last_seen[client_addr]
+                    self.codecs.pop(client_addr, None)
+                    expired.append((client_addr, username))
+        return expired
+
+# seconds without any datagram after which a logged in client is considered gone
+SESSION_IDLE_TIMEOUT = float(os.environ.get("FORUM_SESSION_TIMEOUT", "1800"))
+activeUsers = SessionRegistry(SESSION_IDLE_TIMEOUT)
+
+# threads and credentials are kept in files in the working directory ("files"), or in one SQLite
+# database, FORUM_DATABASE ("sqlite"); migrate.py copies a forum from one to the other
+STORAGE_BACKEND = os.environ.get("FORUM_STORAGE", "files")
+DATABASE_FILE = os.environ.get("FORUM_DATABASE", "forum.db")
+if STORAGE_BACKEND not in ("files", "sqlite"):
+    print(f"\n===== Unknown FORUM_STORAGE {STORAGE_BACKEND}, use files or sqlite ======\n")
+    exit(1)
+database = Database(DATABASE_FILE) if STORAGE_BACKEND == "sqlite" else None
+
+# credentials are loaded once into memory, new registrations are written to the file (and fsynced)
+# at most this often, in seconds; 0 writes every registration immediately
+CREDENTIALS_FLUSH_INTERVAL = float(os.environ.get("FORUM_CREDENTIALS_FLUSH", "1.0"))
+if database:
+    credentialStore = SQLiteCredentialStore(database)
+else:
+    credentialStore = CredentialStore(CREDENTIALS_FILE, CREDENTIALS_FLUSH_INTERVAL, shared=cluster.size > 1)
+
+# dispatcher settings: number of worker threads running commands, and how many commands may
+# wait for a free worker before new ones are rejected with a "server busy" reply
+WORKER_COUNT = int(os.environ.get("FORUM_WORKERS", "8"))
+MAX_PENDING_COMMANDS = int(os.environ.get("FORUM_QUEUE_DEPTH", "256"))
+
+command_queue = queue.Queue(maxsize=MAX_PENDING_COMMANDS)
+
+# thread files are append-only logs indexed in memory; a thread is compacted (rewritten without
+# stale lines) once it holds at least this many, checked every THREAD_COMPACTION_INTERVAL seconds.
+# Changed per-thread counters are saved to their "{thread}.meta" sidecar every THREAD_METADATA_INTERVAL.
+THREAD_COMPACT_MIN_GARBAGE = int(os.environ.get("FORUM_COMPACT_MIN_GARBAGE", "1000"))
+THREAD_COMPACTION_INTERVAL = 30.0
+THREAD_METADATA_INTERVAL = 1.0
+
+# threads are loaded on first use and kept in memory, with their files open, within these budgets:
+# threads whose counters are in memory, their lines indexed in memory, and open thread files. The least
+# recently used threads are dropped beyond them (their counters saved first) and loaded again when needed
+THREAD_CACHE_THREADS = int(os.environ.get("FORUM_CACHED_THREADS", "10000"))
+THREAD_CACHE_LINES = int(os.environ.get("FORUM_CACHED_LINES", "500000"))
+THREAD_OPEN_FILES = int(os.environ.get("FORUM_OPEN_FILES", "256"))
+
+# every message's words are indexed for SRCH as it is posted, edited or deleted; the index is saved
+# to "search.index" ("search-{process}.index" for each of several processes, which index their own
+# threads) every SEARCH_INDEX_SAVE_INTERVAL seconds and threads changed since are indexed again on startup
+SEARCH_INDEX_SAVE_INTERVAL = 10.0
+SEARCH_DEFAULT_LIMIT = 20
+SEARCH_MAX_LIMIT = 100
+searchIndex = SearchIndex()
+
+# every thread file write is logged first to "wal.log" ("wal-{process}.log" for each of several
+# processes), and the log is fsynced in groups: a reply to a change waits for the group commit, which
+# writes every change that arrived while the previous fsync ran with one fsync; on slow disks waiting
+# WAL_GROUP_WINDOW seconds before each fsync lets more changes join a group. Thread files are
+# fsynced at checkpoints every WAL_CHECKPOINT_INTERVAL seconds (and before a compaction), which empty
+# the log. Logs left by a crash are replayed into the thread files here, before anything reads them.
+# The SQLite backend has its own write-ahead log, and commits changes in groups the same way
+WAL_GROUP_WINDOW = float(os.environ.get("FORUM_WAL_WINDOW", "0"))
+WAL_CHECKPOINT_INTERVAL = 60.0
+if database:
+    writeAheadLog = None
+    threadStore = SQLiteThreadStore(database, THREAD_COMPACT_MIN_GARBAGE, searchIndex)
+else:
+    # held until the server exits; the logs belong to a server still running here otherwise
+    walLock = lock_wal(".")
+    if walLock is None:
+        print("\n===== Another server is running in this directory, stop it first ======\n")
+        exit(1)
+    recovered = replay_wal(".")
+    if recovered:
+        print(f"Recovered {recovered} thread writes from the write-ahead log")
+    writeAheadLog = WriteAheadLog(WAL_GROUP_WINDOW)
+    threadStore = ThreadStore(".", THREAD_COMPACT_MIN_GARBAGE, searchIndex, writeAheadLog,
+                              THREAD_CACHE_THREADS, THREAD_CACHE_LINES, THREAD_OPEN_FILES)
+
+# uploaded files are stored once per content under "attachments/", threads only refer to them.
+# Uploads saved next to the thread files by older versions are moved in on startup
+attachmentStore = AttachmentStore("attachments", shared=cluster.size > 1)
+
+# login sessions waiting for a username or password, keyed by client address, and how long
+# (in seconds) an abandoned half-finished login is kept before it expires
+LOGIN_TIMEOUT = float(os.environ.get("FORUM_LOGIN_TIMEOUT", "60"))
+AWAITING_USERNAME = "awaiting-username"
+AWAITING_PASSWORD = "awaiting-password"
+AWAITING_NEW_PASSWORD = "awaiting-new-password"
+pendingLogins = {}
+
+# how often (in seconds) the receive loop runs its periodic maintenance
+HOUSEKEEPING_INTERVAL = 1.0
+
+# every UPD/DWN file transfer goes through one long-lived TCP listener (by default on the same port
+# number as the UDP server). The PORT reply carries a one-time token that the client sends first on
+# its data connection, which matches the connection to its pending transfer
+# (with several processes, each listens on its own port: DATA_PORT plus its index)
+DATA_PORT = int(os.environ.get("FORUM_DATA_PORT", str(udpPort)))
+TRANSFER_TIMEOUT = float(os.environ.get("FORUM_TRANSFER_TIMEOUT", "60"))
+TRANSFER_TOKEN_LENGTH = 32
+TRANSFER_BUFFER_SIZE = 1 << 20
+# a client may ask (streams=N in UPD/DWN) for a large file to be split over several TCP connections
+# running side by side; the server allows at most this many, each carrying at least TRANSFER_MIN_CHUNK
+TRANSFER_STREAMS = int(os.environ.get("FORUM_TRANSFER_STREAMS", "4"))
+TRANSFER_MIN_CHUNK = 4 << 20
+transfer_buffers = []
+pendingTransfers = {}
+pendingTransfersLock = threading.Lock()
+
+# "{thread}-{filename}" names and partial files currently being uploaded, so two UPDs cannot
+# write the same file
+uploads_in_progress = set()
+uploadsLock = threading.Lock()
+
+# replies of recent reliable requests, replayed when a client resends a request instead of running
+# it twice (which matters for MSG, DLT, ...); bounded by number of requests and total bytes
+RESPONSE_CACHE_ENTRIES = int(os.environ.get("FORUM_RESPONSE_CACHE", "4096"))
+responseCache = protocol.ResponseCache(RESPONSE_CACHE_ENTRIES)
+
+# clients subscribed to threads (SUB) get the changes to them pushed as notifications. Events are
+# queued per client, at most NOTIFY_QUEUE_LIMIT of them (the oldest are dropped beyond that), and a
+# notifier thread sends whatever has queued up every NOTIFY_BATCH_INTERVAL seconds, packing the
+# events for each client into as few datagrams as possible
+class Notifier:
+    def __init__(self, queue_limit, interval):
+        self.queue_limit = queue_limit
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.subscribers = {}   # thread title -> addresses of the clients subscribed to it
+        self.topics = {}        # client address -> titles of the threads it is subscribed to
+        self.outbox = {}        # client address -> deque of events not sent yet
+        self.dropped = {}       # client address -> events dropped from its full queue
+        self.seqs = {}          # client address -> numbers for its notification datagrams
+        self.origin = 0         # this process's index, sent with the numbers as they are counted per process
+        self.sock = None
+
+    def subscribe(self, client_addr, title):
+        with self.lock:
+            self.subscribers.setdefault(title, set()).add(client_addr)
+            self.topics.setdefault(client_addr, set()).add(title)
+
+    # returns False if the client was not subscribed to the thread
+    def unsubscribe(self, client_addr, title):
+        with self.lock:
+            if title not in self.topics.get(client_addr, ()):
+                return False
+            self.topics[client_addr].discard(title)
+            self.subscribers[title].discard(client_addr)
+            if not self.subscribers[title]:
+                del self.subscribers[title]
+            return True
+
+    # drop a client whose session ended without it logging out (it timed out); if it was subscribed
+    # to threads it is told, as otherwise it would wait for notifications that never come
+    def end_session(self, client_addr):
+        with self.lock:
+            titles = sorted(self.topics.get(client_addr, ()))
+            seqs = self.seqs.setdefault(client_addr, itertools.count(1))
+        self.forget(client_addr)
+        if not titles or self.sock is None:
+            return
+        event = f"Session timed out, notifications for {', '.join(titles)} stopped. Log in and SUB again to resume"
+        try:
+            for datagram in protocol.encode_notifications([event], seqs, self.origin):
+                self.sock.sendto(datagram, client_addr)
+        except OSError as e:
+            print(f"===== Error sending notifications to {client_addr}: {e}")
+
+    # drop everything of a client that has logged out
+    def forget(self, client_addr):
+        with self.lock:
+            for title in self.topics.pop(client_addr, ()):
+                self.subscribers[title].discard(client_addr)
+                if not self.subscribers[title]:
+                    del self.subscribers[title]
+            self.outbox.pop(client_addr, None)
+            self.dropped.pop(client_addr, None)
+            self.seqs.pop(client_addr, None)
+
+    # queue an event for every subscriber of a thread except the client that caused it
+    def publish(self, title, event, exclude=None):
+        with self.lock:
+            for client_addr in self.subscribers.get(title, ()):
+                if client_addr == exclude:
+                    continue
+                events = self.outbox.setdefault(client_addr, collections.deque())
+                if len(events) >= self.queue_limit:
+                    events.popleft()
+                    self.dropped[client_addr] = self.dropped.get(client_addr, 0) + 1
+                events.append(event)
+        self.wakeup.set()
+
+    # a removed thread has no subscribers any more
+    def remove_thread(self, title):
+        with self.lock:
+            for client_addr in self.subscribers.pop(title, ()):
+                self.topics[client_addr].discard(title)
+
+    # notifier thread: wait for events, give more a moment to arrive, then send them all
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.interval)
+            self.wakeup.clear()
+            with self.lock:
+                outbox, self.outbox = self.outbox, {}
+                dropped, self.dropped = self.dropped, {}
+                seqs = [self.seqs.setdefault(client_addr, itertools.count(1)) for client_addr in outbox]
+            for (client_addr, events), client_seqs in zip(outbox.items(), seqs):
+                lines = list(events)
+                if client_addr in dropped:
+                    lines.insert(0, f"({dropped[client_addr]} older notifications were dropped)")
+                try:
+                    for datagram in protocol.encode_notifications(lines, client_seqs, self.origin):
+                        self.sock.sendto(datagram, client_addr)
+                except OSError as e:
+                    print(f"===== Error sending notifications to {client_addr}: {e}")
+
+NOTIFY_QUEUE_LIMIT = int(os.environ.get("FORUM_NOTIFY_QUEUE", "256"))
+NOTIFY_BATCH_INTERVAL = 0.05
+notifier = Notifier(NOTIFY_QUEUE_LIMIT, NOTIFY_BATCH_INTERVAL)
+
+# longest piece of a message text quoted in a notification
+NOTIFY_TEXT_LIMIT = 200
+
+# replies to plain RDTs (a whole thread or a page of it), kept ready to send, so reading a popular
+# thread again is a dict lookup. Entries are keyed by thread, page and the codec the reply was
+# compressed with, hold at most RDT_CACHE_BYTES in total (the least recently used go first), and
+# every change to a thread drops the entries of that thread. Reads and changes of a thread both
+# hold its lock, so a reply read before a change cannot be cached after it
+RDT_CACHE_BYTES = int(os.environ.get("FORUM_RDT_CACHE", str(8 << 20)))
+RDT_CACHE_REPORT_INTERVAL = 60.0
+
+class ReadCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()    # (title, offset, count, codec) -> reply
+        self.titles = {}        # title -> keys of its entries
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    # a cache of 0 bytes is off: nothing is looked up, stored or counted
+    def get(self, key):
+        if not self.max_bytes:
+            return None
+        with self.lock:
+            reply = self.entries.get(key)
+            if reply is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return reply
+
+    def put(self, key, reply):
+        if not self.max_bytes or len(reply) > self.max_bytes:
+            return
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = reply
+            self.titles.setdefault(key[0], set()).add(key)
+            self.size += len(reply)
+            while self.size > self.max_bytes:
+                self.discard(next(iter(self.entries)))
+
+    def discard(self, key):
+        reply = self.entries.pop(key, None)
+        if reply is not None:
+            self.size -= len(reply)
+            keys = self.titles[key[0]]
+            keys.discard(key)
+            if not keys:
+                del self.titles[key[0]]
+
+    # a thread changed (or is gone): its cached replies are stale
+    def invalidate(self, title):
+        with self.lock:
+            for key in list(self.titles.get(title, ())):
+                self.discard(key)
+
+    # hits and misses since the last report, None if there were no lookups (always, when the cache is off)
+    def report(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+            self.hits = self.misses = 0
+            if not hits + misses:
+                return None
+            return (f"{hits} hits, {misses} misses ({100 * hits // (hits + misses)}% hits), "
+                    f"{len(self.entries)} replies, {self.size} bytes")
+
+readCache = ReadCache(RDT_CACHE_BYTES)
+
+# the one place every change to a thread is reported from, so subscribers hear about it and its
+# cached replies are dropped; callers hold the thread lock
+def thread_event(title, event, client_addr=None):
+    readCache.invalidate(title)
+    notifier.publish(title, event, exclude=client_addr)
+
+# commands a BAT request may carry, and how many of them at most
+BATCH_COMMANDS = ("CRT", "MSG", "DLT", "EDT", "RDT")
+MAX_BATCH_OPERATIONS = 100
+
+# ids for replies that are split over several datagrams, so the client can tell the streams apart
+stream_ids = itertools.count(1)
+
+# the codec replies to a client are compressed with, None inside a batch, whose reply is compressed once
+def reply_codec(udp_socket, client_addr):
+    if isinstance(udp_socket, ReplyCollector):
+        return None
+    return activeUsers.codec(client_addr)
+
+# a long reply compressed with the client's codec, if that makes it shorter
+def encode_response(payload, codec):
+    if codec and len(payload) >= protocol.COMPRESS_MIN_SIZE:
+        compressed = protocol.COMPRESSED_MARKER + protocol.compress(codec, payload)
+        if len(compressed) < len(payload):
+            return compressed
+    return payload
+
+# send a reply that may be longer than one datagram, splitting it into numbered parts if needed.
+# Long replies to a client that agreed on a codec are compressed first, unless encoded already
+def send_response(udp_socket, payload, client_addr, encoded=False):
+    # an operation of a batch: its reply is kept whole, the batch reply is split once at the end
+    if isinstance(udp_socket, ReplyCollector):
+        udp_socket.sendto(payload, client_addr)
+        return
+    if not encoded:
+        payload = encode_response(payload, activeUsers.codec(client_addr))
+    for datagram in protocol.split_stream(payload, next(stream_ids)):
+        udp_socket.sendto(datagram, client_addr)
+
+# one lock per thread file, so that commands on the same thread never interleave their reads and writes
+def get_thread_lock(threadTitle):
+    return threadStore.lock(threadTitle)
+
+# tell the other server processes about a session starting, changing codec or ending (expired: it
+# timed out, so the client is told about the subscriptions that end with it)
+def share_session(client_addr, expired=False):
+    cluster.broadcast("session", {"client": client_addr, "username": activeUsers.get(client_addr),
+                                  "codec": activeUsers.codec(client_addr), "expired": expired})
+
+def session_shared(peer, header, payload):
+    client_addr = tuple(header["client"])
+    # a new session from this address does not inherit the subscriptions of an earlier one
+    if header.get("expired"):
+        notifier.end_session(client_addr)
+    elif activeUsers.get(client_addr) != header["username"]:
+        notifier.forget(client_addr)
+    if header["username"] is None:
+        activeUsers.pop(client_addr)
+    else:
+        activeUsers.add_remote(client_addr, header["username"], header["codec"])
 
+# tell the other server processes a thread was created or removed, for their catalog (LST)
+def share_catalog(threadTitle):
+    cluster.broadcast("catalog", {"title": threadTitle, "exists": threadStore.exists(threadTitle)})
+
+def catalog_shared(peer, header, payload):
+    if header["exists"]:
+        threadStore.catalog.add(header["title"])
+    else:
+        threadStore.catalog.discard(header["title"])
+
+# (created, last change) of a thread for LST, from memory; another process changes the threads it
+# owns, their times are read from their sidecar (which does not load them here either)
+def thread_times(threadTitle):
+    if cluster.owns(threadTitle):
+        return threadStore.thread_times(threadTitle)
+    meta = threadStore.peek_meta(threadTitle)
+    return meta.created, meta.modified
+
+# start a login session for this client, the username and password arrive later as separate
+# datagrams and are handled by process_login_step from the main receive loop
 def process_login(client_addr, udp_sock):
     try:
+        # a new login from this address does not inherit the subscriptions of an earlier session
+        notifier.forget(client_addr)
+        pendingLogins[client_addr] = {
+            "state": AWAITING_USERNAME,
+            "username": None,
+            "expires": time.time() + LOGIN_TIMEOUT,
+        }
         udp_sock.sendto("user credentials request".encode(), client_addr)
 
-        # reveive username
-        username_data, _ = udp_sock.recvfrom(1024)
-        username = username_data.decode().strip()
+    except Exception as e:
+        print(f"===== login process error: {e}")
 
-        # check if username is already logged in, if so, send a message and return
-        #if client_addr in activeUsers: # only check client is not enough as it will not stop another user try to login with the same unsername
-        if username in activeUsers.values():
-            udp_sock.sendto("user already logged in".encode(), client_addr)
+# advance the login session of this client by one datagram (username or password)
+def process_login_step(message, client_addr, udp_sock):
+    try:
+        session = pendingLogins[client_addr]
+
+        if session["state"] == AWAITING_USERNAME:
+            # reveive username
+            username = message.strip()
+            # another process may have just registered it
+            credentialStore.check_for_changes()
+
+            # check if username is already logged in, if so, send a message and end the session
+            #if client_addr in activeUsers: # only check client is not enough as it will not stop another user try to login with the same unsername
+            if activeUsers.is_online(username):
+                del pendingLogins[client_addr]
+                udp_sock.sendto("user already logged in".encode(), client_addr)
+                return
+
+            session["username"] = username
+            session["expires"] = time.time() + LOGIN_TIMEOUT
+
+            # if username exists in the credentials file, ask for the password
+            if username in credentialStore:
+                session["state"] = AWAITING_PASSWORD
+                udp_sock.sendto("password request".encode(), client_addr)
+
+            # new user registration; the name goes into thread lines, so it must be a plain word
+            elif not is_valid_username(username):
+                del pendingLogins[client_addr]
+                udp_sock.sendto("invalid username".encode(), client_addr)
+            else:
+                session["state"] = AWAITING_NEW_PASSWORD
+                udp_sock.sendto("new user".encode(), client_addr)
             return
-        
-        credentials = read_credentials()
 
-        # if username exists in the credentials file, check password
-        if username in credentials:
-            udp_sock.sendto("password request".encode(), client_addr)
-            password_data, _ = udp_sock.recvfrom(1024)
-            password = password_data.decode().strip()
+        # the session is complete after the password, whatever the outcome
+        del pendingLogins[client_addr]
+        username = session["username"]
+        password = message.strip()
+
+        # another client may have logged in as this user while we were waiting for the password
+        if activeUsers.is_online(username):
+            udp_sock.sendto("user already logged in".encode(), client_addr)
+            return
 
-            if password == credentials[username]:
+        if session["state"] == AWAITING_PASSWORD:
+            if password == credentialStore.get(username):
                 # if password is correct, add user to activeUsers
-                activeUsers[client_addr] = username
+                activeUsers.add(client_addr, username)
+                share_session(client_addr)
                 udp_sock.sendto("login success".encode(), client_addr)
                 print(f"[login] User {username} logged in from {client_addr}")
             else:
                 # wrong password
                 udp_sock.sendto("login failed".encode(), client_addr)
 
-        # new user registration
         else:
-            udp_sock.sendto("new user".encode(), client_addr)
-            password_data, _ = udp_sock.recvfrom(1024)
-            password = password_data.decode().strip()
+            # someone else registered this username in the meantime
+            if not credentialStore.register(username, password):
+                udp_sock.sendto("login failed".encode(), client_addr)
+                return
 
-            with open(CREDENTIALS_FILE, 'a') as f:
-                f.write(f"{username} {password}\n")
-            activeUsers[client_addr] = username
+            activeUsers.add(client_addr, username)
+            share_session(client_addr)
             udp_sock.sendto("registered and logged in".encode(), client_addr)
             print(f"[register] New user {username} registered and logged in")
 
     except Exception as e:
+        pendingLogins.pop(client_addr, None)
         print(f"===== login process error: {e}")
 
-def process_CRT(message, udp_socket, client_addr):
+# drop login sessions whose client stopped answering
+def expire_pending_logins():
+    now = time.time()
+    for client_addr, session in list(pendingLogins.items()):
+        if session["expires"] <= now:
+            pendingLogins.pop(client_addr, None)
+            print(f"[login] Login session from {client_addr} timed out")
+
+# save changed thread counters to their sidecar files
+def save_thread_metadata():
+    for threadTitle in threadStore.dirty_metadata():
+        try:
+            with get_thread_lock(threadTitle):
+                threadStore.save_metadata(threadTitle)
+        except Exception as e:
+            print(f"===== Error saving metadata of '{threadTitle}': {e}")
+
+# rewrite threads that have collected many stale lines
+def compact_threads():
+    for threadTitle in threadStore.threads_needing_compaction():
+        try:
+            with get_thread_lock(threadTitle):
+                threadStore.compact(threadTitle)
+        except Exception as e:
+            print(f"===== Error compacting '{threadTitle}': {e}")
+
+# make the logged thread writes durable in the thread files and empty the write-ahead log
+def checkpoint_threads():
+    try:
+        writeAheadLog.checkpoint()
+    except Exception as e:
+        print(f"===== Error in write-ahead log checkpoint: {e}")
+
+def save_search_index():
     try:
-        parts = message.strip().split(" ")  # split command and threadtitle
-        if len(parts) != 2:
+        searchIndex.save()
+    except Exception as e:
+        print(f"===== Error saving search index: {e}")
+
+def report_read_cache():
+    report = readCache.report()
+    if report:
+        print(f"[rdt-cache] {report}")
+
+# thread file maintenance, in the background so the listener never waits on disk I/O for it
+def maintenance_worker():
+    next_compaction = time.time() + THREAD_COMPACTION_INTERVAL
+    next_index_save = time.time() + SEARCH_INDEX_SAVE_INTERVAL
+    next_checkpoint = time.time() + WAL_CHECKPOINT_INTERVAL
+    next_cache_report = time.time() + RDT_CACHE_REPORT_INTERVAL
+    while True:
+        time.sleep(THREAD_METADATA_INTERVAL)
+        save_thread_metadata()
+        if time.time() >= next_compaction:
+            compact_threads()
+            next_compaction = time.time() + THREAD_COMPACTION_INTERVAL
+        if time.time() >= next_index_save:
+            save_search_index()
+            next_index_save = time.time() + SEARCH_INDEX_SAVE_INTERVAL
+        if writeAheadLog and time.time() >= next_checkpoint:
+            checkpoint_threads()
+            next_checkpoint = time.time() + WAL_CHECKPOINT_INTERVAL
+        if time.time() >= next_cache_report:
+            report_read_cache()
+            next_cache_report = time.time() + RDT_CACHE_REPORT_INTERVAL
+
+# periodic maintenance, run from the receive loop between datagrams
+# log out clients that disappeared without sending XIT, so their username is free again
+def expire_idle_sessions():
+    for client_addr, username in activeUsers.expire_idle():
+        notifier.end_session(client_addr)
+        share_session(client_addr, expired=True)
+        print(f"[XIT] User '{username}' at {client_addr} timed out.")
+
+def run_housekeeping():
+    expire_pending_logins()
+    expire_idle_sessions()
+    expire_pending_transfers()
+    credentialStore.check_for_changes()
+    credentialStore.flush_if_due()
+
+def process_CRT(parts, udp_socket, client_addr):
+    try:
+        if len(parts) != 2:    # command and threadtitle
             # send error message to client
             udp_socket.sendto("Error: Invalid CRT format.".encode(), client_addr)
             return
 
         threadTitle = parts[1]
 
+        # the thread is stored as a file named after its title, so the title must be a plain file name
+        if not is_valid_title(threadTitle):
+            udp_socket.sendto("Error: Invalid thread title.".encode(), client_addr)
+            return
+
         #print("[debug] activeUsers:", activeUsers)
 
         # read the username from activeUsers
@@ -88,26 +674,29 @@ def process_CRT(message, udp_socket, client_addr):
             udp_socket.sendto("Error: User not recognized.".encode(), client_addr)
             return
 
-        # check if threadtitle already exists
-        if os.path.exists(threadTitle):
-            udp_socket.sendto(f"Thread {threadTitle} already exists.".encode(), client_addr)
-        
-        # create a new thread
-        else:
-            # The first line of the thread file should be the username of the creator
-            with open(threadTitle, "w") as f:
-                f.write(f"{username}\n")
-
-            udp_socket.sendto(f"Thread {threadTitle} created.".encode(), client_addr)
-            print(f"[CRT] Thread '{threadTitle}' created by {username}")
+        with get_thread_lock(threadTitle):
+            # check if threadtitle already exists (or some other file already uses that name)
+            try:
+                if threadStore.exists(threadTitle):
+                    raise FileExistsError(threadTitle)
+                # create a new thread
+                threadStore.create(threadTitle, username)
+            except FileExistsError:
+                udp_socket.sendto(f"Error: Thread {threadTitle} already exists.".encode(), client_addr)
+                return
+            share_catalog(threadTitle)
+
+        # the reply promises the change is durable
+        threadStore.commit(threadTitle)
+        udp_socket.sendto(f"Thread {threadTitle} created.".encode(), client_addr)
+        print(f"[CRT] Thread '{threadTitle}' created by {username}")
 
     except Exception as e:
         print(f"===== Error in CRT: {e}")  
 
-def process_MSG(message, udp_socket, client_addr):
+def process_MSG(parts, udp_socket, client_addr):
     try:
-        parts = message.strip().split(" ", 2)   # split command, threadtitle and message
-        if len(parts) < 3:
+        if len(parts) < 3:     # command, threadtitle and message
             # send error message to client
             udp_socket.sendto("Error: Invalid MSG format.".encode(), client_addr)
             return
@@ -115,36 +704,37 @@ def process_MSG(message, udp_socket, client_addr):
         threadTitle = parts[1]
         message_content = parts[2]
 
+        # each message is one line of the thread file (a framed request could carry a line break)
+        if "\n" in message_content:
+            udp_socket.sendto("Error: A message must be a single line.".encode(), client_addr)
+            return
+
         # read the username from activeUsers
         username = activeUsers.get(client_addr)
         if not username:
             udp_socket.sendto("Error: User not recognized.".encode(), client_addr)
             return
 
-        # check if threadtitle exists
-        if not os.path.exists(threadTitle):
-            udp_socket.sendto(f"Error: Thread {threadTitle} does not exist.".encode(), client_addr)
-            return
-
-        # skip the first line and get the message number
-        with open(threadTitle, "r") as f:
-            lines = f.readlines()
-        message_number = len(lines)
+        with get_thread_lock(threadTitle):
+            # check if threadtitle exists
+            if not threadStore.exists(threadTitle):
+                udp_socket.sendto(f"Error: Thread {threadTitle} does not exist.".encode(), client_addr)
+                return
 
-        # write the message to the thread file
-        with open(threadTitle, "a") as f:
-            f.write(f"{message_number} {username}: {message_content}\n")
+            # append the message to the thread file
+            number = threadStore.post_message(threadTitle, username, message_content)
+            thread_event(threadTitle, f"New message {number} in thread '{threadTitle}' by {username}: {message_content[:NOTIFY_TEXT_LIMIT]}", client_addr)
 
+        threadStore.commit(threadTitle)
         udp_socket.sendto(f"Message posted to thread {threadTitle}.".encode(), client_addr)
         print(f"[MSG] {username} posted to {threadTitle}: {message_content}")
 
     except Exception as e:
         print(f"Error in MSG: {e}")    
 
-def process_DLT(message, udp_socket, client_addr):
+def process_DLT(parts, udp_socket, client_addr):
     try:
-        parts = message.strip().split() # split command, threadtitle and message number
-        if len(parts) != 3:
+        if len(parts) != 3:    # command, threadtitle and message number
             # send error message to client
             udp_socket.sendto("Error: Invalid DLT format.".encode(), client_addr)
             return
@@ -165,49 +755,36 @@ def process_DLT(message, udp_socket, client_addr):
             udp_socket.sendto("Error: User not recognized.".encode(), client_addr)
             return
 
-        # check if threadtitle exists
-        if not os.path.exists(threadTitle):
-            udp_socket.sendto(f"Error: Thread {threadTitle} does not exist.".encode(), client_addr)
-            return
-
-        with open(threadTitle, "r") as f:
-            lines = f.readlines()
-
-        # check if message_number is valid
-        if message_number <= 0 or message_number >= len(lines):
-            udp_socket.sendto("Error: Invalid message number.".encode(), client_addr)
-            return
-
-        target_line = lines[message_number]
-
-        # check if the message belongs to the current user
-        expected_prefix = f"{message_number} {username}:"
-        if not target_line.startswith(expected_prefix):
-            udp_socket.sendto("Error: You can only delete your own message.".encode(), client_addr)
-            return
+        with get_thread_lock(threadTitle):
+            # check if threadtitle exists
+            if not threadStore.exists(threadTitle):
+                udp_socket.sendto(f"Error: Thread {threadTitle} does not exist.".encode(), client_addr)
+                return
 
-        # delete the line
-        del lines[message_number]
+            # check if message_number is valid
+            if message_number <= 0 or message_number > threadStore.message_count(threadTitle):
+                udp_socket.sendto("Error: Invalid message number.".encode(), client_addr)
+                return
 
-        # shift up all the remaining messages
-        for i in range(1, len(lines)):
-            if i >= message_number:
-                content = lines[i].split(" ", 1)[1]
-                lines[i] = f"{i} {content}"
+            # check if the message belongs to the current user
+            if threadStore.message_author(threadTitle, message_number) != username:
+                udp_socket.sendto("Error: You can only delete your own message.".encode(), client_addr)
+                return
 
-        with open(threadTitle, "w") as f:
-            f.writelines(lines)
+            # delete the message, the ones after it move up a number when the thread is read
+            threadStore.delete_message(threadTitle, message_number)
+            thread_event(threadTitle, f"Message {message_number} in thread '{threadTitle}' deleted by {username}", client_addr)
 
+        threadStore.commit(threadTitle)
         udp_socket.sendto(f"Message {message_number} deleted from thread '{threadTitle}'.".encode(), client_addr)
         print(f"[DLT] Message {message_number} deleted by {username} in thread '{threadTitle}'")
 
     except Exception as e:
         print(f"Error in DLT: {e}") 
 
-def process_EDT(message, udp_socket, client_addr):
+def process_EDT(parts, udp_socket, client_addr):
     try:
-        parts = message.strip().split(" ", 3)   # split command, threadtitle, message number and new content
-        if len(parts) < 4:
+        if len(parts) < 4:     # command, threadtitle, message number and new content
             # send error message to client
             udp_socket.sendto("Error: Invalid EDT format.".encode(), client_addr)
             return
@@ -215,6 +792,9 @@ def process_EDT(message, udp_socket, client_addr):
         threadTitle = parts[1]
         message_number_str = parts[2]
         new_content = parts[3]
+        if "\n" in new_content:
+            udp_socket.sendto("Error: A message must be a single line.".encode(), client_addr)
+            return
 
         # check if message number is an integer
         if not message_number_str.isdigit():
@@ -228,49 +808,50 @@ def process_EDT(message, udp_socket, client_addr):
             udp_socket.sendto("Error: User not recognized.".encode(), client_addr)
             return
 
-        # check if threadtitle exists
-        if not os.path.exists(threadTitle):
-            udp_socket.sendto(f"Error: Thread '{threadTitle}' does not exist.".encode(), client_addr)
-            return
-
-        with open(threadTitle, "r") as f:
-            lines = f.readlines()
-
-        # check if message_number is valid
-        if message_number <= 0 or message_number >= len(lines):
-            udp_socket.sendto("Error: Invalid message number.".encode(), client_addr)
-            return
-
-        original_line = lines[message_number].strip()
+        with get_thread_lock(threadTitle):
+            # check if threadtitle exists
+            if not threadStore.exists(threadTitle):
+                udp_socket.sendto(f"Error: Thread '{threadTitle}' does not exist.".encode(), client_addr)
+                return
 
-        # check if the message belongs to the current user
-        expected_prefix = f"{message_number} {username}:"
-        if not original_line.startswith(expected_prefix):
-            udp_socket.sendto("Error: You can only edit your own message.".encode(), client_addr)
-            return
+            # check if message_number is valid
+            if message_number <= 0 or message_number > threadStore.message_count(threadTitle):
+                udp_socket.sendto("Error: Invalid message number.".encode(), client_addr)
+                return
 
-        # edit the line
-        new_line = f"{message_number} {username}: {new_content}\n"
-        lines[message_number] = new_line
+            # check if the message belongs to the current user
+            if threadStore.message_author(threadTitle, message_number) != username:
+                udp_socket.sendto("Error: You can only edit your own message.".encode(), client_addr)
+                return
 
-        with open(threadTitle, "w") as f:
-            f.writelines(lines)
+            # edit the message by appending its new version
+            threadStore.edit_message(threadTitle, message_number, username, new_content)
+            thread_event(threadTitle, f"Message {message_number} in thread '{threadTitle}' edited by {username}: {new_content[:NOTIFY_TEXT_LIMIT]}", client_addr)
 
+        threadStore.commit(threadTitle)
         udp_socket.sendto(f"Message {message_number} edited successfully.".encode(), client_addr)
         print(f"[EDT] Message {message_number} in thread '{threadTitle}' edited by {username}")
 
     except Exception as e:
         print(f"Error in EDT: {e}") 
 
-def process_LST(udp_socket, client_addr):
+# sort orders accepted by "LST [order]"
+LST_ORDERS = ("name", "created", "activity")
+
+def process_LST(parts, udp_socket, client_addr):
     try:
-        # list all threads in the current directory
-        threads = [f for f in os.listdir() if os.path.isfile(f) and os.path.splitext(f)[1] == ''
-                   and f != ".DS_Store"]
+        # command and optional sort order
+        if len(parts) > 2 or (len(parts) == 2 and parts[1] not in LST_ORDERS):
+            udp_socket.sendto(f"Error: Invalid LST format. Usage: LST [{'|'.join(LST_ORDERS)}]".encode(), client_addr)
+            return
+
+        # list all threads from the catalog, no directory scan needed
+        order = parts[1] if len(parts) == 2 else "name"
+        threads = threadStore.list_threads(order, thread_times)
 
         if threads:
             thread_list = "\n".join(threads)
-            udp_socket.sendto(f"current threads:\n{thread_list}".encode(), client_addr)
+            send_response(udp_socket, f"current threads:\n{thread_list}".encode(), client_addr)
         else:
             udp_socket.sendto("No threads exist.".encode(), client_addr)
 
@@ -279,45 +860,91 @@ def process_LST(udp_socket, client_addr):
     except Exception as e:
         print(f"===== Error in LST: {e}")
     
-def process_RDT(message, udp_socket, client_addr):
+def process_RDT(parts, udp_socket, client_addr):
     try:
-        parts = message.strip().split(" ", 1)   # split command and threadtitle
-        if len(parts) != 2:
-            udp_socket.sendto("Error: Invalid RDT format. Usage: RDT <threadtitle>".encode(), client_addr)
+        # command, threadtitle and the optional offset and count, or "since" and a message number or version
+        since = parts[3] if len(parts) == 4 and parts[2] == "since" else None
+        if not 2 <= len(parts) <= 4 or (since is None and not all(part.isdigit() for part in parts[2:])):
+            udp_socket.sendto("Error: Invalid RDT format. Usage: RDT <threadtitle> [offset] [count] or RDT <threadtitle> since <number|version>".encode(), client_addr)
             return
 
         threadTitle = parts[1]
-
-        # check if threadtitle exists
-        if not os.path.exists(threadTitle):
-            udp_socket.sendto(f"Error: Thread '{threadTitle}' does not exist.".encode(), client_addr)
+        # without offset/count the whole thread is sent, as several datagrams if it does not fit in one
+        offset = int(parts[2]) if len(parts) > 2 and since is None else 0
+        count = int(parts[3]) if len(parts) > 3 and since is None else None
+        codec = reply_codec(udp_socket, client_addr)
+        reply = None
+
+        with get_thread_lock(threadTitle):
+            # check if threadtitle exists
+            if not threadStore.exists(threadTitle):
+                udp_socket.sendto(f"Error: Thread '{threadTitle}' does not exist.".encode(), client_addr)
+                return
+
+            if since is not None:
+                version, reset, content, deleted = threadStore.read_changes(threadTitle, since)
+                total = threadStore.message_count(threadTitle)
+            else:
+                reply = readCache.get((threadTitle, offset, count, codec))
+                if reply is None:
+                    # read the contents of the thread, without the creator line
+                    content = threadStore.read_thread(threadTitle, offset, count)
+                    total = threadStore.message_count(threadTitle)
+                    if content:
+                        reply = encode_response(content, codec)
+                        readCache.put((threadTitle, offset, count, codec), reply)
+
+        if since is not None:
+            # "VERSION <version> <total>" (or RESET when the client's copy has to be replaced), the new or
+            # edited lines, and the ids of deleted messages; a thread that did not change costs one line
+            header = f"{'RESET' if reset else 'VERSION'} {version} {total}\n".encode()
+            if deleted:
+                content += ("DELETED " + " ".join(map(str, deleted)) + "\n").encode()
+            send_response(udp_socket, header + content, client_addr)
+            print(f"[RDT] Sent changes of thread '{threadTitle}' since {since} to {client_addr}")
             return
 
-        # read the contents of the thread file, except the first line
-        with open(threadTitle, "r") as f:
-            lines = f.readlines()
-
+        if reply is not None:
+            send_response(udp_socket, reply, client_addr, encoded=True)
         # check if there is no message in the thread
-        if len(lines) <= 1:
+        elif total == 0:
             udp_socket.sendto(f"Thread '{threadTitle}' has no messages.".encode(), client_addr)
         else:
-            content = "".join(lines[1:])  # skip the first line
-            udp_socket.sendto(content.encode(), client_addr)
+            udp_socket.sendto(f"Error: Thread '{threadTitle}' has only {total} messages.".encode(), client_addr)
 
         print(f"[RDT] Sent contents of thread '{threadTitle}' to {client_addr}")
 
     except Exception as e:
         print(f"===== Error in RDT: {e}")
 
-def process_UPD(message, udp_socket, client_addr):
+def process_UPD(parts, udp_socket, client_addr):
     try:
-        parts = message.strip().split() # split command, threadtitle and filename
-        if len(parts) != 3:
+        # command, threadtitle, filename and optional size/sha256/streams/compress
+        try:
+            options = protocol.parse_options(parts[3:])
+        except ValueError:
+            options = None
+        if (len(parts) < 3 or options is None or set(options) - {"size", "sha256", "streams", "compress"}
+                or not options.get("streams", "1").isdigit()
+                or options.get("compress", "zlib") not in protocol.CODECS):
             udp_socket.sendto("Error: Invalid UPD format.\n".encode(), client_addr)
             return
 
         threadTitle = parts[1]
         filename = parts[2]
+        if not is_valid_name(filename):
+            udp_socket.sendto("Error: Invalid file name.\n".encode(), client_addr)
+            return
+
+        # with the file's size and checksum the upload can be resumed: it is written to a partial file
+        # named after the checksum, and a later UPD of the same file continues where it stopped
+        size = options.get("size")
+        checksum = options.get("sha256")
+        resumable = size is not None or checksum is not None
+        if resumable and not (size is not None and size.isdigit() and checksum is not None
+                              and len(checksum) == 64 and all(c in "0123456789abcdef" for c in checksum)):
+            udp_socket.sendto("Error: Invalid UPD format.\n".encode(), client_addr)
+            return
 
         # read the username from activeUsers, used to add the upload record to the thread file
         username = activeUsers.get(client_addr)
@@ -325,204 +952,654 @@ def process_UPD(message, udp_socket, client_addr):
             udp_socket.sendto("Error: User not recognized.\n".encode(), client_addr)
             return
 
-        # check if thread exists
-        if not os.path.exists(threadTitle):
-            udp_socket.sendto(f"Error: Thread '{threadTitle}' does not exist.\n".encode(), client_addr)
-            return
-
-        # check if the file already exists in the thread
         save_name = f"{threadTitle}-{filename}"
-        if os.path.exists(save_name):
-            udp_socket.sendto(f"Error: File '{filename}' already uploaded to thread '{threadTitle}'.\n".encode(), client_addr)
-            return
-
-        # if everything is ok, transfer the file over TCP
+        if resumable:
+            part_name = attachmentStore.incoming_path(f"{checksum}.part")
+        else:
+            part_name = attachmentStore.incoming_path(f"upload-{secrets.token_hex(8)}")
+        offset = 0
+        with get_thread_lock(threadTitle):
+            # check if thread exists
+            if not threadStore.exists(threadTitle):
+                udp_socket.sendto(f"Error: Thread '{threadTitle}' does not exist.\n".encode(), client_addr)
+                return
+
+            # check if the file already exists in the thread (or is being uploaded right now)
+            with uploadsLock:
+                if attachmentStore.lookup(threadTitle, filename) is not None or save_name in uploads_in_progress:
+                    udp_socket.sendto(f"Error: File '{filename}' already uploaded to thread '{threadTitle}'.\n".encode(), client_addr)
+                    return
+                if part_name in uploads_in_progress:
+                    udp_socket.sendto(f"Error: The same file is being uploaded right now, try again later.\n".encode(), client_addr)
+                    return
+
+                # the same content is already stored (e.g. posted to another thread): just refer to it,
+                # no data needs to be sent
+                if resumable and attachmentStore.has_object(checksum):
+                    attachmentStore.add(threadTitle, filename, checksum)
+                    threadStore.add_upload(threadTitle, username, filename)
+                    thread_event(threadTitle, f"File '{filename}' uploaded to thread '{threadTitle}' by {username}", client_addr)
+                    threadStore.commit(threadTitle)
+                    udp_socket.sendto(f"File '{filename}' uploaded to thread '{threadTitle}' successfully.\n".encode(), client_addr)
+                    print(f"[UPD] File '{filename}' already stored, logged to thread '{threadTitle}' without a transfer")
+                    return
+
+                uploads_in_progress.add(save_name)
+                uploads_in_progress.add(part_name)
+
+            if resumable and os.path.exists(part_name):
+                offset = os.path.getsize(part_name)
+                if offset > int(size):
+                    os.remove(part_name)
+                    offset = 0
+
+        # called by the data listener once the file has arrived (or the transfer failed)
+        def upload_done(ok):
+            try:
+                with get_thread_lock(threadTitle):
+                    with uploadsLock:
+                        uploads_in_progress.discard(save_name)
+                        uploads_in_progress.discard(part_name)
+
+                    if resumable:
+                        # a short file is kept for the next UPD to resume, a wrong one is thrown away
+                        received = os.path.getsize(part_name) if os.path.exists(part_name) else 0
+                        if received < int(size):
+                            udp_socket.sendto(f"Error: Upload of '{filename}' interrupted at {received} of {size} bytes, send UPD again to resume.\n".encode(), client_addr)
+                            return
+                        if received > int(size) or protocol.file_sha256(part_name) != checksum:
+                            os.remove(part_name)
+                            udp_socket.sendto(f"Error: Checksum mismatch for '{filename}', upload discarded.\n".encode(), client_addr)
+                            return
+                    elif not ok:
+                        if os.path.exists(part_name):
+                            os.remove(part_name)
+                        udp_socket.sendto(f"Error: Upload of '{filename}' failed.\n".encode(), client_addr)
+                        return
+
+                    # the thread may have been removed while the file was being transferred
+                    if not threadStore.exists(threadTitle):
+                        if os.path.exists(part_name):
+                            os.remove(part_name)
+                        udp_socket.sendto(f"Error: Thread '{threadTitle}' does not exist.\n".encode(), client_addr)
+                        return
+
+                    # move the file into the attachment store (or drop it if the content is there already)
+                    attachmentStore.add(threadTitle, filename, checksum or protocol.file_sha256(part_name), part_name)
+
+                    # write the username and upload record to the thread file
+                    threadStore.add_upload(threadTitle, username, filename)
+                    thread_event(threadTitle, f"File '{filename}' uploaded to thread '{threadTitle}' by {username}", client_addr)
+
+                threadStore.commit(threadTitle)
+                udp_socket.sendto(f"File '{filename}' uploaded to thread '{threadTitle}' successfully.\n".encode(), client_addr)
+                print(f"[UPD] File '{filename}' uploaded and logged to thread '{threadTitle}'")
+            except Exception as e:
+                print(f"===== Error in UPD: {e}")
+
+        # if everything is ok, the client sends the file (from offset on) over TCP to the data
+        # listener; this worker is done, the rest happens in upload_done. Only a file of known size
+        # can be split over several streams, and a compressed upload always uses one
+        codec = options.get("compress")
+        if resumable and codec is None:
+            count = int(size) - offset
+            streams = negotiate_streams(int(options.get("streams", "1")), count)
+        else:
+            count, streams = (int(size) - offset if resumable else None), 1
+        token = register_transfer("upload", part_name, upload_done, offset, count, streams, codec)
+        reply = f"PORT {DATA_PORT + cluster.index} {token} offset={offset} streams={streams}"
+        if codec:
+            reply += f" compress={codec}"
         udp_socket.sendto("READY\n".encode(), client_addr)
-        print(f"[UPD] Ready to receive file '{filename}' via TCP")
-
-        time.sleep(0.01)    # for the client to receive the message, stayability
-        receive_file_over_tcp(threadTitle, filename, udp_socket, client_addr)
-
-        # write the username and upload record to the thread file
-        with open(threadTitle, "a") as f:
-            f.write(f"{username} uploaded {filename}\n")
-
-        udp_socket.sendto(f"File '{filename}' uploaded to thread '{threadTitle}' successfully.\n".encode(), client_addr)
-        print(f"[UPD] File '{filename}' uploaded and logged to thread '{threadTitle}'")
+        udp_socket.sendto(f"{reply}\n".encode(), client_addr)
+        print(f"[UPD] Ready to receive file '{filename}' via TCP from byte {offset} over {streams} stream(s)")
 
     except Exception as e:
         print(f"===== Error in UPD: {e}")
 
-def receive_file_over_tcp(thread, filename, udp_socket, client_addr, serverHost="127.0.0.1"):
-    max_tries = 10
-    tcp_sock = None
-    port = None
-
-    # every time a new file to be uploaded, randomly select a port number between 20000 and 30000
-    # to prevent port collision
-    for _ in range(max_tries):
-        try:
-            port = random.randint(20000, 30000)
-            tcp_sock = socket(AF_INET, SOCK_STREAM)
-            tcp_sock.bind((serverHost, port))
-            tcp_sock.listen(1)
-            break
-        except OSError:
-            continue
-    else:
-        udp_socket.sendto("Error: Cannot find available port.\n".encode(), client_addr)
-        return False
-
-    # send the port number to the client
-    udp_socket.sendto(f"PORT {port}\n".encode(), client_addr)
-    print(f"[TCP] Listening for file on port {port}.")
+# receive buffers for uploads, allocated once and reused by the data connection threads
+def acquire_transfer_buffer():
+    try:
+        return transfer_buffers.pop()
+    except IndexError:
+        return bytearray(TRANSFER_BUFFER_SIZE)
 
-    # build the TCP connection
-    conn, addr = tcp_sock.accept()
-    print(f"[TCP] Connected by {addr}")
+def release_transfer_buffer(buffer):
+    transfer_buffers.append(buffer)
 
-    # create and write the file
-    server_file = f"{thread}-{filename}"
-    file_created = False
-    f = None
+# receive an uploaded file from an accepted data connection until the client closes it, writing
+# from offset on (what a resumed upload already has is kept) and decompressing it if codec is set
+def receive_file_over_tcp(conn, server_file, offset=0, codec=None, limit=None):
+    buffer = acquire_transfer_buffer()
+    view = memoryview(buffer)
+    decompressor = protocol.Decompressor(codec) if codec else None
 
     try:
-        while True:
-            data = conn.recv(2048)
-            if not data:
-                break
-            if not file_created:
-                f = open(server_file, "wb")
-                file_created = True
-            f.write(data)
+        # create the file, or cut a partial file back to the offset the client was told to send from
+        with open(server_file, "r+b" if offset else "wb") as f:
+            f.seek(offset)
+            f.truncate()
+            while True:
+                # read straight into the preallocated buffer, no new bytes object per chunk
+                n = conn.recv_into(buffer)
+                if n == 0:
+                    break
+                if decompressor:
+                    # a compressed stream must not expand past the size the client announced: ask for
+                    # one byte more than is still allowed, getting it means the upload is too large
+                    allowed = None if limit is None else offset + limit - f.tell() + 1
+                    data = decompressor.decompress(view[:n], allowed)
+                    if allowed is not None and len(data) >= allowed:
+                        raise ValueError("upload larger than announced")
+                    f.write(data)
+                else:
+                    f.write(view[:n])
+            if decompressor:
+                f.write(decompressor.flush())
+                if limit is not None and f.tell() > offset + limit:
+                    raise ValueError("upload larger than announced")
         print(f"[TCP] File received and saved as {server_file}")
         return True
     except Exception as e:
         print(f"[TCP Error] {e}")
         return False
     finally:
-        if f:
-            f.close()   # once the file is uploaded, close the tcp connection
-        conn.close()
-        tcp_sock.close()
+        view.release()
+        release_transfer_buffer(buffer)
+
+# receive bytes [start, end) of an upload split over several streams, writing them in place with
+# pwrite so the streams can fill their parts of the file side by side; returns the bytes received
+def receive_range_over_tcp(conn, server_file, start, end):
+    received = 0
+    buffer = acquire_transfer_buffer()
+    view = memoryview(buffer)
+    fd = os.open(server_file, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        while received < end - start:
+            n = conn.recv_into(buffer, min(len(buffer), end - start - received))
+            if n == 0:
+                break
+            os.pwrite(fd, view[:n], start + received)
+            received += n
+    except Exception as e:
+        print(f"[TCP Error] {e}")
+    finally:
+        os.close(fd)
+        view.release()
+        release_transfer_buffer(buffer)
+    print(f"[TCP] Received bytes {start}-{start + received} of {server_file}")
+    return received
 
-def process_DWN(message, udp_socket, client_addr):
+def process_DWN(parts, udp_socket, client_addr):
     try:
-        parts = message.strip().split() # split command, threadtitle and filename
-        if len(parts) != 3:
+        # command, threadtitle, filename and optional offset/length/streams
+        try:
+            options = protocol.parse_options(parts[3:])
+        except ValueError:
+            options = None
+        if (len(parts) < 3 or options is None or set(options) - {"offset", "length", "streams"}
+                or not all(value.isdigit() for value in options.values())):
             udp_socket.sendto("Error: Invalid DWN format.\n".encode(), client_addr)
             return
 
         threadTitle = parts[1]
         filename = parts[2]
-        full_filename = f"{threadTitle}-{filename}"
-
-        # check if the thread and file exist
-        if not os.path.exists(threadTitle):
-            udp_socket.sendto(f"Error: Thread '{threadTitle}' does not exist.\n".encode(), client_addr)
-            return
-
-        if not os.path.exists(full_filename):
-            udp_socket.sendto(f"Error: File '{filename}' was not found in thread '{threadTitle}'.\n".encode(), client_addr)
+        if not is_valid_name(filename):
+            udp_socket.sendto("Error: Invalid file name.\n".encode(), client_addr)
             return
 
-        # if the file exists, send the file over TCP
+        # the file is looked up and opened with the thread locked, so an RMV cannot delete it in
+        # between; the open files keep it readable until the client has fetched it
+        with get_thread_lock(threadTitle):
+            # check if the thread and file exist
+            if not threadStore.exists(threadTitle):
+                udp_socket.sendto(f"Error: Thread '{threadTitle}' does not exist.\n".encode(), client_addr)
+                return
+
+            checksum = attachmentStore.lookup(threadTitle, filename)
+            if checksum is None:
+                udp_socket.sendto(f"Error: File '{filename}' was not found in thread '{threadTitle}'.\n".encode(), client_addr)
+                return
+            full_filename = attachmentStore.object_path(checksum)
+
+            # only the byte range [offset, offset + length) is sent; an offset past the end (a stale
+            # partial download of an older file) starts over from 0, which the reply tells the client
+            size = os.path.getsize(full_filename)
+            offset = int(options.get("offset", "0"))
+            if offset > size:
+                offset = 0
+            count = size - offset
+            if "length" in options:
+                count = min(count, int(options["length"]))
+
+            # a client that agreed on a codec gets the file compressed over a single stream, unless
+            # the file is compressed already
+            codec = activeUsers.codec(client_addr)
+            if codec and protocol.looks_compressed(full_filename):
+                codec = None
+            streams = 1 if codec else negotiate_streams(int(options.get("streams", "1")), count)
+            files = [open(full_filename, "rb") for _ in range(streams)]
+
+        # called by the data listener once the file has been sent (or the transfer failed)
+        def download_done(ok):
+            if ok:
+                udp_socket.sendto(f"File '{filename}' downloaded successfully from thread '{threadTitle}'.\n".encode(), client_addr)
+                print(f"[DWN] Sent file '{filename}' to {client_addr}")
+            else:
+                udp_socket.sendto(f"Error: Download of '{filename}' failed.\n".encode(), client_addr)
+
+        # if the file exists, the client fetches it over TCP from the data listener; the reply also
+        # carries the whole file's size and checksum so the client can verify what it put together
+        token = register_transfer("download", full_filename, download_done, offset, count, streams, codec, files)
+        reply = f"PORT {DATA_PORT + cluster.index} {token} offset={offset} length={count} size={size} sha256={checksum} streams={streams}"
+        if codec:
+            reply += f" compress={codec}"
         udp_socket.sendto("READY".encode(), client_addr)
-        time.sleep(0.01)
+        udp_socket.sendto(reply.encode(), client_addr)
 
-        # send the file over TCP
-        send_file_over_tcp(full_filename, udp_socket, client_addr)
+    except Exception as e:
+        print(f"===== Error in DWN: {e}")
 
-        udp_socket.sendto(f"File '{filename}' downloaded successfully from thread '{threadTitle}'.\n".encode(), client_addr)
-        print(f"[DWN] Sent file '{filename}' to {client_addr}")
+# send count bytes of a file (a path, or a file opened for this connection, which is closed after),
+# starting at offset, over an accepted data connection, compressed with codec if one is given
+def send_file_over_tcp(conn, source, offset=0, count=None, codec=None):
+    # write the file
+    try:
+        with open(source, "rb") if isinstance(source, str) else source as f:
+            if count == 0 and codec is None:
+                pass    # nothing left to send, e.g. a download resumed after its last byte
+            elif hasattr(os, "sendfile") and codec is None:
+                # zero copy: the kernel moves the file to the socket without passing through Python
+                conn.sendfile(f, offset, count)
+            else:
+                # compressing, or no sendfile on this platform: copy in large chunks instead
+                compressor = protocol.Compressor(codec) if codec else None
+                f.seek(offset)
+                remaining = count
+                buffer = acquire_transfer_buffer()
+                try:
+                    view = memoryview(buffer)
+                    while remaining is None or remaining > 0:
+                        n = f.readinto(buffer)
+                        if not n:
+                            break
+                        if remaining is not None:
+                            n = min(n, remaining)
+                            remaining -= n
+                        conn.sendall(compressor.compress(view[:n]) if compressor else view[:n])
+                    if compressor:
+                        conn.sendall(compressor.flush())
+                    view.release()
+                finally:
+                    release_transfer_buffer(buffer)
+        print(f"[TCP] File {f.name} sent successfully.")
+        return True
+    except Exception as e:
+        print(f"[TCP Send Error] {e}")
+        return False
 
+# number of streams for a transfer of count bytes that the client asked to split into requested
+def negotiate_streams(requested, count):
+    return max(1, min(requested, TRANSFER_STREAMS, count // TRANSFER_MIN_CHUNK))
+
+# remember a transfer the client is about to open data connections for, returns its one-time token.
+# A transfer split over several streams expects that many connections, each for one byte range
+# within [offset, offset + count); on_done runs once, after the last of them has finished
+def register_transfer(kind, path, on_done, offset=0, count=None, streams=1, codec=None, files=None):
+    token = secrets.token_hex(TRANSFER_TOKEN_LENGTH // 2)
+    with pendingTransfersLock:
+        pendingTransfers[token] = {
+            "kind": kind,
+            "path": path,
+            "offset": offset,
+            "count": count,
+            "streams": streams,
+            "codec": codec,     # compression of a single-stream transfer
+            "files": files or [],   # a download's file opened once per stream, each connection takes one
+            "connected": 0,
+            "finished": 0,
+            "ok": True,
+            "ranges": {},       # start -> (end, bytes received) of each uploaded range
+            "on_done": on_done,
+            "expires": time.time() + TRANSFER_TIMEOUT,
+        }
+    return token
+
+# give up on transfers whose client never opened (all of) its connections
+def expire_pending_transfers():
+    now = time.time()
+    with pendingTransfersLock:
+        expired = [token for token, transfer in pendingTransfers.items() if transfer["expires"] <= now]
+        expired = [pendingTransfers.pop(token) for token in expired]
+        done = []
+        for transfer in expired:
+            # streams already running still finish, the transfer completes (as failed) after them
+            transfer["ok"] = False
+            transfer["streams"] = transfer["connected"]
+            if transfer["finished"] == transfer["streams"]:
+                done.append(transfer)
+    for transfer in expired:
+        print(f"[TCP] Transfer of {transfer['path']} timed out")
+    for transfer in done:
+        # on_done may wait for a thread lock, keep that off the listener
+        threading.Thread(target=complete_transfer, args=(transfer,), daemon=True).start()
+
+# count one finished connection of a transfer, completing the transfer after the last one
+def finish_transfer(transfer, ok):
+    with pendingTransfersLock:
+        transfer["finished"] += 1
+        transfer["ok"] = transfer["ok"] and ok
+        done = transfer["finished"] == transfer["streams"]
+    if done:
+        complete_transfer(transfer)
+
+def complete_transfer(transfer):
+    # files opened for connections that never came
+    for f in transfer["files"]:
+        f.close()
+    # ranges of a multi-stream upload may have stopped part way; keep only the bytes received
+    # without a gap from the start, so a resumed upload can carry on from the end of the file
+    if transfer["kind"] == "upload" and transfer["ranges"]:
+        end = protocol.received_prefix(transfer["offset"], transfer["ranges"])
+        if os.path.exists(transfer["path"]) and os.path.getsize(transfer["path"]) > end:
+            os.truncate(transfer["path"], end)
+    transfer["on_done"](transfer["ok"])
+
+# read exactly n bytes from a TCP connection (fewer only if it is closed first)
+def recv_exact(conn, n):
+    data = b""
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+# read the rest of a short header line, one byte at a time so no file data is consumed with it
+def recv_line(conn, limit):
+    data = b""
+    while len(data) < limit and not data.endswith(b"\n"):
+        chunk = conn.recv(1)
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+# one data connection: the client first sends its transfer token and a newline, then the file is
+# received (UPD) or sent (DWN). A connection carrying one range of a multi-stream transfer sends
+# "{token} {start} {end}" instead and only that byte range of the file is transferred
+def handle_data_connection(conn, addr):
+    transfer = None
+    ok = False
+    try:
+        conn.settimeout(TRANSFER_TIMEOUT)
+        header = recv_exact(conn, TRANSFER_TOKEN_LENGTH + 1)
+        if header.endswith(b" "):
+            header += recv_line(conn, 64)
+        fields = header.decode(errors="replace").split()
+        token = fields[0] if fields else ""
+        byte_range = None
+        with pendingTransfersLock:
+            transfer = pendingTransfers.get(token)
+            if transfer is not None and transfer["streams"] > 1:
+                limit = transfer["offset"] + transfer["count"]
+                if (len(fields) == 3 and fields[1].isdigit() and fields[2].isdigit()
+                        and transfer["offset"] <= int(fields[1]) <= int(fields[2]) <= limit):
+                    byte_range = (int(fields[1]), int(fields[2]))
+                else:
+                    transfer = None
+            if transfer is not None:
+                transfer["connected"] += 1
+                source = transfer["files"].pop() if transfer["files"] else transfer["path"]
+                # every expected connection has arrived, the token cannot be used again
+                if transfer["connected"] == transfer["streams"]:
+                    pendingTransfers.pop(token)
+        if transfer is None:
+            print(f"[TCP] Unknown transfer token or range from {addr}")
+            return
+
+        print(f"[TCP] Connected by {addr}")
+        if byte_range is not None:
+            start, end = byte_range
+            if transfer["kind"] == "upload":
+                received = receive_range_over_tcp(conn, transfer["path"], start, end)
+                with pendingTransfersLock:
+                    transfer["ranges"][start] = (end, received)
+                ok = received == end - start
+            else:
+                ok = send_file_over_tcp(conn, source, start, end - start)
+        elif transfer["kind"] == "upload":
+            ok = receive_file_over_tcp(conn, transfer["path"], transfer["offset"], transfer["codec"], transfer["count"])
+        else:
+            ok = send_file_over_tcp(conn, source, transfer["offset"], transfer["count"], transfer["codec"])
     except Exception as e:
-        print(f"===== Error in DWN: {e}")
+        print(f"[TCP Error] {e}")
+    finally:
+        conn.close()    # once the file is transferred, close the tcp connection
+        if transfer is not None:
+            finish_transfer(transfer, ok)
+
+# keep accepting file transfer connections on the data port, each one is served by its own thread
+def data_listener(tcp_sock):
+    while True:
+        conn, addr = tcp_sock.accept()
+        threading.Thread(target=handle_data_connection, args=(conn, addr), daemon=True).start()
 
-def send_file_over_tcp(filepath, udp_socket, client_addr, serverHost="127.0.0.1"):
-    # similar to UPD, randomly select a port number between 20000 and 30000
-    max_tries = 10
-    for _ in range(max_tries):
+# agree on session options: "HELLO compress=zstd,zlib framing=binary" is answered with what was
+# chosen ("HELLO compress=zlib framing=binary"), a bare "HELLO" if none of it is available
+def process_HELLO(parts, udp_socket, client_addr):
+    try:
         try:
-            port = random.randint(20000, 30000)
-            tcp_sock = socket(AF_INET, SOCK_STREAM)
-            tcp_sock.bind((serverHost, port))
-            tcp_sock.listen(1)
-            break
-        except OSError:
-            continue
-    else:
-        udp_socket.sendto("Error: Cannot find available port.\n".encode(), client_addr)
-        return
+            options = protocol.parse_options(parts[1:])
+        except ValueError:
+            udp_socket.sendto("Error: Invalid HELLO format.".encode(), client_addr)
+            return
 
-    # send the port number to the client
-    udp_socket.sendto(f"PORT {port}".encode(), client_addr)
-    print(f"[TCP] Ready to send file on port {port}")
+        agreed = {}
+        codec = protocol.choose_codec(options.get("compress", "").split(","))
+        activeUsers.set_codec(client_addr, codec)
+        share_session(client_addr)
+        if codec:
+            agreed["compress"] = codec
+        # the server answers framed requests with frames, so binary framing just needs confirming
+        if "binary" in options.get("framing", "").split(","):
+            agreed["framing"] = "binary"
+        udp_socket.sendto(f"HELLO {protocol.format_options(agreed)}".strip().encode(), client_addr)
+        print(f"[HELLO] {client_addr} agreed on {agreed}")
 
-    # build the TCP connection
-    conn, addr = tcp_sock.accept()
-    print(f"[TCP] Sending to {addr}")
+    except Exception as e:
+        print(f"===== Error in HELLO: {e}")
+
+# the messages of this process's threads matching a search
+# (number of matches, [(title, message number, "user: text")] of the first limit of them)
+def search_messages(query, user, limit):
+    hits = searchIndex.search(query, user)
+
+    # message numbers change as messages are deleted, so they are looked up now; a hit whose
+    # message was deleted in the meantime is skipped
+    total = len(hits)
+    found = []
+    while hits and len(found) < limit:
+        threadTitle, message_id = heapq.heappop(hits)
+        with get_thread_lock(threadTitle):
+            message = threadStore.exists(threadTitle) and threadStore.find_message(threadTitle, message_id)
+        if message:
+            found.append((threadTitle, message[0], message[1]))
+    return total, found
+
+def search_asked(peer, header, payload):
+    total, found = search_messages(header["query"], header["user"], header["limit"])
+    return {"total": total, "found": found}, b""
+
+def process_SRCH(parts, udp_socket, client_addr):
+    try:
+        # command, the words to look for and the optional user=<name> and limit=<n>
+        words = [part for part in parts[1:] if not part.startswith(("user=", "limit="))]
+        try:
+            options = protocol.parse_options([part for part in parts[1:] if part not in words])
+            limit = min(int(options.get("limit", SEARCH_DEFAULT_LIMIT)), SEARCH_MAX_LIMIT)
+        except ValueError:
+            limit = 0
+        if not words or limit < 1:
+            udp_socket.sendto("Error: Invalid SRCH format. Usage: SRCH <words> [user=<name>] [limit=<n>]".encode(), client_addr)
+            return
 
-    # write the file
+        query = " ".join(words)
+        total, found = search_messages(query, options.get("user"), limit)
+        # other processes search the threads they own
+        for reply, _ in cluster.ask_all("search", {"query": query, "user": options.get("user"), "limit": limit}):
+            total += reply["total"]
+            found += [tuple(hit) for hit in reply["found"]]
+        found = sorted(found)[:limit]
+
+        if not found:
+            udp_socket.sendto(f"No messages match '{query}'.".encode(), client_addr)
+        else:
+            more = f", showing the first {len(found)}" if total > len(found) else ""
+            header = f"{total} message(s) match '{query}'{more}:"
+            lines = [f"{threadTitle} {number} {line}" for threadTitle, number, line in found]
+            send_response(udp_socket, "\n".join([header] + lines).encode(), client_addr)
+
+        print(f"[SRCH] '{query}' matched {total} messages for {client_addr}")
+
+    except Exception as e:
+        print(f"===== Error in SRCH: {e}")
+
+# subscribe to a thread: changes others make to it are pushed to this client as notifications
+def process_SUB(parts, udp_socket, client_addr):
     try:
-        with open(filepath, "rb") as f:
-            while True:
-                data = f.read(2048)
-                if not data:
-                    break
-                conn.sendall(data)
-        print(f"[TCP] File {filepath} sent successfully.")
+        if len(parts) != 2:    # command and threadtitle
+            udp_socket.sendto("Error: Invalid SUB format.".encode(), client_addr)
+            return
+
+        threadTitle = parts[1]
+        with get_thread_lock(threadTitle):
+            if not threadStore.exists(threadTitle):
+                udp_socket.sendto(f"Error: Thread '{threadTitle}' does not exist.".encode(), client_addr)
+                return
+            notifier.subscribe(client_addr, threadTitle)
+
+        udp_socket.sendto(f"Subscribed to thread '{threadTitle}'.".encode(), client_addr)
+        print(f"[SUB] {client_addr} subscribed to '{threadTitle}'")
+
     except Exception as e:
-        print(f"[TCP Send Error] {e}")
-    finally:
-        conn.close()
-        tcp_sock.close()
+        print(f"===== Error in SUB: {e}")
 
-def process_RMV(message, udp_socket, client_addr):
+def process_UNSUB(parts, udp_socket, client_addr):
     try:
-        parts = message.strip().split()     # split command, threadtitle
-        if len(parts) != 2:
-            udp_socket.sendto("Error: Invalid RMV format.".encode(), client_addr)
+        if len(parts) != 2:    # command and threadtitle
+            udp_socket.sendto("Error: Invalid UNSUB format.".encode(), client_addr)
             return
 
         threadTitle = parts[1]
+        if not notifier.unsubscribe(client_addr, threadTitle):
+            udp_socket.sendto(f"Error: Not subscribed to thread '{threadTitle}'.".encode(), client_addr)
+            return
+
+        udp_socket.sendto(f"Unsubscribed from thread '{threadTitle}'.".encode(), client_addr)
+        print(f"[UNSUB] {client_addr} unsubscribed from '{threadTitle}'")
+
+    except Exception as e:
+        print(f"===== Error in UNSUB: {e}")
+
+# stands in for the reply socket while one operation of a batch runs, keeping its replies
+class ReplyCollector:
+    def __init__(self):
+        self.replies = []
+
+    def sendto(self, data, address):
+        self.replies.append(data)
 
-        # # check if thread exists
-        if not os.path.exists(threadTitle):
-            udp_socket.sendto(f"Error: Thread '{threadTitle}' does not exist.".encode(), client_addr)
+# run several commands from one request: "BAT" followed by one command per line. Every thread the
+# batch touches is locked once for the whole batch and its writes are fsynced once at the end; the
+# reply lists each command's own reply under a "[n] command thread" line
+def batch_titles(operations):
+    return sorted({operation[1] for operation in operations
+                   if operation[0] in BATCH_COMMANDS and len(operation) > 1},
+                  key=lambda title: (threadStore.lock_order(title), title))
+
+def process_BAT(parts, udp_socket, client_addr):
+    try:
+        operations = [protocol.split_command(line.strip()) for line in parts[1:] if line.strip()]
+        if not operations or len(operations) > MAX_BATCH_OPERATIONS:
+            udp_socket.sendto(f"Error: A batch must hold 1 to {MAX_BATCH_OPERATIONS} commands.".encode(), client_addr)
             return
 
-        # read the username from activeUsers
-        username = activeUsers.get(client_addr)
-        if not username:
-            udp_socket.sendto("Error: User not recognized.".encode(), client_addr)
+        # lock the threads in lock order, so two batches can never wait for each other
+        titles = batch_titles(operations)
+        # commands reach the process owning their thread, but a batch is run by one process
+        if not all(cluster.owns(title) for title in titles):
+            udp_socket.sendto("Error: The threads of this batch are kept by different server processes, send them in separate batches.".encode(), client_addr)
             return
+        results = []
+        with contextlib.ExitStack() as stack:
+            for title in titles:
+                stack.enter_context(get_thread_lock(title))
+            for title in titles:
+                threadStore.begin_batch(title)
+                stack.callback(threadStore.end_batch, title)
+
+            for operation in operations:
+                collector = ReplyCollector()
+                if operation[0] in BATCH_COMMANDS:
+                    COMMANDS[operation[0]](operation, collector, client_addr)
+                else:
+                    collector.sendto(f"Error: {operation[0]} cannot be used in a batch.".encode(), client_addr)
+                reply = b"\n".join(reply.rstrip(b"\n") for reply in collector.replies)
+                results.append(f"[{len(results) + 1}] {' '.join(operation[:2])}\n".encode() + reply)
+
+        send_response(udp_socket, b"\n".join(results), client_addr)
+        print(f"[BAT] Ran {len(operations)} commands on {len(titles)} threads for {client_addr}")
 
-        # check if the thread is created by this user by checking the first line of the thresd file
-        with open(threadTitle, "r") as f:
-            creator = f.readline().strip()
+    except Exception as e:
+        print(f"===== Error in BAT: {e}")
 
-        if username != creator:
-            udp_socket.sendto("Error: Only the thread creator can remove it.".encode(), client_addr)
+def process_RMV(parts, udp_socket, client_addr):
+    try:
+        if len(parts) != 2:    # command and threadtitle
+            udp_socket.sendto("Error: Invalid RMV format.".encode(), client_addr)
             return
 
-        # if the user mathches the username, remove the thread and all the corresponding file that starts with "threadTitle-"
-        os.remove(threadTitle)
-        for file in os.listdir():
-            if file.startswith(f"{threadTitle}-"):
-                os.remove(file)
+        threadTitle = parts[1]
+
+        # read the username from activeUsers
+        username = activeUsers.get(client_addr)
+        if not username:
+            udp_socket.sendto("Error: User not recognized.".encode(), client_addr)
+            return
 
+        with get_thread_lock(threadTitle):
+            # # check if thread exists
+            if not threadStore.exists(threadTitle):
+                udp_socket.sendto(f"Error: Thread '{threadTitle}' does not exist.".encode(), client_addr)
+                return
+
+            # check if the thread is created by this user (the first line of the thread file)
+            if username != threadStore.creator(threadTitle):
+                udp_socket.sendto("Error: Only the thread creator can remove it.".encode(), client_addr)
+                return
+
+            # if the user mathches the username, remove the thread and let go of its uploaded files
+            threadStore.remove(threadTitle)
+            attachmentStore.remove_thread(threadTitle)
+            thread_event(threadTitle, f"Thread '{threadTitle}' removed by {username}", client_addr)
+            notifier.remove_thread(threadTitle)
+            share_catalog(threadTitle)
+
+        threadStore.commit(threadTitle)
         udp_socket.sendto(f"Thread '{threadTitle}' and its associated files have been removed.".encode(), client_addr)
         print(f"[RMV] Thread '{threadTitle}' deleted by {username}")
 
     except Exception as e:
         print(f"===== Error in RMV: {e}")
 
-def process_XIT(udp_socket, client_addr):
+def process_XIT(parts, udp_socket, client_addr):
     try:
         # check if the user is online by using client address as the key
         if client_addr in activeUsers:
             username = activeUsers.pop(client_addr)
+            notifier.forget(client_addr)
+            share_session(client_addr)
             print(f"[XIT] User '{username}' logged out.")
             udp_socket.sendto("Goodbye!".encode(), client_addr)
         else:
@@ -531,50 +1608,224 @@ def process_XIT(udp_socket, client_addr):
         print(f"===== Error in XIT: {e}")
 
 
-# keep listening for UDP messages and handle user commands
+# command name -> handler, each called with the command's parts (the name first)
+COMMANDS = {
+    "CRT": process_CRT,
+    "MSG": process_MSG,
+    "DLT": process_DLT,
+    "EDT": process_EDT,
+    "LST": process_LST,
+    "RDT": process_RDT,
+    "UPD": process_UPD,
+    "DWN": process_DWN,
+    "RMV": process_RMV,
+    "XIT": process_XIT,
+    "HELLO": process_HELLO,
+    "BAT": process_BAT,
+    "SUB": process_SUB,
+    "UNSUB": process_UNSUB,
+    "SRCH": process_SRCH,
+}
+
+# run a single user command, called from the worker threads
+def handle_command(parts, udp_sock, client_addr):
+    handler = COMMANDS.get(parts[0]) if parts else None
+    if handler is None:
+        udp_sock.sendto("Error: Unrecognized command.".encode(), client_addr)
+        return
+    handler(parts, udp_sock, client_addr)
+
+# worker thread: take commands from the queue and run them, so a slow UPD/DWN only occupies one worker
+def command_worker():
+    while True:
+        parts, udp_sock, client_addr = command_queue.get()
+        try:
+            handle_command(parts, udp_sock, client_addr)
+        except Exception as e:
+            print(f"===== Error in worker: {e}")
+        finally:
+            command_queue.task_done()
+
+# commands that name a thread, run by the process owning it
+THREAD_COMMANDS = ("CRT", "MSG", "DLT", "EDT", "RDT", "UPD", "DWN", "RMV", "SUB", "UNSUB")
+
+# the process that should run a command: the owner of the thread it names (for a batch, of its threads
+# if they all have the same owner), else the one that received it
+def command_owner(parts):
+    if cluster.size == 1 or not parts:
+        return cluster.index
+    if parts[0] in THREAD_COMMANDS and len(parts) > 1:
+        return cluster.owner(parts[1])
+    if parts[0] == "BAT":
+        operations = [protocol.split_command(line.strip()) for line in parts[1:] if line.strip()]
+        owners = {cluster.owner(title) for title in batch_titles(operations)}
+        if len(owners) == 1:
+            return owners.pop()
+    return cluster.index
+
+# one datagram from a client, received here or forwarded by the process that received it
+def handle_datagram(udp_sock, data, client_addr, forwarded=False):
+    # sessions are timed by the process receiving the client's datagrams
+    if not forwarded:
+        activeUsers.touch(client_addr)
+    if data == protocol.KEEPALIVE_MARKER:
+        return
+
+    try:
+        request = protocol.parse_request(data)
+    except ValueError:
+        print(f"[recv] Malformed request from {client_addr}")
+        return
+    body = request[1] if request is not None else data
+
+    # a framed request arrives split into its parts already, and its replies are framed too
+    try:
+        frame = protocol.parse_frame(body)
+    except ValueError:
+        print(f"[recv] Malformed frame from {client_addr}")
+        return
+    if frame is not None:
+        opcode, _, frame_id, fields = frame
+        parts = [protocol.OPCODE_NAMES.get(opcode, "")] + [field.decode(errors="replace") for field in fields]
+        message = " ".join(parts)
+    else:
+        message = body.decode(errors="replace").strip()
+        parts = protocol.split_command(message)
+
+    # a command for a thread another process owns goes there as it is, that process answers the
+    # client itself (and also gets every resend of it)
+    if not forwarded and client_addr in activeUsers and client_addr not in pendingLogins:
+        owner = command_owner(parts)
+        if owner != cluster.index:
+            cluster.send(owner, "datagram", {"client": client_addr}, data)
+            return
+
+    # requests from reliable clients carry an id: a resent request is answered from the
+    # replies already sent for it, a new one gets a channel that records its replies
+    reply_sock = udp_sock
+    if request is not None:
+        request_id = request[0]
+        sent, is_new = responseCache.begin(client_addr, request_id)
+        if not is_new:
+            for datagram in sent or [protocol.encode_ack(request_id)]:
+                udp_sock.sendto(datagram, client_addr)
+            return
+        reply_sock = protocol.ReplyChannel(udp_sock, responseCache, client_addr, request_id)
+    if frame is not None:
+        reply_sock = protocol.FrameChannel(reply_sock, opcode, frame_id)
+    print(f"[recv] From {client_addr}: {message}")
+
+    # a client in the middle of logging in is sending its username or password
+    if client_addr in pendingLogins:
+        process_login_step(message, client_addr, reply_sock)
+        return
+
+    # if not logged in, need to login first
+    if client_addr not in activeUsers and not message == 'login':
+        reply_sock.sendto("Error: Please login first using: login".encode(), client_addr)
+        return
+
+    # login only records the session state here, the username and password are handled
+    # by process_login_step as they arrive, so other clients are never kept waiting
+    if message == 'login':
+        print("[recv] New login request")
+        process_login(client_addr, reply_sock)
+        return
+
+    try:
+        command_queue.put_nowait((parts, reply_sock, client_addr))
+    except queue.Full:
+        # the busy reply is not recorded, so resending the same request later runs it
+        if request is not None:
+            responseCache.forget(client_addr, request_id)
+        reply_sock.sendto("Error: Server busy, please try again later.".encode(), client_addr)
+        print(f"[busy] Rejected command from {client_addr}")
+
+# keep listening for UDP messages and hand user commands over to the worker threads
 def udp_listener():
     udp_sock = socket(AF_INET, SOCK_DGRAM)
+    if cluster.size > 1:
+        # every process binds the same port, the kernel spreads clients over them
+        udp_sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
     udp_sock.bind((serverHost, udpPort))
     print(f"UDP server listening on {serverHost}:{udpPort}...")
-    while True:
-        data, client_addr = udp_sock.recvfrom(2048)
-        message = data.decode().strip()
-        print(f"[recv] From {client_addr}: {message}")
 
-        # if not logged in, need to login first
-        if client_addr not in activeUsers and not message == 'login':
-            udp_sock.sendto("Please login first using: login".encode(), client_addr)
-            continue
+    tcp_sock = socket(AF_INET, SOCK_STREAM)
+    tcp_sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    tcp_sock.bind((serverHost, DATA_PORT + cluster.index))
+    tcp_sock.listen(128)
+    print(f"TCP data listener on {serverHost}:{DATA_PORT + cluster.index}...")
+
+    if writeAheadLog:
+        writeAheadLog.open("wal.log" if cluster.size == 1 else f"wal-{cluster.index}.log")
+
+    # each process indexes the threads it owns
+    searchIndex.load("search.index" if cluster.size == 1 else f"search-{cluster.index}.index")
+    indexed = searchIndex.sync(threadStore, [title for title in threadStore.catalog if cluster.owns(title)])
+    if indexed:
+        print(f"Indexed {indexed} threads for search")
+
+    for i in range(WORKER_COUNT):
+        threading.Thread(target=command_worker, name=f"worker-{i}", daemon=True).start()
+    print(f"Started {WORKER_COUNT} workers, queue depth {MAX_PENDING_COMMANDS}")
+    threading.Thread(target=maintenance_worker, name="maintenance", daemon=True).start()
+    threading.Thread(target=data_listener, args=(tcp_sock,), name="data-listener", daemon=True).start()
+    notifier.sock = udp_sock
+    notifier.origin = cluster.index
+    threading.Thread(target=notifier.run, name="notifier", daemon=True).start()
+
+    cluster.on("datagram", lambda peer, header, payload: handle_datagram(udp_sock, payload, tuple(header["client"]), forwarded=True))
+    cluster.on("session", session_shared)
+    cluster.on("catalog", catalog_shared)
+    cluster.on("search", search_asked)
+    cluster.start()
+
+    # wake up regularly even when no datagram arrives, so that housekeeping still runs
+    udp_sock.settimeout(HOUSEKEEPING_INTERVAL)
+    next_housekeeping = time.time() + HOUSEKEEPING_INTERVAL
 
-        if message == 'login':
-            print("[recv] New login request")
-            process_login(client_addr, udp_sock)
-        elif message.startswith("CRT "):
-            process_CRT(message, udp_sock, client_addr)
-        elif message.startswith("MSG "):
-            process_MSG(message, udp_sock, client_addr)
-        elif message.startswith("DLT "):
-            process_DLT(message, udp_sock, client_addr)
-        elif message.startswith("EDT "):
-            process_EDT(message, udp_sock, client_addr)
-        elif message.startswith("LST"):
-            process_LST(udp_sock, client_addr)
-        elif message.startswith("RDT "):
-            process_RDT(message, udp_sock, client_addr)
-        elif message.startswith("UPD "):
-            process_UPD(message, udp_sock, client_addr)
-        elif message.startswith("DWN "):
-            process_DWN(message, udp_sock, client_addr)
-        elif message.startswith("RMV "):
-            process_RMV(message, udp_sock, client_addr)
-        elif message.strip() == "XIT":
-            process_XIT(udp_sock, client_addr)
+    while True:
+        if time.time() >= next_housekeeping:
+            run_housekeeping()
+            next_housekeeping = time.time() + HOUSEKEEPING_INTERVAL
 
-        else:
-            udp_sock.sendto("Unrecognized command.".encode(), client_addr)
+        try:
+            data, client_addr = udp_sock.recvfrom(65535)
+        except timeout:
+            continue
+        except OSError as e:
+            # e.g. ICMP port unreachable from a client that has gone away
+            print(f"===== UDP receive error: {e}")
+            continue
 
+        # one bad datagram must not take the listener down
+        try:
+            handle_datagram(udp_sock, data, client_addr)
+        except Exception as e:
+            print(f"===== Error handling datagram from {client_addr}: {e}")
 
 if __name__ == "__main__":
     print("\n===== Server is running =====")
     print("===== Waiting for connection request from clients.=====")
-    udp_listener()
+    # turn a termination signal into a normal exit, so buffered state is written out below
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    imported = attachmentStore.import_legacy(".", threadStore.catalog)
+    if imported:
+        print(f"Moved {imported} uploaded files into the attachment store")
+    # every process opens its own database connection and thread files
+    threadStore.close()
+    if cluster.fork():
+        print(f"===== Process {cluster.index} of {cluster.size} started =====")
+    try:
+        udp_listener()
+    finally:
+        # write out registrations and thread counters that are still buffered
+        credentialStore.flush()
+        save_thread_metadata()
+        save_search_index()
+        report_read_cache()
+        if writeAheadLog and writeAheadLog.file:
+            checkpoint_threads()
+        threadStore.close()
+        cluster.stop()
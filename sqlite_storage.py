@@ -0,0 +1,356 @@
+import contextlib
+import sqlite3
+import threading
+import time
+
+from storage import BaseThreadStore, ThreadMeta, new_epoch
+
+# the forum kept in one SQLite database instead of thread files and credentials.txt. The database is
+# in WAL mode, so reads do not wait for writes and several server processes can share it. Statements
+# are parameterized and prepared once per connection (sqlite3 keeps them in its statement cache).
+# Message numbers are stored with the lines, so a page or a single message is an index lookup;
+# a delete renumbers the lines after it
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS credentials (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS threads (
+    title TEXT PRIMARY KEY,
+    creator TEXT NOT NULL,
+    created REAL NOT NULL,
+    modified REAL NOT NULL,
+    messages INTEGER NOT NULL DEFAULT 0,
+    uploads INTEGER NOT NULL DEFAULT 0,
+    max_id INTEGER NOT NULL DEFAULT 0,
+    garbage INTEGER NOT NULL DEFAULT 0,
+    epoch TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE IF NOT EXISTS records (
+    thread TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    id INTEGER,
+    user TEXT,
+    line TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    PRIMARY KEY (thread, number)
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX IF NOT EXISTS records_id ON records (thread, id);
+CREATE INDEX IF NOT EXISTS records_version ON records (thread, version);
+CREATE TABLE IF NOT EXISTS deletions (
+    thread TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    version INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deletions_version ON deletions (thread, version);
+"""
+
+# records: the live lines of every thread, number is the message number users see, id the stable
+# message id (NULL for uploads), line "{user}: {text}" or the upload line, version the thread version
+# that wrote it last. deletions: ids of deleted messages, so read_changes can tell clients what to drop;
+# garbage counts them until a compaction drops them.
+# Every change bumps the version of its thread, which (with the epoch) plays the part the file size
+# plays for thread files
+THREAD_COLUMNS = "creator, created, modified, messages, uploads, max_id, garbage, epoch, version"
+
+def thread_meta(row):
+    meta = ThreadMeta(row[0])
+    meta.created, meta.modified, meta.messages, meta.uploads, meta.max_id, meta.garbage, meta.epoch, meta.size = row[1:]
+    meta.appended = meta.messages + meta.uploads
+    meta.dirty = False
+    return meta
+
+# one connection per process, behind one lock that serializes every statement, reads included, and
+# every commit: nothing else runs while a commit waits for its fsync. Changes collect in one open
+# transaction until commit(), which makes all of them durable at once, so a thread whose change was
+# already committed by another thread's commit() returns without an fsync of its own
+class Database:
+    def __init__(self, path, timeout=10.0):
+        self.path = path
+        self.timeout = timeout      # seconds to wait for another process's write to finish
+        self.lock = threading.RLock()
+        self.conn = None
+
+    # opened on first use, so a forked process opens its own
+    def connection(self):
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            conn.executescript(SCHEMA)
+            self.conn = conn
+        return self.conn
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.connection().execute(sql, params).fetchall()
+
+    def query_one(self, sql, params=()):
+        with self.lock:
+            return self.connection().execute(sql, params).fetchone()
+
+    # a change made with the connection this yields is applied completely or not at all, as part of
+    # the open transaction
+    @contextlib.contextmanager
+    def change(self):
+        with self.lock:
+            conn = self.connection()
+            if not conn.in_transaction:
+                conn.execute("BEGIN IMMEDIATE")
+            conn.execute("SAVEPOINT change")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK TO change")
+                conn.execute("RELEASE change")
+                raise
+            conn.execute("RELEASE change")
+
+    # make every change so far durable, the other threads' included
+    def commit(self):
+        with self.lock:
+            if self.conn is not None and self.conn.in_transaction:
+                self.conn.commit()
+
+    # commit and close the connection, e.g. before forking: processes must not share one
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.commit()
+                self.conn.close()
+                self.conn = None
+
+# credentials in the database; every registration is committed at once, and the primary key keeps
+# usernames unique across processes
+class SQLiteCredentialStore:
+    def __init__(self, database):
+        self.database = database
+
+    def check_for_changes(self):
+        pass
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def get(self, username):
+        row = self.database.query_one("SELECT password FROM credentials WHERE username = ?", (username,))
+        return row[0] if row else None
+
+    def items(self):
+        return self.database.query("SELECT username, password FROM credentials ORDER BY rowid")
+
+    # add a new user, returns False if the username is already taken
+    def register(self, username, password):
+        try:
+            with self.database.change() as conn:
+                conn.execute("INSERT INTO credentials (username, password) VALUES (?, ?)", (username, password))
+        except sqlite3.IntegrityError:
+            return False
+        self.database.commit()
+        return True
+
+    def flush(self):
+        self.database.commit()
+
+    def flush_if_due(self):
+        pass
+
+# threads in the database, see BaseThreadStore for what each method does
+class SQLiteThreadStore(BaseThreadStore):
+    def __init__(self, database, compact_min_garbage=1000, index=None):
+        BaseThreadStore.__init__(self, index)
+        self.database = database
+        self.compact_min_garbage = compact_min_garbage
+        self.catalog = {title for title, in database.query("SELECT title FROM threads")}
+
+    def meta(self, title):
+        row = self.database.query_one(f"SELECT {THREAD_COLUMNS} FROM threads WHERE title = ?", (title,))
+        if row is None:
+            raise FileNotFoundError(title)
+        return thread_meta(row)
+
+    # the database is shared, so another process's thread reads the same as our own
+    def peek_meta(self, title):
+        row = self.database.query_one(f"SELECT {THREAD_COLUMNS} FROM threads WHERE title = ?", (title,))
+        return thread_meta(row) if row else ThreadMeta(None)
+
+    # count a change to a thread in its counters and bump its version; returns (max id, number of
+    # lines, version) afterwards
+    def touch(self, conn, title, messages=0, uploads=0, max_id=0, garbage=0):
+        now = time.time()
+        conn.execute("UPDATE threads SET messages = messages + ?, uploads = uploads + ?, max_id = max_id + ?, "
+                     "garbage = garbage + ?, version = version + 1, modified = ? WHERE title = ?",
+                     (messages, uploads, max_id, garbage, now, title))
+        self.times[title] = (self.thread_times(title)[0], now)
+        return conn.execute("SELECT max_id, messages + uploads, version FROM threads WHERE title = ?", (title,)).fetchone()
+
+    def version(self, title):
+        return "%s:%d" % self.database.query_one("SELECT epoch, version FROM threads WHERE title = ?", (title,))
+
+    def create(self, title, creator):
+        now = time.time()
+        try:
+            with self.database.change() as conn:
+                conn.execute("INSERT INTO threads (title, creator, created, modified, epoch) VALUES (?, ?, ?, ?, ?)",
+                             (title, creator, now, now, new_epoch()))
+        except sqlite3.IntegrityError:
+            raise FileExistsError(title)
+        self.catalog.add(title)
+        self.times[title] = (now, now)
+        if self.index:
+            self.index.set_version(title, self.version(title))
+
+    def remove(self, title):
+        self.catalog.discard(title)
+        self.times.pop(title, None)
+        with self.database.change() as conn:
+            conn.execute("DELETE FROM records WHERE thread = ?", (title,))
+            conn.execute("DELETE FROM deletions WHERE thread = ?", (title,))
+            conn.execute("DELETE FROM threads WHERE title = ?", (title,))
+        if self.index:
+            self.index.remove_thread(title)
+
+    def creator(self, title):
+        return self.database.query_one("SELECT creator FROM threads WHERE title = ?", (title,))[0]
+
+    def message_count(self, title):
+        return self.database.query_one("SELECT messages + uploads FROM threads WHERE title = ?", (title,))[0]
+
+    def message_author(self, title, number):
+        message_id, user = self.database.query_one("SELECT id, user FROM records WHERE thread = ? AND number = ?", (title, number))
+        return user if message_id is not None else None
+
+    def post_message(self, title, username, text):
+        with self.database.change() as conn:
+            message_id, number, version = self.touch(conn, title, messages=1, max_id=1)
+            conn.execute("INSERT INTO records (thread, number, id, user, line, version) VALUES (?, ?, ?, ?, ?, ?)",
+                         (title, number, message_id, username, f"{username}: {text}", version))
+        if self.index:
+            self.index.add(title, message_id, username, text, self.version(title))
+        return number
+
+    def edit_message(self, title, number, username, text):
+        with self.database.change() as conn:
+            message_id, = conn.execute("SELECT id FROM records WHERE thread = ? AND number = ?", (title, number)).fetchone()
+            version = self.touch(conn, title)[2]
+            conn.execute("UPDATE records SET user = ?, line = ?, version = ? WHERE thread = ? AND number = ?",
+                         (username, f"{username}: {text}", version, title, number))
+        if self.index:
+            self.index.add(title, message_id, username, text, self.version(title))
+
+    def delete_message(self, title, number):
+        with self.database.change() as conn:
+            message_id, = conn.execute("SELECT id FROM records WHERE thread = ? AND number = ?", (title, number)).fetchone()
+            version = self.touch(conn, title, messages=-1, garbage=1)[2]
+            conn.execute("DELETE FROM records WHERE thread = ? AND number = ?", (title, number))
+            # shift the later lines down by one in two steps, as (thread, number) must stay unique throughout.
+            # This rewrites every line after the deleted one (twice), so a DLT costs time in proportion
+            # to the lines that follow it, where the thread files append one line whatever its position
+            conn.execute("UPDATE records SET number = -number WHERE thread = ? AND number > ?", (title, number))
+            conn.execute("UPDATE records SET number = -number - 1 WHERE thread = ? AND number < 0", (title,))
+            conn.execute("INSERT INTO deletions (thread, id, version) VALUES (?, ?, ?)", (title, message_id, version))
+        if self.index:
+            self.index.remove(title, message_id, self.version(title))
+
+    def add_upload(self, title, username, filename):
+        with self.database.change() as conn:
+            _, number, version = self.touch(conn, title, uploads=1)
+            conn.execute("INSERT INTO records (thread, number, id, user, line, version) VALUES (?, ?, NULL, ?, ?, ?)",
+                         (title, number, username, f"{username} uploaded {filename}", version))
+        if self.index:
+            self.index.set_version(title, self.version(title))
+
+    def read_thread(self, title, offset=0, count=None):
+        end = offset + count if count is not None else self.message_count(title)
+        rows = self.database.query("SELECT number, id, line FROM records WHERE thread = ? AND number > ? AND number <= ? "
+                                   "ORDER BY number", (title, offset, end))
+        return b"".join((f"{number} {line}\n" if message_id is not None else f"{line}\n").encode()
+                        for number, message_id, line in rows)
+
+    def read_changes(self, title, since):
+        epoch, version = self.database.query_one("SELECT epoch, version FROM threads WHERE title = ?", (title,))
+        reset = False
+        deleted = []
+        if since.isdigit():
+            rows = self.database.query("SELECT number, id, line FROM records WHERE thread = ? AND number > ? "
+                                       "ORDER BY number", (title, int(since)))
+        else:
+            since_epoch, _, base = since.partition(":")
+            base = int(base) if base.isdigit() else 0
+            if since_epoch != epoch or not 0 < base <= version:
+                reset, base = True, 0
+            rows = self.database.query("SELECT number, id, line FROM records WHERE thread = ? AND version > ? "
+                                       "ORDER BY number", (title, base))
+            if base:
+                deleted = [message_id for message_id, in self.database.query(
+                    "SELECT id FROM deletions WHERE thread = ? AND version > ? ORDER BY version", (title, base))]
+
+        out = []
+        for number, message_id, line in rows:
+            out.append(f"{number} {'-' if message_id is None else message_id} {line}\n".encode())
+        return f"{epoch}:{version}", reset, b"".join(out), deleted
+
+    def records(self, title):
+        return self.database.query("SELECT id, user, line FROM records WHERE thread = ? ORDER BY number", (title,))
+
+    def messages(self, title):
+        for message_id, user, line in self.records(title):
+            if message_id is not None:
+                yield message_id, user, line.split(": ", 1)[1]
+
+    def find_message(self, title, message_id):
+        row = self.database.query_one("SELECT number, line FROM records WHERE thread = ? AND id = ?", (title, message_id))
+        return tuple(row) if row else None
+
+    def begin_batch(self, title):
+        self.batches.add(title)
+
+    def end_batch(self, title):
+        self.batches.discard(title)
+        self.commit()
+
+    def commit(self, title=None):
+        if title not in self.batches:
+            self.database.commit()
+
+    # counters are written with every change, there is nothing to save later
+    def dirty_metadata(self):
+        return []
+
+    def save_metadata(self, title):
+        pass
+
+    def threads_needing_compaction(self):
+        return [title for title, in self.database.query("SELECT title FROM threads WHERE garbage >= ?",
+                                                         (self.compact_min_garbage,))]
+
+    # forget the recorded deletions; the new epoch makes clients holding an older version read the whole thread
+    def compact(self, title):
+        with self.database.change() as conn:
+            garbage, = conn.execute("SELECT garbage FROM threads WHERE title = ?", (title,)).fetchone()
+            if garbage < self.compact_min_garbage:
+                return
+            conn.execute("DELETE FROM deletions WHERE thread = ?", (title,))
+            conn.execute("UPDATE threads SET garbage = 0, epoch = ? WHERE title = ?", (new_epoch(), title))
+        self.database.commit()
+        print(f"[compact] Thread '{title}': dropped {garbage} deletion records")
+        if self.index:
+            self.index.set_version(title, self.version(title))
+
+    def restore(self, title, creator, created, modified, records):
+        records = list(records)
+        ids = [message_id for message_id, _, _ in records if message_id is not None]
+        with self.database.change() as conn:
+            conn.execute("INSERT INTO threads (title, creator, created, modified, messages, uploads, max_id, epoch) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                         (title, creator, created, modified, len(ids), len(records) - len(ids), max(ids, default=0), new_epoch()))
+            conn.executemany("INSERT INTO records (thread, number, id, user, line, version) VALUES (?, ?, ?, ?, ?, 1)",
+                             [(title, number, message_id, user, line)
+                              for number, (message_id, user, line) in enumerate(records, 1)])
+        self.database.commit()
+        self.catalog.add(title)
+        self.times[title] = (created, modified)
+
+    def close(self):
+        self.database.close()
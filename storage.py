@@ -0,0 +1,1476 @@
+import collections
+import contextlib
+import fcntl
+import heapq
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+
+from protocol import file_sha256
+
+# an exclusive lock on a file, for state that several server processes share
+@contextlib.contextmanager
+def file_lock(path):
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+# user credentials kept in memory: loaded once from the credentials file, new registrations are
+# appended to the file in batches, and the file is reloaded when it is edited by hand.
+# A shared store is written by several processes: each registration is written at once, under a
+# lock on the file, after catching up with what the others wrote
+class CredentialStore:
+    def __init__(self, path, flush_interval=1.0, shared=False):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.credentials = {}
+        self.pending = []           # registrations not written to the file yet
+        self.signature = None       # (mtime, size) of the file when it was last read or written
+        self.last_flush = time.time()
+        self.reload()
+
+    def file_signature(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    # read the whole credentials file, one "username password" pair per line
+    def reload(self):
+        with self.lock:
+            credentials = {}
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
+                    for line in f:
+                        parts = line.strip().split(' ', 1)
+                        if len(parts) == 2:
+                            credentials[parts[0]] = parts[1]
+
+            # registrations still waiting to be written are not in the file yet, keep them
+            for username, password in self.pending:
+                credentials[username] = password
+            self.credentials = credentials
+            self.signature = self.file_signature()
+
+    # reload the file if someone else changed it since we last read or wrote it
+    def check_for_changes(self):
+        if self.file_signature() != self.signature:
+            self.reload()
+            print(f"[credentials] Reloaded {self.path}, {len(self.credentials)} users")
+
+    def __contains__(self, username):
+        return username in self.credentials
+
+    def get(self, username):
+        return self.credentials.get(username)
+
+    # every (username, password), for copying them to another store
+    def items(self):
+        with self.lock:
+            return list(self.credentials.items())
+
+    # add a new user, returns False if the username is already taken
+    def register(self, username, password):
+        with file_lock(self.path + ".lock") if self.shared else contextlib.nullcontext():
+            if self.shared:
+                self.check_for_changes()
+            with self.lock:
+                if username in self.credentials:
+                    return False
+                self.credentials[username] = password
+                self.pending.append((username, password))
+
+            if self.flush_interval <= 0 or self.shared:
+                self.flush()
+        return True
+
+    # append all pending registrations to the file with a single write and fsync
+    def flush(self):
+        with self.lock:
+            self.last_flush = time.time()
+            if not self.pending:
+                return
+            lines = "".join(f"{username} {password}\n" for username, password in self.pending)
+            with open(self.path, 'a') as f:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self.pending = []
+            self.signature = self.file_signature()
+
+    def flush_if_due(self):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+
+# one live line of a thread: a message (with its stable id) or an upload/other line (id None)
+class ThreadRecord:
+    __slots__ = ("id", "user", "offset")
+
+    def __init__(self, id, user, offset):
+        self.id = id
+        self.user = user
+        self.offset = offset
+
+# in-memory index of one thread file, only built for commands that need to look at old lines
+class ThreadLog:
+    def __init__(self):
+        self.records = []       # live records in display order, message number n is records[n - 1]
+        self.by_id = {}         # stable message id -> record
+        self.numbers = None     # record -> message number, built on first use and dropped when a record is deleted
+
+    def number(self, record):
+        if self.numbers is None:
+            self.numbers = {record: number for number, record in enumerate(self.records, 1)}
+        return self.numbers[record]
+
+    def add(self, record):
+        self.records.append(record)
+        if self.numbers is not None:
+            self.numbers[record] = len(self.records)
+
+# per-thread counters, kept in memory and saved next to the thread file as "{title}.meta", so
+# posting to a thread never has to read it
+class ThreadMeta:
+    FIELDS = ("creator", "messages", "uploads", "created", "modified", "max_id", "appended", "garbage", "size", "epoch")
+
+    def __init__(self, creator):
+        self.creator = creator
+        self.messages = 0       # live messages
+        self.uploads = 0        # upload (and other non-message) lines
+        self.created = time.time()
+        self.modified = self.created
+        self.max_id = 0
+        self.appended = 0       # messages and uploads ever appended, used to pick the next id
+        self.garbage = 0        # lines on disk that are no longer shown (old versions, deleted, tombstones)
+        self.size = 0           # file size, i.e. the offset of the next appended line
+        self.epoch = new_epoch()    # changes when the file is rewritten, so old offsets into it are no longer valid
+        self.dirty = True       # changed since the sidecar was last written
+
+    def next_id(self):
+        # same as the line number the message would have had in the old rewrite-the-file format
+        return max(self.max_id, self.appended) + 1
+
+    def changed(self):
+        self.modified = time.time()
+        self.dirty = True
+
+    # every change appends to the file, so its size (within one epoch) orders the versions of a thread
+    def version(self):
+        return f"{self.epoch}:{self.size}"
+
+    def to_json(self):
+        return json.dumps({field: getattr(self, field) for field in self.FIELDS})
+
+    @classmethod
+    def from_json(cls, text):
+        values = json.loads(text)
+        meta = cls(values["creator"])
+        meta.created = values.get("created", values["modified"])
+        for field in cls.FIELDS:
+            if field != "created":
+                # sidecars written before a field existed keep its default
+                setattr(meta, field, values.get(field, getattr(meta, field)))
+        meta.dirty = False
+        return meta
+
+def new_epoch():
+    return "%08x" % random.getrandbits(32)
+
+# the full line (with its newline) starting at offset
+def line_at(data, offset):
+    end = data.find(b"\n", offset)
+    if end == -1:
+        return data[offset:] + b"\n"
+    return data[offset:end + 1]
+
+# the rest of an open file from offset, read without moving its position (so a handle can be shared)
+def read_from(f, offset=0):
+    fd = f.fileno()
+    size = os.fstat(fd).st_size
+    chunks = []
+    while offset < size:
+        chunk = os.pread(fd, size - offset, offset)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        offset += len(chunk)
+    return b"".join(chunks)
+
+# the full line (with its newline) starting at offset of an open file
+def read_line(f, offset, chunk_size=4096):
+    line = b""
+    while True:
+        chunk = os.pread(f.fileno(), chunk_size, offset + len(line))
+        if not chunk:
+            return line + b"\n"
+        end = chunk.find(b"\n")
+        if end != -1:
+            return line + chunk[:end + 1]
+        line += chunk
+
+# thread titles are plain file names without an extension (files with one are sidecars, uploads, ...)
+def is_valid_title(title):
+    return (is_valid_name(title) and not title.startswith(".") and os.path.splitext(title)[1] == "")
+
+# a thread title or file name is one word: no whitespace, control characters or path separators
+def is_valid_name(name):
+    return (name != "" and name.isprintable() and not any(c.isspace() for c in name)
+            and "/" not in name and "\\" not in name)
+
+# split a message line "{id} {user}: {text}" into (id, user), or None for any other line
+def parse_message_line(line):
+    parts = line.split(b" ", 1)
+    if len(parts) != 2 or not parts[0].isdigit():
+        return None
+    user = parts[1].split(b": ", 1)
+    if len(user) != 2:
+        return None
+    user = user[0].decode(errors="replace")
+    if not is_valid_username(user):
+        return None
+    return int(parts[0]), user
+
+# the uploader of an upload line "{user} uploaded {file}", or None for any other line
+def parse_upload_line(line):
+    parts = line.split(b" ", 2)
+    if len(parts) != 3 or parts[1] != b"uploaded" or not parts[2]:
+        return None
+    user = parts[0].decode(errors="replace")
+    return user if is_valid_username(user) else None
+
+# a user name is one word that cannot be mistaken for another part of a thread line ("{id} {user}: ",
+# "!DLT {id}"), so a user cannot forge lines of someone else
+def is_valid_username(name):
+    return is_valid_name(name) and ":" not in name and not name.startswith("!")
+
+# number of thread locks a store has, see BaseThreadStore
+LOCK_STRIPES = 1024
+
+# what the server needs from a thread store, whichever way it keeps the threads: ThreadStore below keeps
+# them in files, SQLiteThreadStore (sqlite_storage.py) in a database. Besides the methods here:
+#   create, remove, creator, message_count, message_author     the thread and who wrote what
+#   post_message, edit_message, delete_message, add_upload      changes
+#   read_thread, read_changes, messages, find_message           reading it back
+#   meta, peek_meta             counters (a ThreadMeta), whose version() orders the changes of a thread
+#   version                     just that version, if the store can tell it without loading the thread
+#   begin_batch, end_batch, commit      grouping changes, and making them durable before a reply
+#   dirty_metadata, save_metadata, threads_needing_compaction, compact      background maintenance
+#   restore, close              writing a whole thread (migrate.py), letting go of open resources
+# Callers must hold lock(title) around every call that names a thread.
+class BaseThreadStore:
+    def __init__(self, index=None):
+        self.catalog = set()    # titles of all threads, so lookups never touch the disk
+        # so commands on one thread never interleave: a fixed table of locks, each title uses the one
+        # its hash picks, so titles clients make up cost no memory. Titles may share a lock, code that
+        # holds several at once takes them in lock_order
+        self.locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+        self.batches = set()    # titles of the threads inside a batch of commands
+        self.index = index      # SearchIndex told about every change, or None
+        # title -> (created, last change), for listing threads from memory; set by every change, and
+        # read once from the saved counters for threads not changed since the start
+        self.times = {}
+
+    def lock_order(self, title):
+        return zlib.crc32(title.encode()) % len(self.locks)
+
+    def lock(self, title):
+        return self.locks[self.lock_order(title)]
+
+    # version of a thread (what meta(title).version() gives), None if it cannot be told without
+    # loading the thread; stores that can do it cheaper override this
+    def version(self, title):
+        return self.meta(title).version()
+
+    # counters of a thread, taking its lock; for callers that do not hold it already
+    def locked_meta(self, title):
+        with self.lock(title):
+            return self.meta(title)
+
+    def exists(self, title):
+        return title in self.catalog
+
+    # (created, last change) of a thread, without loading it (or taking its lock)
+    def thread_times(self, title):
+        times = self.times.get(title)
+        if times is None:
+            meta = self.peek_meta(title)
+            # a change made meanwhile has set newer times, keep those
+            times = self.times.setdefault(title, (meta.created, meta.modified))
+        return times
+
+    # thread titles sorted by "name", "created" (oldest first) or "activity" (most recently changed first);
+    # times gives (created, last change) of a thread, thread_times unless the caller knows better
+    def list_threads(self, order="name", times=None):
+        times = times or self.thread_times
+        titles = list(self.catalog)
+        if order == "created":
+            return sorted(titles, key=lambda title: (times(title)[0], title))
+        if order == "activity":
+            return sorted(titles, key=lambda title: (-times(title)[1], title))
+        return sorted(titles)
+
+    def close(self):
+        pass
+
+# thread files as append-only logs. The first line is the creator, then one line per record:
+#   "{id} {user}: {text}"   a message; a later line with the same id is an edit of it
+#   "{user} uploaded {file}" an upload record
+#   "!DLT {id}"              the message with this id was deleted
+# ids are stable, the message numbers users see are positions among the live records and are
+# worked out when the thread is read, so MSG, EDT and DLT each append exactly one line.
+# Threads are loaded when first used and their files kept open, within budgets: at most max_threads
+# threads' counters and max_records parsed lines in memory, and max_open_files open files. Beyond
+# them the least recently used threads are dropped, saving their counters first if they changed;
+# a thread that is in use (its lock is taken) or inside a batch is never dropped
+class ThreadStore(BaseThreadStore):
+    def __init__(self, root=".", compact_min_garbage=1000, index=None, wal=None,
+                 max_threads=10000, max_records=500000, max_open_files=256):
+        BaseThreadStore.__init__(self, index)
+        self.root = root
+        self.compact_min_garbage = compact_min_garbage
+        self.threads = {}       # title -> ThreadLog, built on first access that needs it
+        self.metas = collections.OrderedDict()  # title -> ThreadMeta, least recently used first
+        self.files = collections.OrderedDict()  # title -> thread file kept open, least recently used first
+        self.cached_records = 0     # records in the ThreadLogs in memory
+        self.cache_lock = threading.Lock()      # guards the three above
+        self.max_threads = max_threads
+        self.max_records = max_records
+        self.max_open_files = max_open_files
+        self.wal = wal          # WriteAheadLog every write goes through first, or None
+        self.scan_catalog()
+
+    def path(self, title):
+        return os.path.join(self.root, title)
+
+    def meta_path(self, title):
+        return self.path(title) + ".meta"
+
+    # build the catalog once: thread files are the files without an extension in the directory
+    def scan_catalog(self):
+        catalog = set()
+        for entry in os.scandir(self.root):
+            if entry.is_file() and is_valid_title(entry.name):
+                catalog.add(entry.name)
+        self.catalog = catalog
+
+    # the thread file open for reading and appending, kept open for the next command on the thread.
+    # It is unbuffered, so every write reaches the file at once, and read with pread only
+    def file(self, title):
+        with self.cache_lock:
+            f = self.files.get(title)
+            if f is not None:
+                self.files.move_to_end(title)
+                return f
+        f = open(self.path(title), "a+b", buffering=0)
+        with self.cache_lock:
+            self.files[title] = f
+        self.trim(title)
+        return f
+
+    def close_file(self, title):
+        with self.cache_lock:
+            f = self.files.pop(title, None)
+        if f is not None:
+            f.close()
+
+    # keep the counters (and the ThreadLog, if there is one) of a thread in memory as most recently used
+    def remember(self, title, meta, log=None):
+        with self.cache_lock:
+            self.metas[title] = meta
+            self.metas.move_to_end(title)
+            if log is not None:
+                old_log = self.threads.get(title)
+                self.cached_records += len(log.records) - (len(old_log.records) if old_log else 0)
+                self.threads[title] = log
+        self.trim(title)
+
+    def count_records(self, title, change):
+        with self.cache_lock:
+            if title in self.threads:
+                self.cached_records += change
+
+    # drop the least recently used threads and files while over budget; current is the thread the
+    # caller is working on. Threads that are in use are skipped, so this may stay over budget for a while
+    def trim(self, current, batch=32):
+        with self.cache_lock:
+            files = titles = []
+            if len(self.files) > self.max_open_files:
+                files = list(itertools.islice(self.files, len(self.files) - self.max_open_files + batch))
+            if len(self.metas) > self.max_threads or self.cached_records > self.max_records:
+                titles = list(itertools.islice(self.metas, max(0, len(self.metas) - self.max_threads) + batch))
+
+        for title in files:
+            if len(self.files) <= self.max_open_files:
+                break
+            if title != current and title not in self.batches:
+                with self.try_lock(title) as locked:
+                    if locked:
+                        self.close_file(title)
+
+        for title in titles:
+            if len(self.metas) <= self.max_threads and self.cached_records <= self.max_records:
+                break
+            if title != current and title not in self.batches:
+                with self.try_lock(title) as locked:
+                    if locked:
+                        self.evict(title)
+
+    # take the lock of a thread if no other thread of the server holds it
+    @contextlib.contextmanager
+    def try_lock(self, title):
+        lock = self.lock(title)
+        locked = lock.acquire(blocking=False)
+        try:
+            yield locked
+        finally:
+            if locked:
+                lock.release()
+
+    # forget a thread until it is used again, saving its counters if they changed
+    def evict(self, title):
+        try:
+            self.save_metadata(title)
+        except OSError as e:
+            print(f"===== Error saving metadata of '{title}': {e}")
+            return
+        self.close_file(title)
+        with self.cache_lock:
+            self.metas.pop(title, None)
+            log = self.threads.pop(title, None)
+            if log is not None:
+                self.cached_records -= len(log.records)
+
+    # counters of a thread: from memory, else from its sidecar if that matches the thread file,
+    # else rebuilt by scanning the file
+    def meta(self, title):
+        with self.cache_lock:
+            meta = self.metas.get(title)
+            if meta is not None:
+                self.metas.move_to_end(title)
+                return meta
+
+        meta = self.saved_meta(title)
+        try:
+            if meta is not None and meta.size == os.path.getsize(self.path(title)):
+                self.remember(title, meta)
+                return meta
+        except OSError:
+            pass
+
+        self.load(title)
+        return self.metas[title]
+
+    # counters of a thread read without loading (or caching) anything: from memory if it is loaded,
+    # else as last saved to its sidecar, else just the times of its file
+    def peek_meta(self, title):
+        with self.cache_lock:
+            meta = self.metas.get(title)
+        if meta is not None:
+            return meta
+        meta = self.saved_meta(title)
+        if meta is None:
+            meta = ThreadMeta(None)
+            try:
+                meta.created = meta.modified = os.path.getmtime(self.path(title))
+            except OSError:
+                pass
+        return meta
+
+    # the version from the counters in memory, else from the sidecar's epoch and the file's size (what
+    # load would make of them); None if the sidecar is missing or from before the file was rewritten
+    def version(self, title):
+        with self.cache_lock:
+            meta = self.metas.get(title)
+        if meta is not None:
+            return meta.version()
+        meta = self.saved_meta(title)
+        try:
+            size = os.path.getsize(self.path(title))
+        except OSError:
+            return None
+        if meta is None or meta.size > size:
+            return None
+        return f"{meta.epoch}:{size}"
+
+    # the counters last saved to the sidecar, None if there is none (or it cannot be read)
+    def saved_meta(self, title):
+        try:
+            with open(self.meta_path(title), "r") as f:
+                return ThreadMeta.from_json(f.read())
+        except (OSError, ValueError, KeyError):
+            return None
+
+    # build the index (and the counters) of a thread with one pass over its file
+    def load(self, title):
+        with self.cache_lock:
+            log = self.threads.get(title)
+            if log is not None:
+                self.metas.move_to_end(title)
+                return log
+
+        f = self.file(title)
+        data = read_from(f)
+
+        # a file edited by hand may miss its final newline, add it so appended lines start on their own line
+        if not data.endswith(b"\n"):
+            f.write(b"\n")
+            if self.wal:
+                self.wal.append(self.path(title), len(data), b"\n")
+            data += b"\n"
+
+        end = data.find(b"\n")
+        log = ThreadLog()
+        meta = ThreadMeta(data[:end].decode().strip())
+        offset = end + 1
+        records = []
+
+        while offset < len(data):
+            end = data.find(b"\n", offset)
+            line = data[offset:end]
+
+            if line.startswith(b"!DLT ") and line[5:].isdigit():
+                record = log.by_id.pop(int(line[5:]), None)
+                if record is not None:
+                    record.offset = None    # marks it deleted
+                    meta.messages -= 1
+                    meta.garbage += 1
+                meta.garbage += 1
+            else:
+                message = parse_message_line(line)
+                if message is not None and message[0] in log.by_id:
+                    # an edit: the record now points at the newest version. Only the author edits a
+                    # message, a line claiming another user is not one this server wrote
+                    if log.by_id[message[0]].user == message[1]:
+                        log.by_id[message[0]].offset = offset
+                    meta.garbage += 1
+                elif message is not None:
+                    record = ThreadRecord(message[0], message[1], offset)
+                    log.by_id[record.id] = record
+                    meta.max_id = max(meta.max_id, record.id)
+                    meta.appended += 1
+                    meta.messages += 1
+                    records.append(record)
+                elif parse_upload_line(line) is not None:
+                    records.append(ThreadRecord(None, parse_upload_line(line), offset))
+                    meta.appended += 1
+                    meta.uploads += 1
+                elif line.strip():
+                    # not a line of the format above (e.g. a hand edit gone wrong): left out of the thread
+                    meta.garbage += 1
+            offset = end + 1
+
+        log.records = [record for record in records if record.offset is not None]
+        meta.size = len(data)
+
+        # the counters from the scan are authoritative, but keep the time of the last change and the epoch
+        old_meta = self.metas.get(title) or self.saved_meta(title)
+        if old_meta:
+            meta.created, meta.modified = old_meta.created, old_meta.modified
+            # a sidecar for a longer file is from before the file was rewritten, versions from then are stale
+            if old_meta.size <= meta.size:
+                meta.epoch = old_meta.epoch
+        else:
+            meta.created = meta.modified = os.path.getmtime(self.path(title))
+        meta.dirty = old_meta is None or old_meta.to_json() != meta.to_json()
+
+        self.remember(title, meta, log)
+        return log
+
+    def append(self, title, meta, line):
+        data = line.encode()
+        f = self.file(title)
+        written = 0
+        while written < len(data):
+            written += f.write(data[written:])
+        # logged after the write, so a checkpoint that sees the record also finds the data in the file
+        if self.wal:
+            self.wal.append(self.path(title), meta.size, data)
+        offset = meta.size
+        meta.size += len(data)
+        meta.changed()
+        self.times[title] = (meta.created, meta.modified)
+        return offset
+
+    # writes to a thread between begin_batch and end_batch share one commit at the end, and the thread
+    # stays in memory meanwhile; the caller holds lock(title) for the whole batch
+    def begin_batch(self, title):
+        self.batches.add(title)
+
+    def end_batch(self, title):
+        self.batches.discard(title)
+        self.commit()
+
+    # wait until every change made so far is durable: one group commit of the write-ahead log. Inside a
+    # batch this is left to end_batch, so the batch is committed once
+    def commit(self, title=None):
+        if self.wal and title not in self.batches:
+            self.wal.commit()
+
+    # create a new thread file, raises FileExistsError rather than overwriting any existing file
+    def create(self, title, creator):
+        # The first line of the thread file should be the username of the creator
+        data = f"{creator}\n".encode()
+        with open(self.path(title), "xb") as f:
+            f.write(data)
+        if self.wal:
+            self.wal.append(self.path(title), 0, data)
+        meta = ThreadMeta(creator)
+        meta.size = len(data)
+        self.catalog.add(title)
+        self.times[title] = (meta.created, meta.modified)
+        self.remember(title, meta, ThreadLog())
+        if self.index:
+            self.index.set_version(title, meta.version())
+
+    def remove(self, title):
+        self.catalog.discard(title)
+        self.times.pop(title, None)
+        self.close_file(title)
+        with self.cache_lock:
+            log = self.threads.pop(title, None)
+            if log is not None:
+                self.cached_records -= len(log.records)
+            self.metas.pop(title, None)
+        os.remove(self.path(title))
+        if os.path.exists(self.meta_path(title)):
+            os.remove(self.meta_path(title))
+        if self.wal:
+            self.wal.remove(self.path(title))
+        if self.index:
+            self.index.remove_thread(title)
+
+    def creator(self, title):
+        return self.meta(title).creator
+
+    # number of numbered lines in the thread; uploads take a number too, as they always did
+    def message_count(self, title):
+        meta = self.meta(title)
+        return meta.messages + meta.uploads
+
+    # author of message number n, None if that line is not a message
+    def message_author(self, title, number):
+        record = self.load(title).records[number - 1]
+        return record.user if record.id is not None else None
+
+    # append a new message and return its message number; only touches the counters, so the
+    # cost does not depend on the size of the thread
+    def post_message(self, title, username, text):
+        meta = self.meta(title)
+        message_id = meta.next_id()
+        offset = self.append(title, meta, f"{message_id} {username}: {text}\n")
+        meta.max_id = message_id
+        meta.appended += 1
+        meta.messages += 1
+
+        log = self.threads.get(title)
+        if log is not None:
+            record = ThreadRecord(message_id, username, offset)
+            log.by_id[message_id] = record
+            log.add(record)
+            self.count_records(title, 1)
+        if self.index:
+            self.index.add(title, message_id, username, text, meta.version())
+        return meta.messages + meta.uploads
+
+    def edit_message(self, title, number, username, text):
+        log = self.load(title)
+        meta = self.metas[title]
+        record = log.records[number - 1]
+        record.offset = self.append(title, meta, f"{record.id} {username}: {text}\n")
+        meta.garbage += 1
+        if self.index:
+            self.index.add(title, record.id, username, text, meta.version())
+
+    def delete_message(self, title, number):
+        log = self.load(title)
+        meta = self.metas[title]
+        record = log.records[number - 1]
+        self.append(title, meta, f"!DLT {record.id}\n")
+        del log.records[number - 1]
+        del log.by_id[record.id]
+        log.numbers = None
+        self.count_records(title, -1)
+        meta.messages -= 1
+        meta.garbage += 2
+        if self.index:
+            self.index.remove(title, record.id, meta.version())
+
+    def add_upload(self, title, username, filename):
+        meta = self.meta(title)
+        offset = self.append(title, meta, f"{username} uploaded {filename}\n")
+        meta.appended += 1
+        meta.uploads += 1
+
+        log = self.threads.get(title)
+        if log is not None:
+            log.add(ThreadRecord(None, username, offset))
+            self.count_records(title, 1)
+        if self.index:
+            self.index.set_version(title, meta.version())
+
+    # the thread as users see it: every live line, messages numbered by their current position.
+    # offset/count select a page of lines; a page is read line by line instead of reading the whole file
+    def read_thread(self, title, offset=0, count=None):
+        log = self.load(title)
+        end = len(log.records) if count is None else min(len(log.records), offset + count)
+        selected = log.records[offset:end]
+        if not selected:
+            return b""
+
+        out = []
+        f = self.file(title)
+        if count is None:
+            data = read_from(f)
+        for number, record in enumerate(selected, offset + 1):
+            if count is None:
+                line = line_at(data, record.offset)
+            else:
+                line = read_line(f, record.offset)
+            if record.id is not None:
+                line = b"%d %s" % (number, line.split(b" ", 1)[1])
+            out.append(line)
+        return b"".join(out)
+
+    # (id, user, line) of every live line in display order: id None for uploads, and message lines
+    # without their id, "{user}: {text}"
+    def records(self, title):
+        log = self.load(title)
+        data = read_from(self.file(title))
+        for record in log.records:
+            line = line_at(data, record.offset).decode(errors="replace").rstrip("\n")
+            if record.id is not None:
+                line = line.split(" ", 1)[1]
+            yield record.id, record.user, line
+
+    # (id, user, text) of every live message, for building a search index
+    def messages(self, title):
+        for message_id, user, line in self.records(title):
+            if message_id is not None:
+                yield message_id, user, line.split(": ", 1)[1]
+
+    # message number and full line of the message with this id, None if it is gone
+    def find_message(self, title, message_id):
+        log = self.load(title)
+        record = log.by_id.get(message_id)
+        if record is None:
+            return None
+        line = read_line(self.file(title), record.offset).decode(errors="replace").rstrip("\n")
+        return log.number(record), line.split(" ", 1)[1]
+
+    # what changed in a thread since a client last read it. since is either a message number (the client has
+    # messages 1..since) or a version returned by an earlier call, in which case only the lines appended or
+    # edited after that version are read back, plus the ids of the messages deleted after it. Returns
+    # (version, reset, lines, deleted ids); reset means the version is unknown (e.g. from before a
+    # compaction) and lines are the whole thread. Lines carry the stable id next to the number,
+    # "{number} {id} {user}: {text}", or "-" for uploads, so a client can merge them into its copy
+    def read_changes(self, title, since):
+        log = self.load(title)
+        meta = self.metas[title]
+        reset = False
+        base = 0
+        deleted = []
+        if since.isdigit():
+            selected = list(enumerate(log.records, 1))[int(since):]
+        else:
+            epoch, _, offset = since.partition(":")
+            base = int(offset) if offset.isdigit() else 0
+            if epoch != meta.epoch or not 0 < base <= meta.size:
+                reset, base = True, 0
+            selected = [(number, record) for number, record in enumerate(log.records, 1)
+                        if record.offset >= base]
+
+        f = self.file(title)
+        # a valid version is the offset of the start of a line
+        if base and os.pread(f.fileno(), 1, base - 1) != b"\n":
+            reset, base = True, 0
+            selected = list(enumerate(log.records, 1))
+        data = read_from(f, base)
+
+        out = []
+        for number, record in selected:
+            line = line_at(data, record.offset - base)
+            if record.id is not None:
+                out.append(b"%d %d %s" % (number, record.id, line.split(b" ", 1)[1]))
+            else:
+                out.append(b"%d - %s" % (number, line))
+        if base:
+            for line in data.split(b"\n"):
+                if line.startswith(b"!DLT ") and line[5:].isdigit():
+                    deleted.append(int(line[5:]))
+        return meta.version(), reset, b"".join(out), deleted
+
+    # write a whole thread at once, as records() returns them; for copying threads from another store
+    def restore(self, title, creator, created, modified, records):
+        lines = [f"{creator}\n"]
+        for message_id, user, line in records:
+            lines.append(f"{message_id} {line}\n" if message_id is not None else f"{line}\n")
+        with open(self.path(title), "xb") as f:
+            f.write("".join(lines).encode())
+            f.flush()
+            os.fsync(f.fileno())
+        self.catalog.add(title)
+        self.load(title)
+        meta = self.metas[title]
+        meta.created, meta.modified = created, modified
+        self.times[title] = (created, modified)
+        meta.dirty = True
+        self.save_metadata(title)
+
+    def dirty_metadata(self):
+        with self.cache_lock:
+            return [title for title, meta in self.metas.items() if meta.dirty]
+
+    # write the counters of a thread to its sidecar (atomically, so a crash leaves the old one)
+    def save_metadata(self, title):
+        meta = self.metas.get(title)
+        if meta is None or not meta.dirty:
+            return
+        tmp_path = self.meta_path(title) + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(meta.to_json())
+        os.replace(tmp_path, self.meta_path(title))
+        meta.dirty = False
+
+    def needs_compaction(self, title):
+        meta = self.metas.get(title)
+        return (meta is not None and meta.garbage >= self.compact_min_garbage
+                and meta.garbage > meta.messages + meta.uploads)
+
+    def threads_needing_compaction(self):
+        with self.cache_lock:
+            titles = list(self.metas)
+        return [title for title in titles if self.needs_compaction(title)]
+
+    def close(self):
+        with self.cache_lock:
+            files, self.files = list(self.files.values()), collections.OrderedDict()
+        for f in files:
+            f.close()
+
+    # rewrite the file with only the live lines (keeping their ids), dropping old versions and tombstones
+    def compact(self, title):
+        if not self.needs_compaction(title):
+            return
+        log = self.load(title)
+        meta = self.metas[title]
+        path = self.path(title)
+        data = read_from(self.file(title))
+
+        out = [f"{meta.creator}\n".encode()]
+        offset = len(out[0])
+        for record in log.records:
+            line = line_at(data, record.offset)
+            record.offset = offset
+            offset += len(line)
+            out.append(line)
+
+        # log records for this thread point into the old file, so they must all be in it for good first
+        if self.wal:
+            self.wal.checkpoint()
+        tmp_path = path + ".compact"
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(out))
+            f.flush()
+            os.fsync(f.fileno())
+        # the open file is the old one
+        self.close_file(title)
+        os.replace(tmp_path, path)
+        fsync_dir(self.root)
+        print(f"[compact] Thread '{title}': dropped {meta.garbage} stale lines")
+        meta.garbage = 0
+        meta.size = offset
+        meta.epoch = new_epoch()
+        meta.dirty = True
+        if self.index:
+            self.index.set_version(title, meta.version())
+
+
+# make renames and new files in a directory durable
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# server-wide write-ahead log of thread file writes. Every write is logged as the file, the offset it
+# goes to and its bytes right after it is made to the file, and the log is fsynced in groups: a
+# committer thread writes and fsyncs everything that arrived while it was busy (after waiting for the
+# group window, if any) with one fsync, and commit() waits for that. Thread files are written
+# without fsync; a checkpoint fsyncs the files written since the last one and starts a new log.
+# Each record is a header line "{crc32} {length}" followed by a body of that many bytes (the crc32 is
+# of the body): "A {offset} {path length} {path}{data}" for a write, "R 0 {path length} {path}" for
+# a file that was removed
+class WriteAheadLog:
+    def __init__(self, window=0.0, max_group=1 << 20):
+        self.window = window
+        self.max_group = max_group
+        self.path = None
+        self.file = None
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.io_lock = threading.Lock()     # held while writing to the log or replacing it
+        self.checkpoint_lock = threading.Lock()
+        self.pending = []       # records not written to the log yet
+        self.pending_size = 0
+        self.appended = 0       # number of records appended so far
+        self.durable = 0        # number of those that are fsynced
+        self.touched = set()    # files written since the last checkpoint
+
+    def open(self, path):
+        self.path = path
+        self.file = open(path, "ab")
+        threading.Thread(target=self.run, name="wal-committer", daemon=True).start()
+
+    # a record is a header line "<crc32> <length>" followed by that many bytes of body, so paths and
+    # data may hold spaces and newlines
+    def add(self, record, path):
+        record = b"%08x %d\n%s" % (zlib.crc32(record), len(record), record)
+        with self.lock:
+            self.pending.append(record)
+            self.pending_size += len(record)
+            self.appended += 1
+            self.touched.add(path)
+            self.changed.notify_all()
+
+    # body: kind, offset and path length, then the path and the data
+    def append(self, path, offset, data):
+        path_bytes = path.encode()
+        self.add(b"A %d %d %s%s" % (offset, len(path_bytes), path_bytes, data), path)
+
+    def remove(self, path):
+        path_bytes = path.encode()
+        self.add(b"R 0 %d %s" % (len(path_bytes), path_bytes), path)
+
+    # wait until every record appended so far is fsynced
+    def commit(self):
+        with self.lock:
+            target = self.appended
+            while self.durable < target:
+                self.changed.wait()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.changed.wait()
+            # let more writers join the group, unless it is big already
+            if self.window and self.pending_size < self.max_group:
+                time.sleep(self.window)
+            try:
+                self.write_pending()
+            except Exception as e:
+                # e.g. the disk is full: the writers keep waiting and the records are written later.
+                # Whatever went wrong, this thread must live on, or every commit() waits forever
+                print(f"===== Error writing the write-ahead log: {e}")
+                time.sleep(1.0)
+
+    def write_pending(self):
+        with self.io_lock:
+            with self.lock:
+                records, self.pending, self.pending_size = self.pending, [], 0
+                target = self.appended
+            try:
+                self.write(records, target)
+            except Exception:
+                self.put_back(records)
+                raise
+
+    # return records taken from pending that could not be written, ahead of the ones that came since
+    def put_back(self, records, touched=()):
+        with self.lock:
+            self.pending = records + self.pending
+            self.pending_size += sum(map(len, records))
+            self.touched.update(touched)
+
+    # write and fsync records, then tell the waiting writers; with io_lock held
+    def write(self, records, target):
+        if self.file.closed:
+            # a checkpoint failed between closing the log and opening the next one
+            self.file = open(self.path, "ab")
+        if records:
+            self.file.write(b"".join(records))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        with self.lock:
+            self.durable = max(self.durable, target)
+            self.changed.notify_all()
+
+    # make every logged write durable in the files themselves and start an empty log
+    def checkpoint(self):
+        with self.checkpoint_lock:
+            with self.io_lock:
+                # the records still going to this log and the files written since the last
+                # checkpoint are taken together, later ones belong to the new log
+                with self.lock:
+                    records, self.pending, self.pending_size = self.pending, [], 0
+                    target = self.appended
+                    touched, self.touched = self.touched, set()
+                try:
+                    self.write(records, target)
+                except Exception:
+                    self.put_back(records, touched)
+                    raise
+                old_path = self.path + ".old"
+                try:
+                    self.file.close()
+                    os.replace(self.path, old_path)
+                except Exception:
+                    # the records are in the log still, the files they touched wait for the next checkpoint
+                    self.put_back([], touched)
+                    raise
+                finally:
+                    # the log is always open, whether the rename happened or not
+                    self.file = open(self.path, "ab")
+
+            for path in touched:
+                try:
+                    with open(path, "rb") as f:
+                        os.fsync(f.fileno())
+                except FileNotFoundError:
+                    pass
+            fsync_dir(os.path.dirname(self.path) or ".")
+            os.remove(old_path)
+
+# (kind, path, offset, data) of each record in the contents of a write-ahead log. Reading stops at a
+# cut short or corrupt record, which can only be the end of the log a crash left behind; a record
+# that passes its checksum but cannot be understood is skipped
+def read_wal_records(log, name):
+    records = []
+    position = 0
+    while position < len(log):
+        header_end = log.find(b"\n", position)
+        header = log[position:header_end].split(b" ") if header_end >= 0 else []
+        if len(header) != 2 or not header[1].isdigit():
+            print(f"[wal] {name}: unreadable record at {position}, the rest of the log is ignored")
+            break
+        start = header_end + 1
+        end = start + int(header[1])
+        record = log[start:end]
+        if end > len(log) or header[0] != b"%08x" % zlib.crc32(record):
+            print(f"[wal] {name}: incomplete record at {position}, the rest of the log is ignored")
+            break
+        position = end
+        try:
+            kind, offset, path_length, rest = record.split(b" ", 3)
+            path_length = int(path_length)
+            path = rest[:path_length].decode()
+            if kind not in (b"A", b"R") or len(rest) < path_length or not path:
+                raise ValueError(kind)
+            records.append((kind, path, int(offset), rest[path_length:]))
+        except ValueError:
+            print(f"[wal] {name}: skipping a malformed record at {position - len(record)}")
+    return records
+
+# apply one record to its file; True if the file was written
+def apply_wal_record(kind, path, offset, data):
+    if kind == b"R":
+        for stale in (path, path + ".meta"):
+            if os.path.exists(stale):
+                os.remove(stale)
+        return False
+
+    size = os.path.getsize(path) if os.path.exists(path) else None
+    if size is None and offset != 0 or size is not None and size < offset:
+        print(f"[wal] Skipping a write to {path} at {offset}, the file is shorter")
+        return False
+    if size is not None and size >= offset + len(data):
+        with open(path, "rb") as f:
+            f.seek(offset)
+            if f.read(len(data)) != data:
+                print(f"[wal] {path} differs from the log at {offset}, left as it is")
+        return False
+    # missing or cut short: write it (again) and drop whatever partial write follows
+    with open(path, "r+b" if size is not None else "wb") as f:
+        f.seek(offset)
+        f.write(data)
+        f.truncate()
+    return True
+
+# names of the logs a server writes: "wal.log", or "wal-{process}.log" for each of several processes,
+# and the ".old" log of a checkpoint that has not finished
+WAL_NAME = re.compile(r"wal(-\d+)?\.log(\.old)?$")
+
+# "wal.lock" in root, locked for as long as the returned file stays open (forked processes share it),
+# so a second server cannot replay and delete the logs of one that is running; None if one is
+def lock_wal(root):
+    f = open(os.path.join(root, "wal.lock"), "a")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+# bring the thread files up to date from the logs a previous run left in root ("wal*.log", and the
+# ".old" log of a checkpoint it did not finish), then delete them. Records are applied by offset, so
+# one that already reached its file is skipped. Returns the number of records applied
+def replay_wal(root):
+    logs = sorted(entry.name for entry in os.scandir(root) if WAL_NAME.match(entry.name))
+    # a log's ".old" predecessor comes first
+    logs.sort(key=lambda name: (name.replace(".old", ""), not name.endswith(".old")))
+    records = []
+    for name in logs:
+        with open(os.path.join(root, name), "rb") as f:
+            log = f.read()
+        records.extend(read_wal_records(log, name))
+
+    # writes to a file before it was removed are skipped
+    last_removal = {}
+    for n, (kind, path, offset, data) in enumerate(records):
+        if kind == b"R":
+            last_removal[path] = n
+
+    applied = 0
+    touched = set()
+    for n, (kind, path, offset, data) in enumerate(records):
+        if n < last_removal.get(path, -1):
+            continue
+        try:
+            if apply_wal_record(kind, path, offset, data):
+                touched.add(path)
+                applied += 1
+        except OSError as e:
+            print(f"[wal] Could not apply a record for {path}: {e}")
+
+    for path in touched:
+        with open(path, "rb") as f:
+            os.fsync(f.fileno())
+    fsync_dir(root)
+    for name in logs:
+        os.remove(os.path.join(root, name))
+    return applied
+
+# words of a message as the search index sees them: lowercase runs of letters and digits
+def search_tokens(text):
+    return set(re.findall(r"\w+", text.lower()))
+
+# inverted index over all messages: word -> {thread title: ids of the messages containing it}, kept up
+# to date by ThreadStore as messages are posted, edited and deleted. It is saved to one file now and
+# then, with the version of each thread it covers; on startup (load, then sync) a thread whose version
+# differs (changed after the last save, or by hand) is indexed again from its file.
+class SearchIndex:
+    def __init__(self, compact_min_size=1 << 20):
+        self.path = None
+        self.lock = threading.Lock()
+        self.postings = {}      # word -> {title: set of message ids}
+        self.messages = {}      # title -> {message id: (user, words)}, to undo a message's postings
+        self.versions = {}      # title -> thread version the entries above reflect
+        self.changes = []       # changes not saved yet, as save writes them to the log
+        # save appends the changes to a log next to the index file and only writes the whole index
+        # again (from the file and the log, without the lock) once the log is bigger than the file
+        self.save_lock = threading.Lock()
+        self.compact_min_size = compact_min_size
+
+    def log_path(self):
+        return self.path + ".log"
+
+    # read the index saved to path, which is also where save writes it
+    def load(self, path):
+        self.path = path
+        saved = self.read_saved()
+        with self.lock:
+            for title, thread in saved.items():
+                self.versions[title] = thread["version"]
+                for message_id, (user, words) in thread["messages"].items():
+                    self.insert(title, int(message_id), user, words.split())
+
+    # {title: {"version": ..., "messages": {id: [user, "words"]}}} from the index file and its log.
+    # A log line cut short by a crash ends the log; anything unreadable leaves those threads to sync
+    def read_saved(self):
+        try:
+            with open(self.path, "r") as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            saved = {}
+        try:
+            with open(self.log_path(), "r") as f:
+                for line in f:
+                    try:
+                        apply_index_change(saved, json.loads(line))
+                    except (ValueError, KeyError, TypeError, AttributeError):
+                        break
+        except OSError:
+            pass
+        return saved
+
+    def insert(self, title, message_id, user, words):
+        self.messages.setdefault(title, {})[message_id] = (user, words)
+        for word in words:
+            self.postings.setdefault(word, {}).setdefault(title, set()).add(message_id)
+
+    def discard(self, title, message_id):
+        entry = self.messages.get(title, {}).pop(message_id, None)
+        if entry is None:
+            return
+        for word in entry[1]:
+            titles = self.postings[word]
+            titles[title].discard(message_id)
+            if not titles[title]:
+                del titles[title]
+                if not titles:
+                    del self.postings[word]
+
+    # a new message, or a new version of one
+    def add(self, title, message_id, user, text, version):
+        with self.lock:
+            self.discard(title, message_id)
+            words = sorted(search_tokens(text))
+            self.insert(title, message_id, user, words)
+            self.versions[title] = version
+            self.changes.append({"title": title, "version": version,
+                                 "messages": {message_id: [user, " ".join(words)]}})
+
+    def remove(self, title, message_id, version):
+        with self.lock:
+            self.discard(title, message_id)
+            self.versions[title] = version
+            self.changes.append({"title": title, "version": version, "deleted": [message_id]})
+
+    # the thread changed without changing its messages (an upload, a compaction)
+    def set_version(self, title, version):
+        with self.lock:
+            self.versions[title] = version
+            self.changes.append({"title": title, "version": version})
+
+    def remove_thread(self, title):
+        with self.lock:
+            for message_id in list(self.messages.get(title, ())):
+                self.discard(title, message_id)
+            self.messages.pop(title, None)
+            self.versions.pop(title, None)
+            self.changes.append({"title": title, "removed": True})
+
+    # bring the index in line with the threads on disk (all of them, or only the given titles);
+    # returns how many threads were indexed again. Versions come from store.version, which does
+    # not load the threads, so only the threads that changed are read
+    def sync(self, store, titles=None):
+        titles = set(store.catalog if titles is None else titles)
+        for title in set(self.versions) - titles:
+            self.remove_thread(title)
+        indexed = 0
+        for title in titles:
+            with store.lock(title):
+                version = store.version(title)
+                if version is not None and self.versions.get(title) == version:
+                    continue
+                messages = {message_id: (user, sorted(search_tokens(text)))
+                            for message_id, user, text in store.messages(title)}
+                if version is None:
+                    version = store.version(title)
+                with self.lock:
+                    for message_id in list(self.messages.get(title, ())):
+                        self.discard(title, message_id)
+                    for message_id, (user, words) in messages.items():
+                        self.insert(title, message_id, user, words)
+                    self.versions[title] = version
+                    self.changes.append({"title": title, "version": version, "replace": True,
+                                         "messages": {message_id: [user, " ".join(words)]
+                                                      for message_id, (user, words) in messages.items()}})
+            indexed += 1
+        return indexed
+
+    # (title, message id) of the messages containing every word of the query (and written by user,
+    # if given), as a heap: heapq.heappop gives them ordered by thread and id, so a caller that only
+    # wants the first few never sorts the rest. Starts from the rarest word, so the work is bounded by it
+    def search(self, query, user=None):
+        words = search_tokens(query)
+        with self.lock:
+            postings = [self.postings.get(word) for word in words]
+            if not postings or None in postings:
+                return []
+            postings.sort(key=lambda titles: sum(map(len, titles.values())))
+            hits = []
+            for title, ids in postings[0].items():
+                ids = set(ids)
+                for titles in postings[1:]:
+                    ids &= titles.get(title, set())
+                    if not ids:
+                        break
+                if user is not None:
+                    ids = [message_id for message_id in ids if self.messages[title][message_id][0] == user]
+                hits.extend((title, message_id) for message_id in ids)
+        heapq.heapify(hits)
+        return hits
+
+    # append the changes since the last save to the log; once the log outgrows the index file, write
+    # the file again (atomically, so a crash leaves the previous one) and start an empty log
+    def save(self):
+        if self.path is None:
+            return
+        with self.save_lock:
+            with self.lock:
+                changes, self.changes = self.changes, []
+            if changes:
+                with open(self.log_path(), "a") as f:
+                    f.write("".join(json.dumps(change) + "\n" for change in changes))
+            try:
+                log_size = os.path.getsize(self.log_path())
+            except OSError:
+                return
+            index_size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            if log_size < max(index_size, self.compact_min_size):
+                return
+            saved = self.read_saved()
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(saved, f)
+            os.replace(tmp_path, self.path)
+            # a crash before this leaves a log whose changes are in the file already, applying
+            # them again changes nothing
+            open(self.log_path(), "w").close()
+
+# apply one change from a search index log to the saved form of the index (see read_saved)
+def apply_index_change(saved, change):
+    title = change["title"]
+    if change.get("removed"):
+        saved.pop(title, None)
+        return
+    thread = saved.setdefault(title, {"version": None, "messages": {}})
+    if change.get("replace"):
+        thread["messages"] = {}
+    thread["version"] = change["version"]
+    thread["messages"].update(change.get("messages", {}))
+    for message_id in change.get("deleted", ()):
+        thread["messages"].pop(str(message_id), None)
+
+
+# uploaded files, stored once per content: a file lives at "objects/ab/cd/{sha256}" under the root,
+# and each thread has a manifest "manifests/{title}" of "{sha256} {filename}" lines naming the files
+# posted to it. A file is deleted when the last thread referring to it is removed. Uploads are
+# received into "incoming/" and moved into place once their checksum is known.
+# A shared store is used by several processes, each for its own threads: changes then also take a
+# lock on the store's files, and a file is only deleted when no manifest on disk refers to it.
+class AttachmentStore:
+    def __init__(self, root="attachments", shared=False):
+        self.root = root
+        self.shared = shared
+        self.objects = os.path.join(root, "objects")
+        self.manifests = os.path.join(root, "manifests")
+        self.incoming = os.path.join(root, "incoming")
+        for path in (self.objects, self.manifests, self.incoming):
+            os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.files = {}         # thread title -> {filename: sha256}
+        self.refcounts = {}     # sha256 -> number of (thread, filename) references to it
+        for entry in os.scandir(self.manifests):
+            if entry.is_file():
+                self.load_manifest(entry.name)
+
+    def manifest_path(self, title):
+        return os.path.join(self.manifests, title)
+
+    def object_path(self, checksum):
+        return os.path.join(self.objects, checksum[:2], checksum[2:4], checksum)
+
+    def incoming_path(self, name):
+        return os.path.join(self.incoming, name)
+
+    def load_manifest(self, title):
+        files = {}
+        with open(self.manifest_path(title), "rb") as f:
+            for line in f:
+                checksum, sep, filename = line.decode().rstrip("\n").partition(" ")
+                if sep and len(checksum) == 64:
+                    files[filename] = checksum
+        self.files[title] = files
+        for checksum in files.values():
+            self.refcounts[checksum] = self.refcounts.get(checksum, 0) + 1
+
+    # sha256 of a file posted to a thread, None if there is no such file
+    def lookup(self, title, filename):
+        return self.files.get(title, {}).get(filename)
+
+    # files stored by other processes sharing the store are not counted here, so look on disk too
+    def has_object(self, checksum):
+        return checksum in self.refcounts or (self.shared and os.path.exists(self.object_path(checksum)))
+
+    @contextlib.contextmanager
+    def locked(self):
+        with self.lock, file_lock(os.path.join(self.root, "lock")) if self.shared else contextlib.nullcontext():
+            yield
+
+    # post a file to a thread. source is the received file: it is moved into the store, or just
+    # deleted when the same content is already stored; without a source the content must be stored
+    def add(self, title, filename, checksum, source=None):
+        with self.locked():
+            if not self.has_object(checksum):
+                if source is None:
+                    # another process deleted it since the caller checked
+                    raise FileNotFoundError(f"{checksum} is no longer stored")
+                path = self.object_path(checksum)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(source, path)
+            elif source is not None:
+                os.remove(source)
+            with open(self.manifest_path(title), "ab") as f:
+                f.write(f"{checksum} {filename}\n".encode())
+            self.files.setdefault(title, {})[filename] = checksum
+            self.refcounts[checksum] = self.refcounts.get(checksum, 0) + 1
+
+    # drop all files of a removed thread, deleting those no other thread refers to
+    def remove_thread(self, title):
+        with self.locked():
+            files = self.files.pop(title, {})
+            if os.path.exists(self.manifest_path(title)):
+                os.remove(self.manifest_path(title))
+            referenced = None
+            for checksum in files.values():
+                self.refcounts[checksum] -= 1
+                if self.refcounts[checksum] == 0:
+                    del self.refcounts[checksum]
+                    if self.shared:
+                        referenced = referenced if referenced is not None else self.manifest_checksums()
+                        if checksum in referenced:
+                            continue
+                    if os.path.exists(self.object_path(checksum)):
+                        os.remove(self.object_path(checksum))
+
+    # every sha256 named by a manifest on disk, including those of other processes' threads
+    def manifest_checksums(self):
+        checksums = set()
+        for entry in os.scandir(self.manifests):
+            with open(entry.path, "rb") as f:
+                for line in f:
+                    checksums.add(line.split(b" ", 1)[0].decode())
+        return checksums
+
+    # move "{thread}-{filename}" uploads saved by older versions of the server into the store,
+    # returns how many were moved. This runs once: a marker file in the root records that it did
+    def import_legacy(self, directory, titles):
+        marker = os.path.join(self.root, "legacy-imported")
+        if os.path.exists(marker):
+            return 0
+        imported = 0
+        for entry in os.scandir(directory):
+            # thread files, their "{title}.meta"-style sidecars and stale partial uploads stay
+            if (not entry.is_file() or entry.name.split(".", 1)[0] in titles
+                    or entry.name.endswith(".part")):
+                continue
+            # the longest thread title the name starts with, as titles may contain "-" themselves
+            title = None
+            for i in range(len(entry.name) - 1, 0, -1):
+                if entry.name[i] == "-" and entry.name[:i] in titles:
+                    title = entry.name[:i]
+                    break
+            if title is None:
+                continue
+            filename = entry.name[len(title) + 1:]
+            if self.lookup(title, filename) is None:
+                self.add(title, filename, file_sha256(entry.path), entry.path)
+                imported += 1
+        with open(marker, "w"):
+            pass
+        return imported
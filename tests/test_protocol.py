@@ -0,0 +1,46 @@
+import itertools
+
+import pytest
+
+import protocol
+from protocol import OPCODES, STATUS_ERROR, encode_frame, parse_frame
+
+
+def test_frame_round_trip():
+    fields = [b"t", b"a message\nwith a newline", b""]
+    frame = encode_frame(OPCODES["EDT"], 7, fields, STATUS_ERROR)
+    assert parse_frame(frame) == (OPCODES["EDT"], STATUS_ERROR, 7, fields)
+
+
+def test_text_is_not_a_frame():
+    assert parse_frame(b"MSG t hello") is None
+    assert parse_frame(b"") is None
+
+
+def test_truncated_frames_raise():
+    frame = encode_frame(OPCODES["MSG"], 1, [b"t", b"hello"])
+    for end in range(1, len(frame)):
+        with pytest.raises(ValueError):
+            parse_frame(frame[:end])
+
+
+def test_field_longer_than_the_frame_raises():
+    frame = protocol.FRAME_MARKER + protocol.FRAME_HEADER.pack(OPCODES["CRT"], 0, 1, 1)
+    frame += protocol.FIELD_LENGTH.pack(1 << 31) + b"t"
+    with pytest.raises(ValueError):
+        parse_frame(frame)
+
+
+def test_parse_request():
+    assert protocol.parse_request(protocol.encode_request(42, b"MSG t hi\nthere")) == (42, b"MSG t hi\nthere")
+    assert protocol.parse_request(b"MSG t hi") is None
+    for data in (b"\x01", b"\x0142", b"\x01x\nMSG t hi", b"\x01\nMSG"):
+        with pytest.raises(ValueError):
+            protocol.parse_request(data)
+
+
+def test_notifications_carry_their_origin():
+    datagrams = protocol.encode_notifications(["one", "two"], itertools.count(5), origin=2)
+    assert [protocol.parse_notification(datagram) for datagram in datagrams] == [(2, 5, ["one", "two"])]
+    # from a server that does not send an origin
+    assert protocol.parse_notification(protocol.NOTIFY_MARKER + b"3\nold") == (0, 3, ["old"])
@@ -0,0 +1,67 @@
+import pytest
+
+from storage import ThreadStore, is_valid_username, parse_message_line, parse_upload_line
+
+
+@pytest.mark.parametrize("name", ["hans", "c_d", "yoda42", "x!"])
+def test_valid_usernames(name):
+    assert is_valid_username(name)
+
+
+@pytest.mark.parametrize("name", ["", "m\n1 alice", "a b", "a\tb", "c:d", "!DLT", "a/b", "a\\b", "a\x00b"])
+def test_usernames_that_could_forge_lines(name):
+    assert not is_valid_username(name)
+
+
+def test_parse_message_line():
+    assert parse_message_line(b"3 hans: hi: there") == (3, "hans")
+    assert parse_message_line(b"3 hans:hi") is None
+    assert parse_message_line(b"x hans: hi") is None
+    assert parse_message_line(b"3 a b: hi") is None
+    assert parse_message_line(b"3 !DLT: hi") is None
+
+
+def test_parse_upload_line():
+    assert parse_upload_line(b"hans uploaded a file.txt") == "hans"
+    assert parse_upload_line(b"hans uploaded ") is None
+    assert parse_upload_line(b"hans posted f.txt") is None
+    assert parse_upload_line(b"c:d uploaded f.txt") is None
+
+
+def test_load_ignores_forged_and_unknown_lines(tmp_path):
+    (tmp_path / "t").write_bytes(b"hans\n"
+                                 b"1 hans: hello\n"
+                                 b"1 yoda: forged edit\n"
+                                 b"2 hans: second\n"
+                                 b"!DLT 2\n"
+                                 b"nonsense line\n"
+                                 b"yoda uploaded f.txt\n"
+                                 b"3 a b: x\n"
+                                 b"4 yoda: ok\n"
+                                 b"!DLT 9\n")
+    store = ThreadStore(str(tmp_path))
+    assert store.read_thread("t") == b"1 hans: hello\nyoda uploaded f.txt\n3 yoda: ok\n"
+    meta = store.meta("t")
+    assert (meta.messages, meta.uploads, meta.garbage) == (2, 1, 6)
+    assert meta.next_id() == 5
+    assert store.find_message("t", 4) == (3, "yoda: ok")
+    assert store.message_author("t", 2) is None
+
+
+def test_reload_matches_the_changes_made(tmp_path):
+    store = ThreadStore(str(tmp_path))
+    store.create("t", "hans")
+    store.post_message("t", "hans", "one")
+    store.post_message("t", "yoda", "two")
+    store.add_upload("t", "hans", "f.txt")
+    store.post_message("t", "hans", "three")
+    store.edit_message("t", 2, "yoda", "two, edited")
+    store.delete_message("t", 1)
+    expected = b"1 yoda: two, edited\nhans uploaded f.txt\n3 hans: three\n"
+    assert store.read_thread("t") == expected
+    assert store.find_message("t", 4) == (3, "hans: three")
+
+    reloaded = ThreadStore(str(tmp_path))
+    assert reloaded.read_thread("t") == expected
+    assert reloaded.post_message("t", "yoda", "four") == 4
+    assert reloaded.find_message("t", 5) == (4, "yoda: four")
@@ -0,0 +1,156 @@
+import os
+import zlib
+
+import pytest
+
+import storage
+from storage import WriteAheadLog, lock_wal, read_wal_records, replay_wal
+
+
+def record(body):
+    return b"%08x %d\n%s" % (zlib.crc32(body), len(body), body)
+
+
+def write_record(path, offset, data):
+    path_bytes = path.encode()
+    return record(b"A %d %d %s%s" % (offset, len(path_bytes), path_bytes, data))
+
+
+def remove_record(path):
+    path_bytes = path.encode()
+    return record(b"R 0 %d %s" % (len(path_bytes), path_bytes))
+
+
+@pytest.fixture
+def wal(tmp_path):
+    log = WriteAheadLog()
+    log.open(str(tmp_path / "wal.log"))
+    yield log
+    log.file.close()
+
+
+def test_records_round_trip_with_spaces_and_newlines_in_paths(tmp_path, wal):
+    path = str(tmp_path / "a thread\nwith lines")
+    wal.append(path, 0, b"hans\n")
+    wal.append(path, 5, b"1 hans: a b\nc\n")
+    wal.remove(path)
+    wal.commit()
+
+    log = (tmp_path / "wal.log").read_bytes()
+    assert read_wal_records(log, "wal.log") == [
+        (b"A", path, 0, b"hans\n"),
+        (b"A", path, 5, b"1 hans: a b\nc\n"),
+        (b"R", path, 0, b""),
+    ]
+
+
+def test_torn_tail_is_ignored():
+    log = write_record("t", 0, b"hans\n") + write_record("t", 5, b"1 hans: hi\n")
+    for cut in range(1, len(write_record("t", 5, b"1 hans: hi\n"))):
+        assert read_wal_records(log[:-cut], "wal.log") == [(b"A", "t", 0, b"hans\n")]
+
+
+def test_bad_checksum_ends_the_log():
+    second = bytearray(write_record("t", 5, b"1 hans: hi\n"))
+    second[-2] ^= 0xFF
+    log = write_record("t", 0, b"hans\n") + bytes(second) + write_record("t", 16, b"2 hans: yo\n")
+    assert read_wal_records(log, "wal.log") == [(b"A", "t", 0, b"hans\n")]
+
+
+def test_malformed_record_with_good_checksum_is_skipped():
+    log = (write_record("t", 0, b"hans\n") + record(b"X 0 1 t") + record(b"A 0 99 t")
+           + write_record("t", 5, b"1 hans: hi\n"))
+    assert read_wal_records(log, "wal.log") == [(b"A", "t", 0, b"hans\n"), (b"A", "t", 5, b"1 hans: hi\n")]
+
+
+def test_replay_restores_a_file_cut_short_by_a_crash(tmp_path):
+    path = str(tmp_path / "t")
+    lines = [b"hans\n", b"1 hans: first\n", b"2 hans: second\n"]
+    log = b""
+    offset = 0
+    for line in lines:
+        log += write_record(path, offset, line)
+        offset += len(line)
+    # the crash left the last line half written, and the log ends in a torn record
+    (tmp_path / "t").write_bytes(b"".join(lines)[:-6])
+    (tmp_path / "wal.log").write_bytes(log + write_record(path, offset, b"3 hans: lost\n")[:-4])
+
+    assert replay_wal(str(tmp_path)) == 1
+    assert (tmp_path / "t").read_bytes() == b"".join(lines)
+    assert not (tmp_path / "wal.log").exists()
+
+
+def test_replay_leaves_files_that_are_up_to_date(tmp_path):
+    path = str(tmp_path / "t")
+    (tmp_path / "t").write_bytes(b"hans\n1 hans: hi\n")
+    (tmp_path / "wal.log").write_bytes(write_record(path, 0, b"hans\n") + write_record(path, 5, b"1 hans: hi\n"))
+    assert replay_wal(str(tmp_path)) == 0
+    assert (tmp_path / "t").read_bytes() == b"hans\n1 hans: hi\n"
+
+
+def test_replay_applies_the_old_log_first(tmp_path):
+    path = str(tmp_path / "t")
+    (tmp_path / "wal.log.old").write_bytes(write_record(path, 0, b"hans\n"))
+    (tmp_path / "wal.log").write_bytes(write_record(path, 5, b"1 hans: hi\n"))
+    assert replay_wal(str(tmp_path)) == 2
+    assert (tmp_path / "t").read_bytes() == b"hans\n1 hans: hi\n"
+    assert not (tmp_path / "wal.log.old").exists()
+
+
+def test_replay_skips_writes_before_a_removal(tmp_path):
+    path = str(tmp_path / "t")
+    (tmp_path / "t").write_bytes(b"hans\n")
+    (tmp_path / "t.meta").write_bytes(b"{}")
+    (tmp_path / "wal-1.log").write_bytes(write_record(path, 0, b"hans\n") + write_record(path, 5, b"1 hans: hi\n")
+                                         + remove_record(path))
+    replay_wal(str(tmp_path))
+    assert not (tmp_path / "t").exists()
+    assert not (tmp_path / "t.meta").exists()
+
+
+def test_replay_only_touches_server_logs(tmp_path):
+    (tmp_path / "wallet.log").write_bytes(b"not a log")
+    (tmp_path / "wal.log.bak").write_bytes(b"not a log")
+    (tmp_path / "wal-2.log").write_bytes(b"")
+    replay_wal(str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == ["wal.log.bak", "wallet.log"]
+
+
+def test_a_second_server_cannot_lock_the_logs(tmp_path):
+    first = lock_wal(str(tmp_path))
+    assert first is not None
+    assert lock_wal(str(tmp_path)) is None
+    first.close()
+    second = lock_wal(str(tmp_path))
+    assert second is not None
+    second.close()
+
+
+def test_checkpoint_starts_an_empty_log(tmp_path, wal):
+    path = str(tmp_path / "t")
+    (tmp_path / "t").write_bytes(b"hans\n")
+    wal.append(path, 0, b"hans\n")
+    wal.commit()
+    wal.checkpoint()
+    assert (tmp_path / "wal.log").read_bytes() == b""
+    assert not (tmp_path / "wal.log.old").exists()
+
+
+def test_failed_checkpoint_keeps_the_log_usable(tmp_path, wal, monkeypatch):
+    path = str(tmp_path / "t")
+    (tmp_path / "t").write_bytes(b"hans\n")
+    wal.append(path, 0, b"hans\n")
+
+    def fail(src, dst):
+        raise OSError("rename failed")
+    monkeypatch.setattr(storage.os, "replace", fail)
+    with pytest.raises(OSError):
+        wal.checkpoint()
+    monkeypatch.undo()
+
+    # the log is open again, later writes still commit and the next checkpoint sees the file
+    wal.append(path, 5, b"1 hans: hi\n")
+    wal.commit()
+    assert path in wal.touched
+    records = read_wal_records((tmp_path / "wal.log").read_bytes(), "wal.log")
+    assert records == [(b"A", path, 0, b"hans\n"), (b"A", path, 5, b"1 hans: hi\n")]